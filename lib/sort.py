@@ -75,9 +75,9 @@ class KalmanBoxTracker(object):
   This class represents the internel state of individual tracked objects observed as bbox.
   """
   count = 0
-  def __init__(self,bbox):
+  def __init__(self,bbox,id=None):
     """
-    Initialises a tracker using initial bounding box.
+    Initialises a tracker using initial bounding box. A new id is taken from the counter unless one is given.
     """
     #define constant velocity model
     self.kf = KalmanFilter(dim_x=7, dim_z=4)
@@ -92,9 +92,11 @@ class KalmanBoxTracker(object):
 
     self.kf.x[:4] = convert_bbox_to_z(bbox)
     self.time_since_update = 0
-    self.id = KalmanBoxTracker.count
+    if id is None:
+      id = KalmanBoxTracker.count
+      KalmanBoxTracker.count += 1
+    self.id = id
     self.detIndex = None
-    KalmanBoxTracker.count += 1
     self.history = []
     self.hits = 0
     self.hit_streak = 0
@@ -126,61 +128,113 @@ class KalmanBoxTracker(object):
     self.history.append(convert_x_to_bbox(self.kf.x))
     return self.history[-1]
 
+  def propagate(self):
+    """
+    Advances the state vector on a frame where the detector wasn't run, and returns the predicted bounding box estimate.
+    Unlike predict, this doesn't count as a missed detection.
+    """
+    if((self.kf.x[6]+self.kf.x[2])<=0):
+      self.kf.x[6] *= 0.0
+    self.kf.predict()
+    self.age += 1
+    self.history.append(convert_x_to_bbox(self.kf.x))
+    return self.history[-1]
+
   def get_state(self):
     """
     Returns the current bounding box estimate.
     """
     return convert_x_to_bbox(self.kf.x)
 
-def associate_detections_to_trackers(detections,trackers,mode, match_score_threshold = 0.2, feature_vector_threshold = 0.3, euclid_threshold = 200, iou_mode_iou_weight=1.0, iou_mode_similarity_weight=1.5, euclid_mode_similarity_weight=2.0, euclid_mode_distance_weight=1.0):
+# The columns of the counters array made by Sort.to_arrays
+tracker_counter_fields = ['id', 'time_since_update', 'hits', 'hit_streak', 'age', 'det_index', 'allow_deletion']
+
+def iou_batch(bb_test,bb_gt):
   """
-  Assigns detections to tracked object (both represented as bounding boxes)
+  Computes IUO between every pair of bboxes from a [N,4] and a [M,4] array, both in the form [x1,y1,x2,y2].
+  Returns a [N,M] matrix
+  """
+  bb_test = np.expand_dims(bb_test, 1)
+  bb_gt = np.expand_dims(bb_gt, 0)
+  xx1 = np.maximum(bb_test[...,0], bb_gt[...,0])
+  yy1 = np.maximum(bb_test[...,1], bb_gt[...,1])
+  xx2 = np.minimum(bb_test[...,2], bb_gt[...,2])
+  yy2 = np.minimum(bb_test[...,3], bb_gt[...,3])
+  w = np.maximum(0., xx2 - xx1)
+  h = np.maximum(0., yy2 - yy1)
+  wh = w * h
+  with np.errstate(divide='ignore', invalid='ignore'):
+    o = wh / ((bb_test[...,2]-bb_test[...,0])*(bb_test[...,3]-bb_test[...,1])
+      + (bb_gt[...,2]-bb_gt[...,0])*(bb_gt[...,3]-bb_gt[...,1]) - wh)
+  return(o)
 
-  Returns 3 lists of matches, unmatched_detections and unmatched_trackers
+def cosine_similarity_batch(features_a,features_b):
   """
-  if(len(trackers)==0):
-    return np.empty((0,2),dtype=int), np.arange(len(detections)), np.empty((0,5),dtype=int)
-  iou_matrix = np.zeros((len(detections),len(trackers)),dtype=np.float32)
+  Computes the cosine similarity between every pair of rows from a [N,K] and a [M,K] array of feature vectors.
+  Pairs where either feature vector is all zeros get a similarity of 0. Returns a [N,M] matrix
+  """
+  norm_a = np.linalg.norm(features_a, axis=1)
+  norm_b = np.linalg.norm(features_b, axis=1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    similarity = np.dot(features_a, features_b.T) / np.outer(norm_a, norm_b)
+  similarity[np.count_nonzero(features_a, axis=1) == 0, :] = 0
+  similarity[:, np.count_nonzero(features_b, axis=1) == 0] = 0
+  return similarity
+
+def compute_score_matrix(detections,trackers,mode, feature_vector_threshold = 0.3, euclid_threshold = 200, iou_mode_iou_weight=1.0, iou_mode_similarity_weight=1.5, euclid_mode_similarity_weight=2.0, euclid_mode_distance_weight=1.0):
+  """
+  Computes the match score between every detection and every tracker, both in the form [x1,y1,x2,y2,score,features...]
+
+  Returns a [len(detections),len(trackers)] matrix, where higher scores are better matches
+  """
+  if(len(detections)==0 or len(trackers)==0):
+    return np.zeros((len(detections),len(trackers)),dtype=np.float32)
 
-  for d,det in enumerate(detections):
-    for t,trk in enumerate(trackers):
-      # Compute similarity metric for their feature vectors
-      if np.count_nonzero(det[5:]) == 0 or np.count_nonzero(trk[5:]) == 0:
-        similarityMetric = 0
-      else:
-        similarityMetric = 1.0 - scipy.spatial.distance.cosine(det[5:], trk[5:])
+  detections = np.asarray(detections, dtype=np.float64)
+  trackers = np.asarray(trackers, dtype=np.float64)
 
-      if mode == 'iou':
-        if similarityMetric < feature_vector_threshold:
-          similarityMetric = 0.0
-        iou_metric = iou(det,trk)
+  # Compute similarity metric for their feature vectors
+  similarity = cosine_similarity_batch(detections[:,5:], trackers[:,5:])
 
-        finalMetric = iou_metric * iou_mode_iou_weight + similarityMetric*iou_mode_similarity_weight
+  if mode == 'iou':
+    similarity[similarity < feature_vector_threshold] = 0.0
+    score_matrix = iou_batch(detections[:,:4], trackers[:,:4]) * iou_mode_iou_weight + similarity * iou_mode_similarity_weight
+  elif mode == 'euclidean':
+    det_centers = np.stack([detections[:,0]/2 + detections[:,2]/2, detections[:,1]/2 + detections[:,3]/2], axis=1)
+    trk_centers = np.stack([trackers[:,0]/2 + trackers[:,2]/2, trackers[:,1]/2 + trackers[:,3]/2], axis=1)
 
-        iou_matrix[d, t] = finalMetric
-      elif mode == 'euclidean':
-        cx1 = det[0]/2 + det[2]/2
-        cy1 = det[1]/2 + det[3]/2
+    dist = np.sqrt(np.sum(np.square(np.expand_dims(trk_centers, 0) - np.expand_dims(det_centers, 1)), axis=2))
 
-        cx2 = trk[0]/2 + trk[2]/2
-        cy2 = trk[1]/2 + trk[3]/2
+    dist_metric = scipy.special.expit(dist / (euclid_threshold / 2))
 
-        dist = math.sqrt((cx2-cx1)*(cx2-cx1) + (cy2-cy1)*(cy2-cy1))
+    score_matrix = similarity * euclid_mode_similarity_weight - dist_metric * euclid_mode_distance_weight
+  else:
+    score_matrix = np.zeros((len(detections),len(trackers)))
+
+  return score_matrix.astype(np.float32)
 
-        distMetric = scipy.special.expit(dist / (euclid_threshold / 2))
+def associate_detections_to_trackers(detections,trackers,mode, match_score_threshold = 0.2, feature_vector_threshold = 0.3, euclid_threshold = 200, iou_mode_iou_weight=1.0, iou_mode_similarity_weight=1.5, euclid_mode_similarity_weight=2.0, euclid_mode_distance_weight=1.0):
+  """
+  Assigns detections to tracked object (both represented as bounding boxes)
 
-        iou_matrix[d,t] = similarityMetric * euclid_mode_similarity_weight - distMetric * euclid_mode_distance_weight
+  Returns 3 lists of matches, unmatched_detections and unmatched_trackers
+  """
+  if(len(trackers)==0):
+    return np.empty((0,2),dtype=int), np.arange(len(detections)), np.empty((0,5),dtype=int)
+  iou_matrix = compute_score_matrix(detections, trackers, mode,
+                                    feature_vector_threshold=feature_vector_threshold,
+                                    euclid_threshold=euclid_threshold,
+                                    iou_mode_iou_weight=iou_mode_iou_weight,
+                                    iou_mode_similarity_weight=iou_mode_similarity_weight,
+                                    euclid_mode_similarity_weight=euclid_mode_similarity_weight,
+                                    euclid_mode_distance_weight=euclid_mode_distance_weight)
 
   det_indices,trk_indices = linear_sum_assignment(-iou_matrix)
 
-  unmatched_detections = []
-  for d,det in enumerate(detections):
-    if(d not in det_indices):
-      unmatched_detections.append(d)
-  unmatched_trackers = []
-  for t,trk in enumerate(trackers):
-    if(t not in trk_indices):
-      unmatched_trackers.append(t)
+  matched_det_indices = set(det_indices)
+  matched_trk_indices = set(trk_indices)
+  unmatched_detections = [d for d in range(len(detections)) if d not in matched_det_indices]
+  unmatched_trackers = [t for t in range(len(trackers)) if t not in matched_trk_indices]
 
   #filter out matched with low IOU
   matches = []
@@ -266,7 +320,7 @@ class Sort(object):
       if(t not in unmatched_trks):
         d = matched[np.where(matched[:,1]==t)[0],0]
         trk.update(dets[d,:][0][:4])
-        trk.detIndex = d
+        trk.detIndex = int(d[0])
         trk.allowDeletion = dets[d,:][0][4]
 
         # Update the feature vector using an exponential rolling average. This helps smooth out any sudden poor detections which
@@ -307,6 +361,75 @@ class Sort(object):
     if(len(ret)>0):
       return np.concatenate(ret)
     return np.empty((0,5))
+
+  def propagate(self):
+    """
+    Moves every tracker forward by one frame using only its motion model. This is called instead of update on the frames
+    where the detector is skipped, so trackers are not aged out while no detections are coming in.
+    Returns a numpy array in the format [[x1,y1,x2,y2,object_id],...] for the trackers that update would report.
+    """
+    self.frame_count += 1
+    ret = []
+    for trk in self.trackers:
+      d = trk.propagate()[0]
+      if((trk.hits >= self.min_hits) and not np.any(np.isnan(d))):
+        ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1))
+    if(len(ret)>0):
+      return np.concatenate(ret)
+    return np.empty((0,5))
+
+  def to_arrays(self):
+    """
+    Packs the state of every tracker into a few contiguous numpy arrays, which can be stored or sent elsewhere without pickling.
+    Returns a dictionary with:
+      x - a [N,7] array of the Kalman filter states
+      P - a [N,7,7] array of the Kalman filter covariances
+      counters - a [N,7] integer array, with the columns in tracker_counter_fields
+      features - a [N,featureVectorSize] array of the feature vectors
+      frame_count - the number of frames processed, and next_id - the next id the tracker counter will hand out, as 1 element arrays
+    The parameters of the tracker are not included, they are given again to from_arrays.
+    """
+    features = np.zeros((len(self.trackers), self.featureVectorSize))
+    for t,trk in enumerate(self.trackers):
+      if trk.featureVector is not None:
+        features[t] = trk.featureVector
+
+    return {
+      'x': np.array([trk.kf.x.reshape(7) for trk in self.trackers], dtype=np.float64).reshape((-1,7)),
+      'P': np.array([trk.kf.P for trk in self.trackers], dtype=np.float64).reshape((-1,7,7)),
+      'counters': np.array([[trk.id, trk.time_since_update, trk.hits, trk.hit_streak, trk.age,
+                             -1 if trk.detIndex is None else trk.detIndex, bool(trk.allowDeletion)] for trk in self.trackers], dtype=np.int64).reshape((-1,len(tracker_counter_fields))),
+      'features': features,
+      'frame_count': np.array([self.frame_count], dtype=np.int64),
+      'next_id': np.array([KalmanBoxTracker.count], dtype=np.int64)
+    }
+
+  @classmethod
+  def from_arrays(cls,arrays,**kwargs):
+    """
+    Creates a tracker from the arrays made by to_arrays. The keyword arguments are the parameters for the new tracker, as given to the constructor.
+    The tracker id counter is moved past the restored ids, so new tracks never reuse them.
+    """
+    sort = cls(**kwargs)
+    sort.frame_count = int(arrays['frame_count'][0])
+
+    for x,P,counters,featureVector in zip(arrays['x'], arrays['P'], arrays['counters'], arrays['features']):
+      fields = dict(zip(tracker_counter_fields, (int(value) for value in counters)))
+
+      trk = KalmanBoxTracker(np.array([0.,0.,1.,1.]), id=fields['id'])
+      trk.kf.x = np.array(x, dtype=np.float64).reshape((7,1))
+      trk.kf.P = np.array(P, dtype=np.float64)
+      trk.time_since_update = fields['time_since_update']
+      trk.hits = fields['hits']
+      trk.hit_streak = fields['hit_streak']
+      trk.age = fields['age']
+      trk.detIndex = fields['det_index']
+      trk.allowDeletion = bool(fields['allow_deletion'])
+      trk.featureVector = np.array(featureVector, dtype=np.float64)
+      sort.trackers.append(trk)
+
+    KalmanBoxTracker.count = max([KalmanBoxTracker.count, int(arrays['next_id'][0])] + [trk.id + 1 for trk in sort.trackers])
+    return sort
     
 def parse_args():
     """Parse input arguments."""
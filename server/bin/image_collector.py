@@ -8,4 +8,8 @@ from ebretail.components.image_collector import ImageCollector
 
 collector = ImageCollector()
 
+# The cameras are split between all of the image processors given on the command line
+if len(sys.argv) > 1:
+    collector.setImageProcessors(sys.argv[1:])
+
 collector.runCollector()
@@ -19,8 +19,9 @@ import traceback
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
-    print('usage: %s\n'
-          '(example: "%s")' % (cmd, cmd))
+    print('usage: %s [--local [workers]]\n'
+          '(example: "%s --local 8")\n'
+          'Trials are evaluated through MongoTrials workers, unless --local is given to evaluate them in local processes' % (cmd, cmd))
     sys.exit(1)
 
 
@@ -73,6 +74,7 @@ def optimizeCapture(roundNumber):
     hyperParameters = dict(test.imageAnalyzer.humanHyperParameters)
 
     # Compute our baseline
+    ebretail.components.optimization.earlyStoppingLoss = None
     best = ebretail.components.optimization.computeAccuracy(hyperParameters)
 
     printResults(best, "Baseline")
@@ -97,20 +99,36 @@ def optimizeCapture(roundNumber):
 
         print("Testing fields: ", keysToOptimize)
 
+        # A trial can only be accepted if it beats the current best, so locally run trials stop as soon as they can't
+        ebretail.components.optimization.earlyStoppingLoss = best['loss']
+
         try:
             # pprint(trialSpace)
-            trials = MongoTrials('mongo://localhost:27017/ebretail_optimization/jobs', exp_key='round' + str(roundNumber) + '-exp' + str(experiment))
-            hyperopt.fmin(fn=ebretail.components.optimization.computeAccuracy,
-                        space=trialSpace,
-                        algo=hyperopt.tpe.suggest,
-                        max_evals=10+experiment, # We make the optimization sequences longer as the system moves along, since it gets harder and harder to find a good optimization
-                        trials=trials)
+            if localWorkers is not None:
+                trials = ebretail.components.optimization.parallelMinimize(fn=ebretail.components.optimization.computeAccuracy,
+                                                                           space=trialSpace,
+                                                                           algo=hyperopt.tpe.suggest,
+                                                                           maxEvals=10+experiment,
+                                                                           trials=hyperopt.Trials(),
+                                                                           workers=localWorkers)
+            else:
+                trials = MongoTrials('mongo://localhost:27017/ebretail_optimization/jobs', exp_key='round' + str(roundNumber) + '-exp' + str(experiment))
+                hyperopt.fmin(fn=ebretail.components.optimization.computeAccuracy,
+                            space=trialSpace,
+                            algo=hyperopt.tpe.suggest,
+                            max_evals=10+experiment, # We make the optimization sequences longer as the system moves along, since it gets harder and harder to find a good optimization
+                            trials=trials)
         except Exception as e:
             print("Crashed! Retrying.")
             print(traceback.format_exc())
             continue
 
-        optimizedBest = min(*trials.results, key=lambda result: result['loss'])
+        successfulResults = [result for result in trials.results if result['status'] == hyperopt.STATUS_OK]
+        if len(successfulResults) == 0:
+            print("No trials succeeded! Retrying.")
+            continue
+
+        optimizedBest = min(successfulResults, key=lambda result: result['loss'])
 
         # print("Tested:")
         # for result in trials.results:
@@ -166,8 +184,16 @@ def optimizeCapture(roundNumber):
         json.dump(best, file, indent=4)
 
 if __name__ == '__main__':
-    testFile = '/home/bricks/bricks-analytics-data/session1/capture1.json'
+    testFile = ebretail.components.optimization.testFile
+
+    localWorkers = None
+    if len(sys.argv) > 1:
+        if sys.argv[1] != '--local' or len(sys.argv) > 3:
+            usage(sys.argv)
+        localWorkers = int(sys.argv[2]) if len(sys.argv) == 3 else os.cpu_count()
 
+        # Load the detection cache once, before the trial workers are forked, so they can all share it
+        ebretail.components.optimization.loadSharedDetectionCache()
 
     round = 0
 
@@ -4,6 +4,7 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
 
+import signal
 import waitress
 from ebretail import image_processor_microservice
 from pyramid.paster import (
@@ -26,4 +27,11 @@ if __name__ == '__main__':
     setup_logging(config_uri)
     settings = get_appsettings(config_uri)
 
-    waitress.serve(image_processor_microservice(None, **settings), host='*', port=1845)
+    # Several image processors can be run on one machine, on different ports, and the image collector splits the cameras between them
+    port = int(settings.get('image_processor.port', 1845))
+
+    # Exit normally when asked to stop, so that the camera states are saved on the way out
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: sys.exit(0))
+
+    # Use enough threads that images from every camera can be waiting in the same batch
+    waitress.serve(image_processor_microservice(None, **settings), host='*', port=port, threads=16)
@@ -8,6 +8,7 @@ from ebretail.components.multi_image_analyzer import MultiImageAnalyzer
 import pymongo
 import pika
 import pika.exceptions
+from ebretail.components.metrics import startMetricsServer
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
@@ -40,6 +41,9 @@ if __name__ == '__main__':
             amqpConnection = pika.BlockingConnection(pika.ConnectionParameters(settings['amqp.uri']))
             return getMessagingChannel()
 
+    # This process isn't a web application, so its metrics are served from a small server of their own
+    startMetricsServer(int(settings.get('multi_image_analysis.metrics_port', 1807)))
+
     analyzer = MultiImageAnalyzer(db, getMessagingChannel)
     analyzer.main()
 
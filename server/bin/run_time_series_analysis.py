@@ -8,6 +8,7 @@ from ebretail.components.time_series_analyzer import TimeSeriesAnalyzer
 import pymongo
 import pika
 import pika.exceptions
+from ebretail.components.metrics import startMetricsServer
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
@@ -40,6 +41,9 @@ if __name__ == '__main__':
             amqpConnection = pika.BlockingConnection(pika.ConnectionParameters(settings['amqp.uri']))
             return getMessagingChannel()
 
+    # This process isn't a web application, so its metrics are served from a small server of their own
+    startMetricsServer(int(settings.get('time_series_analysis.metrics_port', 1808)))
+
     analyzer = TimeSeriesAnalyzer(db, getMessagingChannel)
     analyzer.main()
 
@@ -14,6 +14,7 @@ import cv2
 import time
 import datetime
 from ebretail.components.CaptureTest import CaptureTest
+from ebretail.components.person_detection import singleCameraFrameToJSON
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
@@ -29,9 +30,13 @@ if __name__ == '__main__':
 
     useCache = True
 
+    # Set above 1 to replay the cameras in parallel worker processes, rather then one at a time with live debug windows
+    replayWorkers = 1
+
     test = CaptureTest(sys.argv[1])
     
     test.loadStoreMap()
+    test.openDetectionCache()
 
     # Load calibration image
     test.loadCalibrationImage()
@@ -40,42 +45,33 @@ if __name__ == '__main__':
 
     # Either load the singleCameraFrame objects from a cache, or compute them fresh
     cacheFileName = sys.argv[1] + "-cached.json"
+    cachedSingleCameraFrames = None
     if os.path.exists(cacheFileName) and useCache:
-        resultSingleCameraFrames = json.load(open(cacheFileName, 'r'))
-        resultDebugImages = [[] for frame in range(test.testData['numberOfImages'])]
-    else:
-        # Process each of the main sequence images
-        resultSingleCameraFrames, resultDebugImages = test.createSingleCameraFrames()
-        json.dump(resultSingleCameraFrames, open(cacheFileName, 'w'), indent=4)
-
-
-    multiCameraFrames = test.createMultiCameraFrames(resultSingleCameraFrames)
-
-    cv2.waitKey(50)
-
-    # Now we process all the multi camera frames through a time-series analysis
-    timeSeriesFrames, visitSummaries = test.runTimeSeriesAnalysis(multiCameraFrames)
+        cachedSingleCameraFrames = json.load(open(cacheFileName, 'r'))
 
-    storeMapDebugImages = test.drawStoreMapResults(multiCameraFrames, timeSeriesFrames)
-    for frameIndex in range(len(multiCameraFrames)):
-        resultDebugImages[frameIndex].append(storeMapDebugImages[frameIndex])
-
-    score = test.measureAccuracy(timeSeriesFrames)
-    for i in range(3):
-        print('=' * 30)
-    print ('Score', score)
-    for i in range(3):
-        print('=' * 30)
-
-    for i in range(test.testData['numberOfImages']):
-        debugImages = resultDebugImages[i]
+    # Each frame is run through the whole pipeline and shown before moving onto the next one, so
+    # nothing but the small result objects are kept around
+    allSingleCameraFrames = []
+    timeSeriesFrames = []
+    for frame in test.replayFrames(workers=replayWorkers, keepDebugImages=True, allSingleCameraFrames=cachedSingleCameraFrames):
+        allSingleCameraFrames.append([singleCameraFrameToJSON(singleCameraFrame) for singleCameraFrame in frame['singleCameraFrames']])
+        timeSeriesFrames.append(frame['timeSeriesFrame'])
 
+        debugImages = frame['debugImages']
         for imageIndex, debugImage in enumerate(debugImages):
             if imageIndex < (len(debugImages)-1):
                 frameName = test.testData['cameras'][imageIndex]['name']
             else:
                 frameName = 'Store Map (Individual Frames)'
             cv2.imshow(frameName, debugImage)
-        cv2.waitKey(2000)
+        cv2.waitKey(50)
 
+    if cachedSingleCameraFrames is None:
+        json.dump(allSingleCameraFrames, open(cacheFileName, 'w'), indent=4)
 
+    score = test.measureAccuracy(timeSeriesFrames)
+    for i in range(3):
+        print('=' * 30)
+    print ('Score', score)
+    for i in range(3):
+        print('=' * 30)
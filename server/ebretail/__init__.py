@@ -30,6 +30,7 @@ def main_api(global_config, **settings):
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('collect_images', '/collect_images')
     config.add_route('register_collector', '/register_collector')
+    config.add_route('metrics', '/metrics')
 
 
     config.add_route('home', '/')
@@ -53,6 +54,10 @@ def image_processor_microservice(global_config, **settings):
     config.add_renderer('bson', 'ebretail.components.bson_renderer.BSONRenderer')
 
     config.add_route('process_image', '/process_image')
+    config.add_route('camera_state', '/camera_state')
+    config.add_route('forwarding_status', '/forwarding_status')
+    config.add_route('motion_gate_status', '/motion_gate_status')
+    config.add_route('metrics', '/metrics')
     config.scan('ebretail.processor_endpoints')
     return config.make_wsgi_app()
 
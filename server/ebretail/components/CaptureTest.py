@@ -7,6 +7,10 @@ import json
 
 from pprint import pprint
 from ebretail.components.image_analyzer import ImageAnalyzer
+from ebretail.components.frame_store import FrameStore
+from ebretail.components.accuracy_scorer import AccuracyScorer
+from ebretail.components.detection_cache import DetectionCache
+from ebretail.components.frame_encoding import encodeCameraImage
 from PIL import Image
 import numpy
 import cv2
@@ -16,9 +20,9 @@ import requests
 import pika
 import threading
 import io
-import scipy.optimize
-import scipy.spatial
 import pickle
+import multiprocessing
+import concurrent.futures
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
@@ -27,6 +31,53 @@ def usage(argv):
     sys.exit(1)
 
 
+# Each worker process used for parallel replay has its own image analyzer
+replayImageAnalyzer = None
+
+
+def initializeReplayWorker(hyperParameters, validationEnabled, detectionCache):
+    global replayImageAnalyzer
+    replayImageAnalyzer = ImageAnalyzer()
+    replayImageAnalyzer.setHyperParameters(hyperParameters)
+    replayImageAnalyzer.detectionCache = detectionCache
+    if not validationEnabled:
+        replayImageAnalyzer.disableValidation()
+
+
+def replayCameraSequence(cameraId, frameStoreDirectory, cameraIndex, timestamps, keepDebugImages=True):
+    """
+        Processes the full sequence of images from one camera, inside of a replay worker process.
+
+        :param cameraId: The id of the camera
+        :param frameStoreDirectory: The directory of the captures FrameStore. The worker maps the images itself, rather then having them sent over
+        :param cameraIndex: The index of this camera within the FrameStore
+        :param timestamps: The timestamp for each frame
+        :param keepDebugImages: Whether to draw and return a debug image for each frame
+        :return: (singleCameraFrames, debugImages)
+    """
+    cameraImages = FrameStore(frameStoreDirectory).getCameraSequence(cameraIndex)
+
+    state = {}
+    singleCameraFrames = []
+    debugImages = []
+    for frameIndex, (cameraImage, timestamp) in enumerate(zip(cameraImages, timestamps)):
+        debugImage = cameraImage.copy() if keepDebugImages else None
+
+        metadata = {
+            'storeId': 1,
+            'cameraId': cameraId,
+            'timestamp': timestamp
+        }
+
+        singleCameraFrame, state, personImages = replayImageAnalyzer.processSingleCameraImage(cameraImage, metadata, state, debugImage)
+
+        singleCameraFrames.append(singleCameraFrame)
+        if keepDebugImages:
+            debugImages.append(debugImage)
+
+    return singleCameraFrames, debugImages
+
+
 class CaptureTest:
     """ This class represents the combined state of a capture test."""
 
@@ -118,32 +169,52 @@ class CaptureTest:
 
         self.storeMap = storeMapImageArray
 
-    def loadCalibrationImage(self):
-        calibrationCacheFile = os.path.join(os.path.dirname(self.fileName), os.path.basename(self.fileName).split('.')[0] + '-calibration.pickle')
+    def frameStoreDirectory(self, name):
+        """ Returns the directory for one of the FrameStores kept next to the capture file."""
+        return os.path.join(os.path.dirname(self.fileName), os.path.basename(self.fileName).split('.')[0] + '-' + name)
 
-        if os.path.exists(calibrationCacheFile):
-            data = pickle.load(open(calibrationCacheFile, 'rb'))
+    def loadCalibrationImage(self):
+        calibrationStoreDirectory = self.frameStoreDirectory('calibration')
 
-            self.calibrationImages = data['calibrationImages']
-            self.annotationWidthAdjust = data['annotationWidthAdjust']
-            self.annotationHeightAdjust = data['annotationHeightAdjust']
-        else:
+        if not FrameStore.exists(calibrationStoreDirectory):
             # Load calibration image
             calibrationImagePath = os.path.join(os.path.dirname(self.fileName), self.testData['directory'], 'calibration.jpg')
             fullCalibrationImage = Image.open(calibrationImagePath)
-            self.calibrationImages = self.breakApartImage(fullCalibrationImage, self.testData['cameras'])
 
-            self.annotationWidthAdjust = fullCalibrationImage.width / self.annotations['frames']["0"][0]["width"]
-            self.annotationHeightAdjust = (fullCalibrationImage.height + self.testData['storeMap']['height']) / \
+            metadata = {
+                "annotationWidthAdjust": fullCalibrationImage.width / self.annotations['frames']["0"][0]["width"],
+                "annotationHeightAdjust": (fullCalibrationImage.height + self.testData['storeMap']['height']) / \
                                           self.annotations['frames']["0"][0]["height"]
-
-            data = {
-                "calibrationImages": self.calibrationImages,
-                "annotationWidthAdjust": self.annotationWidthAdjust,
-                "annotationHeightAdjust": self.annotationHeightAdjust
             }
 
-            pickle.dump(data, open(calibrationCacheFile, 'wb'))
+            FrameStore.create(calibrationStoreDirectory, 1, lambda frameIndex: self.breakApartImage(fullCalibrationImage, self.testData['cameras']), metadata)
+
+        calibrationStore = FrameStore(calibrationStoreDirectory)
+
+        self.calibrationImages = calibrationStore.getFrame(0)
+        self.annotationWidthAdjust = calibrationStore.metadata['annotationWidthAdjust']
+        self.annotationHeightAdjust = calibrationStore.metadata['annotationHeightAdjust']
+
+    def loadFrameStore(self):
+        """
+            Returns the FrameStore holding the camera images for every frame in the capture. The first time this is
+            called for a capture, the JPEG images are decoded and written into the store one frame at a time.
+        """
+        frameStoreDirectory = self.frameStoreDirectory('frames')
+
+        if not FrameStore.exists(frameStoreDirectory):
+            def loadFrame(i):
+                imagePath = os.path.join(os.path.dirname(self.fileName), self.testData['directory'],
+                                         'image-' + str(i).zfill(5) + '.jpg')
+
+                captureFullImage = Image.open(imagePath)
+
+                # Break it apart into separate images for each camera
+                return self.breakApartImage(captureFullImage, self.testData['cameras'])
+
+            FrameStore.create(frameStoreDirectory, self.testData['numberOfImages'], loadFrame)
+
+        return FrameStore(frameStoreDirectory)
 
     def createCameraConfigurations(self, showDebug=False):
         # Detect the calibration object for each camera, and generate its configuration object
@@ -235,34 +306,48 @@ class CaptureTest:
         cv2.imshow('store-map-test', debugMap)
         cv2.waitKey(2000)
 
-    def createSingleCameraFrames(self):
-        states = {}
-        for camera in self.testData['cameras']:
-            states[camera['name']] = {}
+    def createSingleCameraFrames(self, workers=1, keepDebugImages=True):
+        """
+            Runs every camera image in the capture through the image analyzer.
 
-        imageCacheFile = os.path.join(os.path.dirname(self.fileName), os.path.basename(self.fileName).split('.')[0] + '-images.pickle')
+            :param workers: When above 1, each cameras image sequence is processed in its own worker process, up to this many at a time
+            :param keepDebugImages: Whether to keep a debug image for every camera image. When False, the lists of debug images are empty
+            :return: (resultSingleCameraFrames, resultDebugImages), each a list with one entry per camera for every frame
+        """
+        resultDebugImages = []
+        resultSingleCameraFrames = []
+        for singleCameraFrames, debugImages in self.iterateSingleCameraFrames(workers, keepDebugImages):
+            resultSingleCameraFrames.append(singleCameraFrames)
+            resultDebugImages.append(debugImages)
+        return resultSingleCameraFrames, resultDebugImages
 
-        if os.path.exists(imageCacheFile):
-            cameraFrameImages = pickle.load(open(imageCacheFile, 'rb'))
-        else:
-            cameraFrameImages = []
-            for i in range(self.testData['numberOfImages']):
-                imagePath = os.path.join(os.path.dirname(self.fileName), self.testData['directory'],
-                                         'image-' + str(i).zfill(5) + '.jpg')
+    def iterateSingleCameraFrames(self, workers=1, keepDebugImages=False):
+        """
+            The streaming version of createSingleCameraFrames. This is a generator which processes the capture one
+            frame at a time, so only the images for the current frame are held in memory.
 
-                captureFullImage = Image.open(imagePath)
+            :param workers: When above 1, each cameras image sequence is processed in its own worker process, up to this many at a time
+            :param keepDebugImages: Whether to draw a debug image for every camera image. When False, the list of debug images is empty
+            :return: A generator of (singleCameraFrames, debugImages) tuples, one for each frame
+        """
+        frameStore = self.loadFrameStore()
 
-                # Break it apart into separate images for each camera
-                cameraImages = self.breakApartImage(captureFullImage, self.testData['cameras'])
+        if workers > 1:
+            # The workers process whole camera sequences, so the results only come back once they are all done.
+            # Without the debug images, those results are small.
+            resultSingleCameraFrames, resultDebugImages = self.createSingleCameraFramesParallel(frameStore, workers, keepDebugImages)
+            yield from zip(resultSingleCameraFrames, resultDebugImages)
+            return
 
-                cameraFrameImages.append(cameraImages)
-            pickle.dump(cameraFrameImages, open(imageCacheFile, 'wb'))
+        showDebugImages = 'test_capture' in sys.argv[0]
+
+        states = {}
+        for camera in self.testData['cameras']:
+            states[camera['name']] = {}
 
         # Process each of the main sequence images
-        resultDebugImages = []
-        resultSingleCameraFrames = []
         for i in range(self.testData['numberOfImages']):
-            cameraImages = cameraFrameImages[i]
+            cameraImages = frameStore.getFrame(i)
 
             debugImages = []
 
@@ -279,7 +364,9 @@ class CaptureTest:
                 currentState = states[camera['name']]
 
                 # Copy for the debug image
-                debugImage = cameraImage.copy()
+                debugImage = None
+                if keepDebugImages or showDebugImages:
+                    debugImage = cameraImage.copy()
 
                 metadata = {
                     'storeId': 1,
@@ -287,8 +374,6 @@ class CaptureTest:
                     'timestamp': (now + datetime.timedelta(seconds=0.5)).strftime("%Y-%m-%dT%H:%M:%S.%f"),
                 }
 
-                metadata['cacheId'] = str(metadata['cameraId']) + "-" + str(i)
-
                 # Use the image analyzer to produce the SingleCameraFrame object for this camera image.
                 # This first step mostly just detects people and detects the calibration object.
                 singleCameraFrame, newState, personImages = self.imageAnalyzer.processSingleCameraImage(cameraImage,
@@ -300,14 +385,47 @@ class CaptureTest:
 
                 singleCameraFrames.append(singleCameraFrame)
 
-                if 'test_capture' in sys.argv[0]:
+                if showDebugImages:
                     cv2.imshow(camera['name'], debugImage)
                     cv2.waitKey(1)
 
-                debugImages.append(debugImage)
+                if keepDebugImages:
+                    debugImages.append(debugImage)
+
+            yield singleCameraFrames, debugImages
+
+    def createSingleCameraFramesParallel(self, frameStore, workers, keepDebugImages=True):
+        """
+            The parallel version of createSingleCameraFrames. The tracking state of each camera is independent, so each
+            cameras sequence of images is processed by a pool of worker processes, and the results are put back in frame order.
+            The workers each open the FrameStore themselves, so the images are shared through the page cache rather then copied.
+            Likewise they each open the database of the detection cache, so new detections are only shared if it has a file.
+        """
+        numberOfImages = self.testData['numberOfImages']
+
+        # Frames are spaced half a second apart, the same as the live image collector
+        start = datetime.datetime.now()
+        timestamps = [(start + datetime.timedelta(seconds=0.5 * (i + 1))).strftime("%Y-%m-%dT%H:%M:%S.%f") for i in range(numberOfImages)]
+
+        # Spawn rather then fork, so the workers don't inherit any tensorflow sessions from this process
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=initializeReplayWorker,
+                                                    initargs=(self.imageAnalyzer.hyperParameters, self.imageAnalyzer.validationEnabled, self.imageAnalyzer.detectionCache)) as executor:
+            futures = []
+            for cameraIndex, camera in enumerate(self.testData['cameras']):
+                cameraId = self.cameraId(cameraIndex)
+
+                futures.append(executor.submit(replayCameraSequence, cameraId, frameStore.directory, cameraIndex, timestamps, keepDebugImages))
+
+            cameraResults = [future.result() for future in futures]
+
+        resultSingleCameraFrames = []
+        resultDebugImages = []
+        for i in range(numberOfImages):
+            resultSingleCameraFrames.append([singleCameraFrames[i] for singleCameraFrames, debugImages in cameraResults])
+            resultDebugImages.append([debugImages[i] for singleCameraFrames, debugImages in cameraResults if keepDebugImages])
 
-            resultSingleCameraFrames.append(singleCameraFrames)
-            resultDebugImages.append(debugImages)
         return resultSingleCameraFrames, resultDebugImages
 
     def getStoreConfiguration(self):
@@ -370,39 +488,87 @@ class CaptureTest:
             currentState = state
         return timeSeriesFrames, visitSummaries
 
+    def iterateTimeSeriesFrames(self, multiCameraFrames):
+        """ The streaming version of runTimeSeriesAnalysis. This is a generator of the TimeSeriesFrame objects, yielding each one as soon as it is produced."""
+        storeConfiguration = self.getStoreConfiguration()
+
+        currentState = {}
+        for multiCameraFrame in multiCameraFrames:
+            timeSeriesFrame, currentState = self.imageAnalyzer.processMultiCameraFrameTimeSeries(multiCameraFrame,
+                                                                                                 currentState,
+                                                                                                 storeConfiguration)
+            yield timeSeriesFrame
+
     def drawStoreMapResults(self, multiCameraFrames, timeSeriesFrames):
         storeMapImages = []
 
         for frameIndex in range(len(multiCameraFrames)):
-            multiCameraFrame = multiCameraFrames[frameIndex]
-            timeSeriesFrame = timeSeriesFrames[frameIndex]
-
-            groundTruthPoints = [{
-                "x": (annotation['x1'] / 2 + annotation['x2'] / 2) * self.annotationWidthAdjust -
-                     self.testData['storeMap'][
-                         'x'],
-                "y": (annotation['y1'] / 2 + annotation['y2'] / 2) * self.annotationHeightAdjust -
-                     self.testData['storeMap'][
-                         'y'],
-                "id": annotation['tags'][0],
-                "color": (255, 0, 0)
-            } for annotation in self.annotations['frames'][str(frameIndex + 1)]]
-
-            multiCameraFramePeople = [dict(person) for person in multiCameraFrame['people']]
-            timeSeriesPeople = [dict(person) for person in timeSeriesFrame['people']]
-
-            for person in timeSeriesPeople:
-                person['color'] = (0, 255, 0)
-                person['x'] = person['x'] * self.testData['storeMap']['width']
-                person['y'] = person['y'] * self.testData['storeMap']['height']
-            for person in multiCameraFramePeople:
-                person['color'] = (0, 0, 255)
-
-            storeMapImages.append(
-                self.drawDebugStoreMap(multiCameraFramePeople + timeSeriesPeople + groundTruthPoints,
-                                       boxSize=100))
+            storeMapImages.append(self.drawStoreMapFrame(frameIndex, multiCameraFrames[frameIndex], timeSeriesFrames[frameIndex]))
         return storeMapImages
 
+    def drawStoreMapFrame(self, frameIndex, multiCameraFrame, timeSeriesFrame):
+        groundTruthPoints = [{
+            "x": (annotation['x1'] / 2 + annotation['x2'] / 2) * self.annotationWidthAdjust -
+                 self.testData['storeMap'][
+                     'x'],
+            "y": (annotation['y1'] / 2 + annotation['y2'] / 2) * self.annotationHeightAdjust -
+                 self.testData['storeMap'][
+                     'y'],
+            "id": annotation['tags'][0],
+            "color": (255, 0, 0)
+        } for annotation in self.annotations['frames'][str(frameIndex + 1)]]
+
+        multiCameraFramePeople = [dict(person) for person in multiCameraFrame['people']]
+        timeSeriesPeople = [dict(person) for person in timeSeriesFrame['people']]
+
+        for person in timeSeriesPeople:
+            person['color'] = (0, 255, 0)
+            person['x'] = person['x'] * self.testData['storeMap']['width']
+            person['y'] = person['y'] * self.testData['storeMap']['height']
+        for person in multiCameraFramePeople:
+            person['color'] = (0, 0, 255)
+
+        return self.drawDebugStoreMap(multiCameraFramePeople + timeSeriesPeople + groundTruthPoints, boxSize=100)
+
+    def replayFrames(self, workers=1, keepDebugImages=False, allSingleCameraFrames=None):
+        """
+            Streams the capture through the whole pipeline one frame at a time - single camera analysis, then multi camera
+            fusion, then time series tracking. Nothing is kept between frames except the tracking state, so memory use
+            doesn't grow with the length of the capture.
+
+            :param workers: Passed on to iterateSingleCameraFrames
+            :param keepDebugImages: Whether to produce debug images for each camera, along with the store map debug image
+            :param allSingleCameraFrames: Previously computed SingleCameraFrame objects for each frame, to use instead of processing the images
+            :return: A generator of dictionaries, one for each frame, with frameIndex, singleCameraFrames, multiCameraFrame,
+                     timeSeriesFrame and debugImages. The store map is the last of the debug images.
+        """
+        if allSingleCameraFrames is None:
+            singleCameraFrameStream = self.iterateSingleCameraFrames(workers, keepDebugImages)
+        else:
+            singleCameraFrameStream = ((singleCameraFrames, []) for singleCameraFrames in allSingleCameraFrames)
+
+        storeConfiguration = self.getStoreConfiguration()
+
+        timeSeriesState = {}
+        for frameIndex, (singleCameraFrames, debugImages) in enumerate(singleCameraFrameStream):
+            multiCameraFrame = self.imageAnalyzer.processMultipleCameraFrames(singleCameraFrames,
+                                                                              self.singleCameraConfigurations)
+
+            timeSeriesFrame, timeSeriesState = self.imageAnalyzer.processMultiCameraFrameTimeSeries(multiCameraFrame,
+                                                                                                    timeSeriesState,
+                                                                                                    storeConfiguration)
+
+            if keepDebugImages:
+                debugImages = debugImages + [self.drawStoreMapFrame(frameIndex, multiCameraFrame, timeSeriesFrame)]
+
+            yield {
+                "frameIndex": frameIndex,
+                "singleCameraFrames": singleCameraFrames,
+                "multiCameraFrame": multiCameraFrame,
+                "timeSeriesFrame": timeSeriesFrame,
+                "debugImages": debugImages
+            }
+
     def startAmqp(self):
         self.amqpThread.start()
 
@@ -467,10 +633,7 @@ class CaptureTest:
 
     def uploadImageToProcessor(self, image, timeStamp, cameraIndex):
         try:
-            image = Image.fromarray(image, mode=None)
-            b = io.BytesIO()
-            image.save(b, "JPEG", quality=80)
-            b.seek(0)
+            b = encodeCameraImage(image)
             metadata = {
                 "storeId": self.storeId,
                 "cameraId": self.cameraId(cameraIndex),
@@ -541,158 +704,53 @@ class CaptureTest:
             timeStamp = timeStamp + datetime.timedelta(seconds=0.5)
 
 
-    def measureAccuracy(self, timeSeriesFrames):
-        score = 0
-
-        allTags = set()
-        personTags = {}
-
-        allAnnotations = json.loads(json.dumps(self.annotations))
+    def createAccuracyScorer(self, totalFrames=None):
+        """ Creates an AccuracyScorer for measuring TimeSeriesFrame objects against the annotations of this capture."""
+        return AccuracyScorer(self.annotations['frames'], self.annotationWidthAdjust, self.annotationHeightAdjust,
+                              self.testData['storeMap'], totalFrames)
 
-        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
-            people = timeSeriesFrame['people']
-            annotations = allAnnotations['frames'][str(frameIndex + 1)]
-            for annotation in annotations:
-                tag = annotation['tags'][0]
-                allTags.add(tag)
-
-            for person in people:
-                # Now associate this time series frame to this assignment
-                person['annotation'] = None
-                person['groundTruth'] = None
-                personTags[person['visitorId']] = {}
+    def measureAccuracy(self, timeSeriesFrames):
+        scorer = self.createAccuracyScorer(len(timeSeriesFrames))
 
         for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
-            matrix = []
-
-            people = timeSeriesFrame['people']
-            annotations = allAnnotations['frames'][str(frameIndex + 1)]
-
-            # Create a cost matrix to perform linear assignment between detections and ground truth data
-            for person in people:
-                distances = []
-
-                for annotation in annotations:
-                    annotationPoint = [
-                        (annotation['x1'] / 2 + annotation['x2'] / 2) * self.annotationWidthAdjust -
-                        self.testData['storeMap']['x'],
-                        (annotation['y1'] / 2 + annotation['y2'] / 2) * self.annotationHeightAdjust -
-                        self.testData['storeMap']['y'],
-                    ]
-
-                    personPoint = [
-                        person['x'] * self.testData['storeMap']['width'],
-                        person['y'] * self.testData['storeMap']['height']
-                    ]
-
-                    distance = scipy.spatial.distance.euclidean(annotationPoint, personPoint)
-
-                    distances.append(distance)
-
-                # Compute distance between this person and each of the ground truth points
-                matrix.append(distances)
-
-            if len(matrix) == 0:
-                assignments = [[], []]
-            else:
-                assignments = scipy.optimize.linear_sum_assignment(numpy.array(matrix))
-
-            for assignmentIndex in range(len(assignments[0])):
-                personIndex = assignments[0][assignmentIndex]
-                annotationIndex = assignments[1][assignmentIndex]
-
-                person = people[personIndex]
-                annotation = annotations[annotationIndex]
-                tag = annotation['tags'][0]
-
-                if person['visitorId'] in personTags:
-                    if tag in personTags[person['visitorId']]:
-                        personTags[person['visitorId']][tag] += 1
-                    else:
-                        personTags[person['visitorId']][tag] = 1
-                else:
-                    personTags[person['visitorId']] = {tag: 1}
-
-                # Now associate this time series frame to this assignment
-                person['annotation'] = annotation
-                person['groundTruth'] = tag
-                person['groundTruthDistance'] = matrix[personIndex][annotationIndex]
-
-        # Now having processed all of the frames, we only find the dominant ground truth track that each visitorId
-        # was associated with. We eliminate the others, since a track can only be for one person
-        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
-            people = timeSeriesFrame['people']
-            annotations = allAnnotations['frames'][str(frameIndex + 1)]
-            for person in people:
-                if person['visitorId'] in personTags and len(personTags[person['visitorId']]) > 0:
-                    # Determine the dominant ground truth for this person
-                    bestScore = None
-                    bestGroundTruth = None
-                    for tag in personTags[person['visitorId']].keys():
-                        if bestScore is None or personTags[person['visitorId']][tag] > bestScore:
-                            bestScore = personTags[person['visitorId']][tag]
-                            bestGroundTruth = tag
-                else:
-                    bestGroundTruth = None
-
-                if person['groundTruth'] != bestGroundTruth:
-                    person['groundTruth'] = None
-                elif person['groundTruth'] is not None:
-                    person['annotation']['visitorId'] = person['visitorId']
-
-        # Now we add up all the distances as score, and all the extras as punishment
-        falsePositiveCostEach = 5000
-        falseNegativeCostEach = 5000
-        falsePositiveCostTotal = 0
-        falseNegativeCostTotal = 0
-        distanceCostMax = 1000
-        distanceCostTotal = 0
-        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
-            people = timeSeriesFrame['people']
-            annotations = allAnnotations['frames'][str(frameIndex + 1)]
-            frameCost = 0
-            for person in people:
-                if person['groundTruth'] is None:
-                    # Punishment - this person should have had ground truth associated with them
-                    score += falsePositiveCostEach
-                    falsePositiveCostTotal += falsePositiveCostEach
-                    frameCost + falsePositiveCostEach
-                else:
-                    score += min(distanceCostMax, person['groundTruthDistance'])
-                    distanceCostTotal += min(distanceCostMax, person['groundTruthDistance'])
-                    frameCost += min(distanceCostMax, person['groundTruthDistance'])
-            for annotation in annotations:
-                if 'visitorId' not in annotation or annotation['visitorId'] is None:
-                    # Punishment - this ground truth should have had a track associated with it
-                    score += falseNegativeCostEach
-                    falseNegativeCostTotal += falseNegativeCostEach
-                    frameCost += falseNegativeCostEach
-
-                    # Lastly, punish every detected person over and above the number of known tags
-        extraTracksCostTotal = max(0, len(personTags) - len(allTags)) * falseNegativeCostEach
-        score += extraTracksCostTotal
-
-        details = {
-            "totalCost": score / len(timeSeriesFrames),
-            "falsePositiveCost": falsePositiveCostTotal / len(timeSeriesFrames),
-            "falseNegativeCostTotal": falseNegativeCostTotal / len(timeSeriesFrames),
-            "distanceCostTotal": distanceCostTotal / len(timeSeriesFrames),
-            "extraTracksCostTotal": extraTracksCostTotal / len(timeSeriesFrames),
-        }
+            scorer.addFrame(frameIndex, timeSeriesFrame)
 
-        # Average for each frame
-        score = score / len(timeSeriesFrames)
-
-        return score, details
+        return scorer.computeScore()
 
     def setHyperParameters(self, hyperParameters):
         # Set the hyper parameters on the image analyzer
         self.imageAnalyzer.setHyperParameters(hyperParameters)
 
-    def reloadDetectionCache(self, cacheFile):
-        if os.path.exists(cacheFile):
-            self.imageAnalyzer.detectionCache = pickle.load(open(cacheFile, 'rb'))
+    def openDetectionCache(self):
+        """
+            Sets the image analyzer to use the persistent detection cache for this capture, which is stored next to the
+            capture file. The first time, any detections from the old pickled cache are copied into it.
+
+            :return: The DetectionCache
+        """
+        cacheFile = self.fileName + "-detections.sqlite"
+
+        detectionCache = self.imageAnalyzer.detectionCache
+        if detectionCache is None or detectionCache.fileName != cacheFile:
+            importPickledCache = not os.path.exists(cacheFile)
+
+            detectionCache = DetectionCache(cacheFile)
+            self.imageAnalyzer.detectionCache = detectionCache
+
+            pickledCacheFile = self.fileName + "-cached.pickle"
+            if importPickledCache and os.path.exists(pickledCacheFile):
+                self.importPickledDetectionCache(pickledCacheFile)
+
+        return detectionCache
+
+    def importPickledDetectionCache(self, pickledCacheFile):
+        """ Copies the person detections from an old pickled detection cache, which was keyed by cameraId and frame index, into the current one."""
+        frameStore = self.loadFrameStore()
+
+        pickledCache = pickle.load(open(pickledCacheFile, 'rb'))
+        for cacheId, detections in pickledCache['people'].items():
+            cameraId, frameIndex = cacheId.rsplit('-', 1)
+            cameraIndex = int(cameraId.rsplit('-', 1)[1])
 
-    def saveDetectionCache(self, cacheFile):
-        if not os.path.exists(cacheFile):
-            pickle.dump(self.imageAnalyzer.detectionCache, open(cacheFile, 'wb'))
+            image = frameStore.getFrame(int(frameIndex))[cameraIndex]
+            self.imageAnalyzer.detectionCache.put('people', self.imageAnalyzer.computeCacheId(image), detections)
@@ -0,0 +1,149 @@
+import numpy
+import scipy.optimize
+import scipy.spatial
+
+
+class AccuracyScorer:
+    """
+        This class measures how closely the TimeSeriesFrame objects produced for a capture test follow its annotated ground truth.
+
+        Frames are added one at a time as they come out of the pipeline, and only running counts are kept - for each
+        visitorId, the number of times it was matched to each ground truth tag, and the total distance of those matches.
+        The final loss can only be computed at the end, since a match only counts if it is for the tag that visitorId
+        was matched to most often. But a lower bound on the loss is known the whole way through, so a hyperopt trial
+        can be stopped as soon as it can no longer beat the best loss found so far.
+    """
+
+    falsePositiveCostEach = 5000
+    falseNegativeCostEach = 5000
+    distanceCostMax = 1000
+
+    def __init__(self, annotationFrames, annotationWidthAdjust, annotationHeightAdjust, storeMap, totalFrames=None):
+        """
+            :param annotationFrames: The frames section of the annotations, mapping each frame number (starting from 1) to the annotations for that frame
+            :param annotationWidthAdjust: The scale from annotation coordinates to capture image coordinates, horizontally
+            :param annotationHeightAdjust: The scale from annotation coordinates to capture image coordinates, vertically
+            :param storeMap: The storeMap section of the test data, giving the position and size of the store map in the capture image
+            :param totalFrames: The number of frames which will be added in total. This is needed for computeLowerBound
+        """
+        self.annotationFrames = annotationFrames
+        self.annotationWidthAdjust = annotationWidthAdjust
+        self.annotationHeightAdjust = annotationHeightAdjust
+        self.storeMap = storeMap
+        self.totalFrames = totalFrames
+
+        self.frameCount = 0
+        self.allTags = set()
+
+        # For each visitorId, maps each ground truth tag it was matched to onto [matches, total capped distance]
+        self.visitorTags = {}
+
+        self.unmatchedPeople = 0
+        self.unmatchedAnnotations = 0
+
+    def addFrame(self, frameIndex, timeSeriesFrame):
+        """
+            Matches the people in the given TimeSeriesFrame to the ground truth for that frame, and adds the results to the running counts.
+
+            :param frameIndex: The index of the frame within the capture, starting from 0
+            :param timeSeriesFrame: The TimeSeriesFrame object. It isn't modified.
+        """
+        annotations = self.annotationFrames[str(frameIndex + 1)]
+        people = timeSeriesFrame['people']
+
+        self.frameCount += 1
+
+        for annotation in annotations:
+            self.allTags.add(annotation['tags'][0])
+
+        for person in people:
+            self.visitorTags.setdefault(person['visitorId'], {})
+
+        if len(people) == 0:
+            self.unmatchedAnnotations += len(annotations)
+            return
+
+        annotationPoints = numpy.array([[
+            (annotation['x1'] / 2 + annotation['x2'] / 2) * self.annotationWidthAdjust - self.storeMap['x'],
+            (annotation['y1'] / 2 + annotation['y2'] / 2) * self.annotationHeightAdjust - self.storeMap['y']
+        ] for annotation in annotations]).reshape(-1, 2)
+
+        personPoints = numpy.array([[
+            person['x'] * self.storeMap['width'],
+            person['y'] * self.storeMap['height']
+        ] for person in people])
+
+        # Perform linear assignment between the detections and the ground truth, based on distance
+        distances = scipy.spatial.distance.cdist(personPoints, annotationPoints)
+        personIndexes, annotationIndexes = scipy.optimize.linear_sum_assignment(distances)
+
+        self.unmatchedPeople += len(people) - len(personIndexes)
+        self.unmatchedAnnotations += len(annotations) - len(annotationIndexes)
+
+        for personIndex, annotationIndex in zip(personIndexes, annotationIndexes):
+            tags = self.visitorTags[people[personIndex]['visitorId']]
+            tag = annotations[annotationIndex]['tags'][0]
+
+            if tag not in tags:
+                tags[tag] = [0, 0.0]
+            tags[tag][0] += 1
+            tags[tag][1] += min(self.distanceCostMax, distances[personIndex, annotationIndex])
+
+    def computeScore(self):
+        """
+            Computes the loss over all of the frames added so far, averaged for each frame.
+
+            :return: (score, details)
+        """
+        falsePositives = self.unmatchedPeople
+        falseNegatives = self.unmatchedAnnotations
+        distanceCostTotal = 0
+
+        # A track can only be for one person, so each visitorId only keeps the matches for the ground truth tag it
+        # was matched to most often. Each of its other matches leaves both a false positive and a false negative
+        for tags in self.visitorTags.values():
+            if len(tags) == 0:
+                continue
+
+            dominantTag = max(tags, key=lambda tag: tags[tag][0])
+            for tag, (matches, distance) in tags.items():
+                if tag == dominantTag:
+                    distanceCostTotal += distance
+                else:
+                    falsePositives += matches
+                    falseNegatives += matches
+
+        falsePositiveCostTotal = falsePositives * self.falsePositiveCostEach
+        falseNegativeCostTotal = falseNegatives * self.falseNegativeCostEach
+
+        # Lastly, punish every detected person over and above the number of known tags
+        extraTracksCostTotal = max(0, len(self.visitorTags) - len(self.allTags)) * self.falseNegativeCostEach
+
+        score = falsePositiveCostTotal + falseNegativeCostTotal + distanceCostTotal + extraTracksCostTotal
+
+        details = {
+            "totalCost": score / self.frameCount,
+            "falsePositiveCost": falsePositiveCostTotal / self.frameCount,
+            "falseNegativeCostTotal": falseNegativeCostTotal / self.frameCount,
+            "distanceCostTotal": distanceCostTotal / self.frameCount,
+            "extraTracksCostTotal": extraTracksCostTotal / self.frameCount,
+        }
+
+        return score / self.frameCount, details
+
+    def computeLowerBound(self):
+        """
+            Returns the lowest loss that is still possible once all totalFrames frames have been added. Every unmatched
+            person and annotation is certain to be counted, and every match costs at least its own distance.
+        """
+        matchedDistance = sum(distance for tags in self.visitorTags.values() for matches, distance in tags.values())
+
+        cost = self.unmatchedPeople * self.falsePositiveCostEach + \
+               self.unmatchedAnnotations * self.falseNegativeCostEach + \
+               matchedDistance
+
+        return cost / self.totalFrames
+
+    def shouldStop(self, bestLoss):
+        """ Returns True if the final loss is certain to be worse then bestLoss. Always False if bestLoss is None."""
+        return bestLoss is not None and self.computeLowerBound() > bestLoss
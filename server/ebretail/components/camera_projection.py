@@ -0,0 +1,71 @@
+import numpy as np
+import scipy.linalg
+import cv2
+
+
+class CameraProjection:
+    """
+        This class projects points on a cameras image back onto the store map, at a given height above the ground.
+
+        The rotation, translation and intrinsics of a camera only change when it is recalibrated, so the matrix
+        inversions are done once when the projection is created, and each call to project only needs a couple of
+        small matrix products for all of the points at once.
+    """
+
+    def __init__(self, rotationVector, translationVector, cameraMatrix, calibrationReference, calibrationPointSize):
+        rotationMatrix = cv2.Rodrigues(np.array(rotationVector, dtype=np.float64))[0]
+
+        self.inverseRotationMatrix = scipy.linalg.inv(rotationMatrix)
+        self.inverseCameraMatrix = scipy.linalg.inv(np.array(cameraMatrix, dtype=np.float64))
+
+        # Maps a point on the screen onto the direction of its ray in calibration object coordinates
+        self.rayMatrix = np.matmul(self.inverseRotationMatrix, self.inverseCameraMatrix)
+
+        # The location of the camera in calibration object coordinates, negated
+        self.rotatedTranslation = np.matmul(self.inverseRotationMatrix, np.array(translationVector, dtype=np.float64).reshape(3))
+
+        self.calibrationReference = calibrationReference
+        self.calibrationPointSize = calibrationPointSize
+
+    @staticmethod
+    def fromCameraConfiguration(cameraConfiguration, calibrationPointSize):
+        return CameraProjection(
+            rotationVector=cameraConfiguration['rotationVector'],
+            translationVector=cameraConfiguration['translationVector'],
+            cameraMatrix=cameraConfiguration['cameraMatrix'],
+            calibrationReference=cameraConfiguration['calibrationReferencePoint'],
+            calibrationPointSize=calibrationPointSize
+        )
+
+    def project(self, points, heights):
+        """
+            Projects points on the camera image onto the store map.
+
+            :param points: A [N, 2] array of screen locations
+            :param heights: The height above the ground of each point, either a [N] array or a single number
+            :return: A [N, 2] array of store map locations
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        heights = np.broadcast_to(np.asarray(heights, dtype=np.float64), (len(points),))
+
+        # Add in another dimension
+        locations = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+
+        rays = np.matmul(locations, self.rayMatrix.T)
+
+        s = ((-heights) / self.calibrationPointSize + self.rotatedTranslation[2]) / rays[:, 2]
+
+        final = s[:, np.newaxis] * rays - self.rotatedTranslation
+
+        x = final[:, 0] * self.calibrationReference['unitWidth']
+        y = final[:, 1] * self.calibrationReference['unitHeight']
+
+        # Now we need to rotate the coordinates based on the direction of the camera
+        if self.calibrationReference['direction'] == 'east':
+            x, y = -y + self.calibrationReference['unitWidth'] * 7, x
+        elif self.calibrationReference['direction'] == 'west':
+            x, y = y, -x + self.calibrationReference['unitHeight'] * 5
+        elif self.calibrationReference['direction'] == 'south':
+            x, y = -x + self.calibrationReference['unitWidth'] * 7, -y + self.calibrationReference['unitHeight'] * 5
+
+        return np.stack([x + self.calibrationReference['x'], y + self.calibrationReference['y']], axis=1)
@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+import traceback
+from datetime import datetime
+import bson
+import numpy as np
+from ebretail.components.metrics import traceStage
+from ebretail.components.person_detection import PersonDetection
+from ebretail.components.frame_encoding import encodeArrays, decodeArrays
+
+# Entries in the people tracking state which are only needed from one frame to the next, and are too large to be
+# worth handing over. The optical flow just starts again from the next image.
+transientPeopleStateKeys = ('grayImage', 'previousGrayImage')
+
+
+def encodeStateValue(value):
+    """
+        Converts a value from the state for a camera into plain data which can be encoded as BSON. Numpy arrays are
+        stored with encodeArrays, and every other container is tagged with its type, so that decodeStateValue can
+        rebuild exactly the same value. Only plain data can be restored this way, never arbitrary objects.
+
+        :param value: The value to convert
+        :return: A value which can be encoded as BSON
+    """
+    if value is None or isinstance(value, (bool, str, int, float)):
+        return value
+    elif isinstance(value, np.bool_):
+        return bool(value)
+    elif isinstance(value, np.integer):
+        return int(value)
+    elif isinstance(value, np.floating):
+        return float(value)
+    elif isinstance(value, datetime):
+        # Stored as text, because BSON dates lose the microseconds, which the out-of-order check depends on
+        return {"type": "datetime", "value": value.isoformat()}
+    elif isinstance(value, np.ndarray):
+        return {"type": "ndarray", "value": encodeArrays({"value": value})["value"]}
+    elif isinstance(value, PersonDetection):
+        return {"type": "person", "value": encodeStateValue({
+            "detectionId": value.detectionId,
+            "keypoints": value.keypoints,
+            "featureVector": value.featureVector,
+            "boundingBox": value.boundingBox
+        })}
+    elif isinstance(value, (list, tuple)):
+        return {"type": "list", "value": [encodeStateValue(item) for item in value]}
+    elif isinstance(value, dict):
+        # The keys aren't always strings, so the items are kept as pairs
+        return {"type": "dict", "value": [[encodeStateValue(key), encodeStateValue(item)] for key, item in value.items()]}
+    else:
+        raise TypeError("Can't store a " + type(value).__name__ + " in a camera state snapshot")
+
+
+def decodeStateValue(value):
+    """
+        Converts a value made by encodeStateValue back into the original value.
+
+        :param value: The value from encodeStateValue, after being decoded from BSON
+        :return: The original value
+    """
+    if not isinstance(value, dict):
+        return value
+
+    if value['type'] == 'datetime':
+        return datetime.fromisoformat(value['value'])
+    elif value['type'] == 'ndarray':
+        # The arrays decoded from the snapshot are read-only views of it, and some of the state is updated in place
+        return decodeArrays({"value": value['value']})["value"].copy()
+    elif value['type'] == 'person':
+        person = decodeStateValue(value['value'])
+        return PersonDetection(person['detectionId'], person['keypoints'], person['featureVector'], person['boundingBox'])
+    elif value['type'] == 'list':
+        return [decodeStateValue(item) for item in value['value']]
+    elif value['type'] == 'dict':
+        return {decodeStateValue(key): decodeStateValue(item) for key, item in value['value']}
+    else:
+        raise ValueError("Unknown value type in camera state snapshot: " + str(value['type']))
+
+
+def createCameraStateSnapshot(state):
+    """
+        Converts the state for a single camera, as carried between images by the image analyzer, into a snapshot.
+        The Sort tracker is packed into the arrays from Sort.to_arrays, and is restored by the image analyzer when the
+        next image for the camera is processed.
+
+        The snapshot is BSON containing only plain data, so it is safe to restore one that came in over the network.
+
+        :param state: The state dictionary for the camera
+        :return: The snapshot, as bytes
+    """
+    state = dict(state)
+    if state.get('peopleState', None) is not None:
+        peopleState = {key: value for key, value in state['peopleState'].items() if key not in transientPeopleStateKeys}
+        if 'tracker' in peopleState:
+            peopleState['trackerArrays'] = peopleState.pop('tracker').to_arrays()
+        state['peopleState'] = peopleState
+
+    return bson.BSON.encode({"state": encodeStateValue(state)})
+
+
+def restoreCameraStateSnapshot(snapshot):
+    """
+        Converts a snapshot from createCameraStateSnapshot back into the state for a single camera.
+
+        :param snapshot: The snapshot, as bytes
+        :return: The state dictionary for the camera
+    """
+    return decodeStateValue(bson.BSON(snapshot).decode()['state'])
+
+
+class CameraShard:
+    """
+        This class owns the tracking state for a set of cameras within an image processor, including the Sort tracker
+        and the bestImages for each of them. Each camera has its own lock, so only one image from a camera is analyzed
+        at a time.
+
+        Which cameras belong to which shard is decided by the CameraShardRouter. When that changes, the state for a
+        camera is handed over to its new shard with exportCameraState and importCameraState, so the people being
+        tracked keep their ids. Once a camera has been handed over, any of its images still on their way to this
+        shard are discarded, rather then starting a new state for it which nothing would ever hand back.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+        self.states = {}
+        self.locks = {}
+        self.locksLock = threading.Lock()
+        self.saveLock = threading.Lock()
+
+        # The cameras whose state has been handed over to another shard, and not handed back since
+        self.handedOverCameraIds = set()
+
+    def getCameraLock(self, cameraId):
+        with self.locksLock:
+            if cameraId not in self.locks:
+                self.locks[cameraId] = threading.Lock()
+            return self.locks[cameraId]
+
+    def cameraIds(self):
+        """ Returns the ids of all of the cameras which this shard has state for."""
+        return list(self.states.keys())
+
+    def processImage(self, metadata, timestamp, processFunction, lockTimeout=0.1):
+        """
+            Runs processFunction on the current state for the camera the image came from, while holding that cameras lock,
+            and keeps the state it returns. Images which are older then the last processed image for the camera are discarded.
+
+            :param metadata: The metadata that came in with the image
+            :param timestamp: The timestamp of the image, as a datetime
+            :param processFunction: A function which takes the current state for the camera, and returns the new state
+            :param lockTimeout: How long to wait for the camera lock before the image is discarded, in seconds
+            :return: Either "processed", "out_of_order", "lock_contended" or "handed_over"
+        """
+        lock = self.getCameraLock(metadata['cameraId'])
+
+        with traceStage(metadata, 'lock_wait'):
+            acquired = lock.acquire(timeout=lockTimeout)
+        if not acquired:
+            return "lock_contended"
+
+        try:
+            # This image was sent before the camera was handed over to another shard
+            if metadata['cameraId'] in self.handedOverCameraIds:
+                return "handed_over"
+
+            currentState = self.states.get(metadata['cameraId'], {})
+            currentTimestamp = currentState.get('timestamp', None)
+
+            # Only process this image if its timestamp is after the last processed image
+            # otherwise we discard it from the sequence as out of order.
+            if currentTimestamp is not None and timestamp <= currentTimestamp:
+                return "out_of_order"
+
+            self.states[metadata['cameraId']] = processFunction(currentState)
+            return "processed"
+        finally:
+            lock.release()
+
+    def exportCameraState(self, cameraId):
+        """
+            Removes the state for the given camera from this shard, and returns it as a snapshot to be handed over to another shard.
+            Any more images from the camera are discarded by this shard, until the camera is handed back with importCameraState.
+
+            :param cameraId: The id of the camera
+            :return: The snapshot from createCameraStateSnapshot, or None if this shard has no state for the camera
+        """
+        with self.getCameraLock(cameraId):
+            self.handedOverCameraIds.add(cameraId)
+            state = self.states.pop(cameraId, None)
+            if state is None:
+                return None
+            return createCameraStateSnapshot(state)
+
+    def importCameraState(self, cameraId, snapshot):
+        """
+            Takes over the given camera, replacing any state this shard already had for it.
+
+            :param cameraId: The id of the camera
+            :param snapshot: The snapshot made by exportCameraState, as bytes, or None if the camera is taken over with no state
+        """
+        state = None
+        if snapshot is not None:
+            state = restoreCameraStateSnapshot(snapshot)
+
+        with self.getCameraLock(cameraId):
+            self.handedOverCameraIds.discard(cameraId)
+            if state is None:
+                self.states.pop(cameraId, None)
+            else:
+                self.states[cameraId] = state
+
+    def saveCameraStates(self, fileName):
+        """
+            Saves a snapshot of the state for every camera in this shard to the given file, so that tracking can carry
+            on where it left off when the image processor is restarted.
+
+            :param fileName: The path of the file to write
+        """
+        cameras = []
+        for cameraId in self.cameraIds():
+            with self.getCameraLock(cameraId):
+                if cameraId in self.states:
+                    cameras.append({"cameraId": cameraId, "snapshot": bson.Binary(createCameraStateSnapshot(self.states[cameraId]))})
+
+        # Write to a temporary file first, so a crash part way through doesn't leave a truncated file behind
+        with self.saveLock:
+            with open(fileName + ".tmp", 'wb') as file:
+                file.write(bson.BSON.encode({"cameras": cameras}))
+            os.replace(fileName + ".tmp", fileName)
+
+    def saveCameraStatesThread(self, fileName, interval):
+        """
+            Saves the camera states to the given file every interval seconds, forever. This is run on a background
+            thread, so that at most interval seconds of tracking is lost if the image processor is killed.
+
+            :param fileName: The path of the file to write
+            :param interval: The time between saves, in seconds
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.saveCameraStates(fileName)
+            except Exception as e:
+                print('camera state save error', traceback.format_exc())
+
+    def loadCameraStates(self, fileName):
+        """
+            Loads the state for every camera saved by saveCameraStates, if the file exists.
+
+            :param fileName: The path of the file to read
+        """
+        if not os.path.exists(fileName):
+            return
+
+        with open(fileName, 'rb') as file:
+            cameras = bson.BSON(file.read()).decode()['cameras']
+
+        for camera in cameras:
+            self.importCameraState(camera['cameraId'], bytes(camera['snapshot']))
@@ -0,0 +1,91 @@
+import bisect
+import hashlib
+import threading
+
+
+class CameraShardRouter:
+    """
+        This class decides which shard each camera is sent to, using consistent hashing on the cameraId. Every shard
+        is placed at many points around a hash ring, and a camera belongs to the first shard point after its own hash.
+        When a shard is added or removed, only the cameras next to its points move, and the rest stay where they are.
+
+        The shards are identified by name, which can be anything - the image collector uses the URLs of the image processors.
+        When the shards change, handOverCamera is called for every camera this router has seen whose shard has changed,
+        before any more of its images are routed to the new shard.
+    """
+
+    def __init__(self, shards=(), replicas=100, handOverCamera=None):
+        """
+            :param shards: The names of the shards to start with
+            :param replicas: The number of points each shard has on the hash ring. More points spread the cameras more evenly.
+            :param handOverCamera: A function taking (cameraId, oldShard, newShard), which moves the state for a camera between shards
+        """
+        self.replicas = replicas
+        self.handOverCamera = handOverCamera
+
+        self.lock = threading.Lock()
+        self.shards = []
+        self.ring = []
+        self.ringShards = []
+        self.knownCameraIds = set()
+
+        self.setShards(shards)
+
+    @staticmethod
+    def hashKey(key):
+        return int(hashlib.md5(str(key).encode('utf8')).hexdigest()[:16], 16)
+
+    def buildRing(self, shards):
+        points = sorted((self.hashKey(str(shard) + "-" + str(replica)), shard) for shard in shards for replica in range(self.replicas))
+        return [point[0] for point in points], [point[1] for point in points]
+
+    def findShard(self, cameraId, ring, ringShards):
+        if len(ring) == 0:
+            return None
+        index = bisect.bisect(ring, self.hashKey(cameraId)) % len(ring)
+        return ringShards[index]
+
+    def getShard(self, cameraId):
+        """
+            Returns the name of the shard which the given camera belongs to.
+
+            :param cameraId: The id of the camera
+            :return: The shard name, or None if there are no shards
+        """
+        with self.lock:
+            self.knownCameraIds.add(cameraId)
+            return self.findShard(cameraId, self.ring, self.ringShards)
+
+    def setShards(self, shards):
+        """
+            Changes the set of shards, handing over every camera which now belongs to a different shard.
+
+            :param shards: The names of the new set of shards
+            :return: A list of (cameraId, oldShard, newShard) tuples, for each camera that was moved
+        """
+        with self.lock:
+            ring, ringShards = self.buildRing(shards)
+
+            moves = []
+            for cameraId in sorted(self.knownCameraIds, key=str):
+                oldShard = self.findShard(cameraId, self.ring, self.ringShards)
+                newShard = self.findShard(cameraId, ring, ringShards)
+                if oldShard is not None and newShard is not None and oldShard != newShard:
+                    moves.append((cameraId, oldShard, newShard))
+
+            if self.handOverCamera is not None:
+                for cameraId, oldShard, newShard in moves:
+                    self.handOverCamera(cameraId, oldShard, newShard)
+
+            self.shards = list(shards)
+            self.ring = ring
+            self.ringShards = ringShards
+            return moves
+
+    def addShard(self, shard):
+        """ Adds a shard, handing over the cameras which now belong to it. Returns the moves, as for setShards."""
+        return self.setShards(self.shards + [shard])
+
+    def removeShard(self, shard):
+        """ Removes a shard, handing over its cameras to the remaining shards. Returns the moves, as for setShards."""
+        return self.setShards([existing for existing in self.shards if existing != shard])
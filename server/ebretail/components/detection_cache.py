@@ -0,0 +1,111 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+import threading
+import collections
+import numpy
+
+
+class DetectionCache:
+    """
+        This class caches the results of the expensive detection steps, keyed by a hash of the image they were computed
+        from along with the version of the detection models. The same image always gets the same key, so the cached
+        results are valid for every replay of a capture test, and for repeated frames coming in from live cameras.
+
+        The most recently used entries are kept in memory, up to maxMemoryEntries. If a fileName is given, each new entry
+        is also appended to a sqlite database at that path, and entries which aren't in memory are looked up there.
+        Every process opens its own connection to the database, so one cache file can be shared by many worker processes.
+    """
+
+    def __init__(self, fileName=None, maxMemoryEntries=10000):
+        """
+            :param fileName: The path of the sqlite database to store the entries in, or None to only keep them in memory
+            :param maxMemoryEntries: The maximum number of entries to keep in memory
+        """
+        self.fileName = fileName
+        self.maxMemoryEntries = maxMemoryEntries
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+        self.connection = None
+        self.connectionPid = None
+
+    def __getstate__(self):
+        # Only the configuration is sent to other processes, they open the database for themselves
+        return {"fileName": self.fileName, "maxMemoryEntries": self.maxMemoryEntries}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def computeKey(image, modelVersion):
+        """
+            Computes the cache key for the given image.
+
+            :param image: A numpy array of the image
+            :param modelVersion: The version of the models producing the results being cached
+            :return: The key, as a hex string
+        """
+        hash = hashlib.sha1()
+        hash.update(modelVersion.encode('utf8'))
+        hash.update(str(image.shape).encode('utf8'))
+        hash.update(numpy.ascontiguousarray(image).data)
+        return hash.hexdigest()
+
+    def get(self, kind, key):
+        """
+            Returns the cached value of the given kind for the given key, or None if there isn't one.
+
+            :param kind: The kind of result, e.g. 'people' or 'calibrationObjects'
+            :param key: The key from computeKey
+        """
+        with self.lock:
+            if (kind, key) in self.entries:
+                self.entries.move_to_end((kind, key))
+                return self.entries[(kind, key)]
+
+            if self.fileName is None:
+                return None
+
+            row = self.getConnection().execute("SELECT value FROM detections WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None:
+                return None
+
+            value = pickle.loads(row[0])
+            self.rememberEntry(kind, key, value)
+            return value
+
+    def put(self, kind, key, value):
+        """
+            Stores a value in the cache. The value can be any picklable object - numpy arrays are stored as their raw buffers.
+
+            :param kind: The kind of result, e.g. 'people' or 'calibrationObjects'
+            :param key: The key from computeKey
+            :param value: The value to store
+        """
+        with self.lock:
+            self.rememberEntry(kind, key, value)
+
+            if self.fileName is not None:
+                # Keys are content addressed, so an entry which is already stored never needs to change
+                self.getConnection().execute("INSERT OR IGNORE INTO detections (kind, key, value) VALUES (?, ?, ?)",
+                                             (kind, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def rememberEntry(self, kind, key, value):
+        self.entries[(kind, key)] = value
+        self.entries.move_to_end((kind, key))
+        while len(self.entries) > self.maxMemoryEntries:
+            self.entries.popitem(last=False)
+
+    def getConnection(self):
+        # A sqlite connection can't be carried across a fork, so each process opens its own
+        if self.connection is None or self.connectionPid != os.getpid():
+            # Each insert is committed on its own, so a worker never holds the write lock while it runs the detectors
+            self.connection = sqlite3.connect(self.fileName, timeout=60, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS detections (kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, key))")
+            self.connectionPid = os.getpid()
+        return self.connection
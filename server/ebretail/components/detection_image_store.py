@@ -0,0 +1,104 @@
+import datetime
+import bson
+import gridfs
+import pymongo
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
+
+# The chunk collections which have already had their index checked by this process
+indexedChunkCollections = set()
+
+
+class DetectionImageStore:
+    """
+        This class stores the images of people that have been detected by the system, in the detectionImages GridFS bucket.
+
+        GridFS.put writes each file on its own, and replacing a file needs an exists / delete / put on top of that.
+        A crowded frame can have dozens of people in it, so instead this class writes the GridFS files and chunks
+        documents for all of the images of a frame directly, in a fixed number of bulk operations. The files are
+        still in the standard GridFS layout, with the detectionId as the filename. The latest version is the one with
+        the latest uploadDate, as for GridFS.get_last_version, with the _id breaking ties between uploads in the same millisecond.
+
+        Replacing an image writes it as a new version, and only removes the older versions once the new one is complete,
+        so a reader always finds a whole file. Versions newer then the one just written are left alone, so two uploads
+        of the same detection at once can't delete each others images.
+    """
+
+    def __init__(self, db, collection='detectionImages'):
+        self.gridFS = gridfs.GridFS(db, collection=collection)
+        self.files = db[collection + ".files"]
+        self.chunks = db[collection + ".chunks"]
+
+        # GridFS.put would normally create this index, so make sure it exists for reads to use
+        if self.chunks.full_name not in indexedChunkCollections:
+            self.chunks.create_index([("files_id", pymongo.ASCENDING), ("n", pymongo.ASCENDING)], unique=True)
+            self.files.create_index([("filename", pymongo.ASCENDING), ("uploadDate", pymongo.ASCENDING)])
+            indexedChunkCollections.add(self.chunks.full_name)
+
+    def get(self, detectionId):
+        """ Returns a GridOut for the image of the given detection, or None if there isn't one."""
+        latest = self.files.find_one({"filename": detectionId}, projection=["_id"], sort=[("uploadDate", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        if latest is not None:
+            try:
+                return self.gridFS.get(latest['_id'])
+            except gridfs.errors.NoFile:
+                # Removed by a newer upload since it was found
+                return self.get(detectionId)
+
+        # Images stored before versions were written had the detectionId as their _id
+        try:
+            return self.gridFS.get(detectionId)
+        except gridfs.errors.NoFile:
+            return None
+
+    def putImages(self, images):
+        """
+            Writes the given images, replacing any existing images for the same detections.
+
+            :param images: A dictionary mapping detectionId to the encoded image data, as bytes
+        """
+        if len(images) == 0:
+            return
+
+        detectionIds = list(images.keys())
+
+        # Mongo only stores dates to the millisecond, so round here to compare against what is stored
+        uploadDate = datetime.datetime.utcnow()
+        uploadDate = uploadDate.replace(microsecond=uploadDate.microsecond // 1000 * 1000)
+
+        chunks = []
+        files = []
+        for detectionId, data in images.items():
+            fileId = bson.ObjectId()
+            for n, offset in enumerate(range(0, len(data), DEFAULT_CHUNK_SIZE)):
+                chunks.append({
+                    "files_id": fileId,
+                    "n": n,
+                    "data": bson.Binary(data[offset:offset + DEFAULT_CHUNK_SIZE])
+                })
+
+            files.append({
+                "_id": fileId,
+                "filename": detectionId,
+                "length": len(data),
+                "chunkSize": DEFAULT_CHUNK_SIZE,
+                "uploadDate": uploadDate
+            })
+
+        # The new versions are written in full before the old ones are touched. Chunks go in before the files
+        # documents, so a file is never visible without its data.
+        if len(chunks) > 0:
+            self.chunks.insert_many(chunks, ordered=False)
+        self.files.insert_many(files, ordered=False)
+
+        # Now the versions from before this upload can go, files documents first and then their chunks. Any written by
+        # another upload since then are kept, the latest of them is what get returns.
+        olderVersions = [{"_id": {"$in": detectionIds}}]
+        for file in files:
+            olderVersions.append({"filename": file['filename'], "uploadDate": {"$lt": uploadDate}})
+            olderVersions.append({"filename": file['filename'], "uploadDate": uploadDate, "_id": {"$lt": file['_id']}})
+
+        oldFileIds = [oldFile['_id'] for oldFile in self.files.find({"$or": olderVersions}, projection=["_id"])]
+
+        if len(oldFileIds) > 0:
+            self.files.delete_many({"_id": {"$in": oldFileIds}})
+            self.chunks.delete_many({"files_id": {"$in": oldFileIds}})
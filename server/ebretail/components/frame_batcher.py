@@ -0,0 +1,83 @@
+import time
+import queue
+import threading
+import concurrent.futures
+from ebretail.components.metrics import recordStage
+
+
+class FrameBatcher:
+    """
+        This class gathers up single camera images which arrive on different request threads within a short time window,
+        and runs them through the image analyzer together as one batch. This lets the pose network process the images from
+        all the cameras in a store in a single session call, rather then launching it once for every image.
+
+        Each camera keeps its own state object, the batcher only decides which images get processed together.
+    """
+
+    def __init__(self, imageAnalyzer, batchWindow=0.02, maxBatchSize=8):
+        self.imageAnalyzer = imageAnalyzer
+
+        # How long, in seconds, to wait for more images after the first image of a batch arrives
+        self.batchWindow = batchWindow
+        self.maxBatchSize = maxBatchSize
+
+        self.pendingImages = queue.Queue()
+
+        self.batchThread = threading.Thread(target=lambda: self.runBatchThread(), daemon=True)
+        self.batchThread.start()
+
+    def processSingleCameraImage(self, image, metadata, state, debugImage):
+        """
+            Queues up the given image to be processed in the next batch, and blocks until its results are ready.
+            Takes the same arguments and returns the same results as ImageAnalyzer.processSingleCameraImage
+        """
+        future = concurrent.futures.Future()
+        self.pendingImages.put((future, image, metadata, state, debugImage, time.time()))
+        return future.result()
+
+    def runBatchThread(self):
+        while True:
+            batch = [self.pendingImages.get()]
+
+            # Keep collecting images until either the batch is full or the window has closed
+            deadline = time.time() + self.batchWindow
+            while len(batch) < self.maxBatchSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pendingImages.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Run the person detector less often while images are piling up faster then they can be processed
+            self.imageAnalyzer.adaptDetectorFrequency(self.pendingImages.qsize(), self.maxBatchSize)
+
+            self.processBatch(batch)
+
+    def processBatch(self, batch):
+        futures = [item[0] for item in batch]
+
+        # Record how long each image waited for its batch to start
+        now = time.time()
+        for item in batch:
+            recordStage(item[2], 'batch_wait', now - item[5])
+
+        try:
+            results = self.imageAnalyzer.processSingleCameraImageBatch(
+                [item[1] for item in batch],
+                [item[2] for item in batch],
+                [item[3] for item in batch],
+                [item[4] for item in batch]
+            )
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        # Each image gets its own result, so a problem with one camera doesn't fail the rest of the batch
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,138 @@
+import io
+import bson
+import cv2
+import numpy as np
+from PIL import Image
+from ebretail.components.person_detection import PersonDetection, singleCameraFrameToJSON
+
+# The content type used when SingleCameraFrame objects are sent in the compact binary format
+compactContentType = 'application/bson'
+
+
+# The cv2.imdecode flags used to decode the uploaded camera images at each supported reduced scale
+cameraImageDecodeFlags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+
+def encodeCameraImage(image):
+    """
+        Encodes a camera image as a JPEG, for the image collector to upload to the image processor.
+
+        The image is in OpenCV's BGR order, but PIL takes it as RGB, so the red and blue channels are swapped within
+        the JPEG. Every image processor expects it that way, and decodeCameraImage swaps them back.
+
+        :param image: The camera image, as a BGR numpy array
+        :return: A BytesIO containing the JPEG
+    """
+    b = io.BytesIO()
+    Image.fromarray(image, mode=None).save(b, "JPEG", quality=80)
+    b.seek(0)
+    return b
+
+
+def decodeCameraImage(data, decodeScale=1):
+    """
+        Decodes a camera image uploaded by the image collector, back into the BGR order the image analyzer works in.
+
+        :param data: The JPEG made by encodeCameraImage, as bytes
+        :param decodeScale: Decode the image at 1/decodeScale of its size. Can be 1, 2, 4 or 8
+        :return: The image, as a BGR numpy array
+        :raises ValueError: If the data isn't a complete image
+    """
+    # cv2 asserts on an empty buffer, and returns None for one it can't decode
+    image = None
+    if len(data) > 0:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cameraImageDecodeFlags[decodeScale])
+    if image is None:
+        raise ValueError("The camera image could not be decoded")
+
+    # cv2 reads the channels in the order they were stored, which encodeCameraImage left swapped
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+
+def encodeSingleCameraFrame(singleCameraFrame):
+    """
+        Encodes a SingleCameraFrame object into the compact binary format. This is BSON, except that each persons
+        keypoints and feature vector are stored as raw little-endian float32 binary rather then as lists of numbers.
+
+        :param singleCameraFrame: A SingleCameraFrame object, with people either as PersonDetection objects or in the JSON format
+        :return: The encoded bytes
+    """
+    data = dict(singleCameraFrame)
+
+    people = []
+    for person in singleCameraFrame['people']:
+        if not isinstance(person, PersonDetection):
+            person = PersonDetection.fromJSON(person)
+
+        people.append({
+            "detectionId": person.detectionId,
+            "keypoints": bson.Binary(person.keypoints.astype('<f4').tobytes()),
+            "boundingBox": person.boundingBox.tolist(),
+            "featureVector": None if person.featureVector is None else bson.Binary(person.featureVector.astype('<f4').tobytes())
+        })
+
+    data['people'] = people
+    return bson.BSON.encode(data)
+
+
+def decodeSingleCameraFrame(data):
+    """
+        Decodes a SingleCameraFrame object from the compact binary format, back into the standard JSON format.
+
+        :param data: The encoded bytes
+        :return: A SingleCameraFrame object in the JSON format
+    """
+    singleCameraFrame = bson.BSON(data).decode()
+
+    people = []
+    for person in singleCameraFrame['people']:
+        featureVector = None
+        if person['featureVector'] is not None:
+            featureVector = np.frombuffer(person['featureVector'], dtype='<f4')
+
+        people.append(PersonDetection(
+            person['detectionId'],
+            np.frombuffer(person['keypoints'], dtype='<f4'),
+            featureVector,
+            person['boundingBox']
+        ))
+
+    singleCameraFrame['people'] = people
+    return singleCameraFrameToJSON(singleCameraFrame)
+
+
+def encodeArrays(arrays):
+    """
+        Encodes a dictionary of numpy arrays, such as the tracker state from Sort.to_arrays, so that it can be stored
+        in Mongo or sent as BSON. Each array is kept as raw little-endian binary along with its shape and type.
+
+        :param arrays: A dictionary of names to numpy arrays
+        :return: A dictionary which can be encoded as BSON
+    """
+    encoded = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        encoded[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "data": bson.Binary(array.tobytes())
+        }
+    return encoded
+
+
+def decodeArrays(encoded):
+    """
+        Decodes a dictionary of numpy arrays encoded with encodeArrays.
+
+        :param encoded: The dictionary from encodeArrays
+        :return: A dictionary of names to numpy arrays
+    """
+    return {
+        name: np.frombuffer(value['data'], dtype=value['dtype']).reshape(value['shape'])
+        for name, value in encoded.items()
+    }
@@ -0,0 +1,163 @@
+import io
+import json
+import time
+import queue
+import threading
+import traceback
+import cv2
+import requests
+import requests.adapters
+from PIL import Image
+from ebretail.components.person_detection import singleCameraFrameToJSON
+from ebretail.components.frame_encoding import encodeSingleCameraFrame, compactContentType
+from ebretail.components.metrics import globalMetricsRegistry, recordStage, traceStage
+
+forwardedResultsCounter = globalMetricsRegistry.counter('ebretail_processor_forwarded_results_total',
+                                                        'Results handled by the frame forwarder, by what happened to them.',
+                                                        ['result'])
+
+
+class FrameForwarder:
+    """
+        This class sends the results of the image processor onwards to the main server, from background threads.
+
+        The request threads only have to queue up the results, so the per-camera lock can be released as soon as
+        analysis is done. All of the HTTP calls go through one pooled requests.Session, so connections to the main
+        server are kept alive and reused rather then opened fresh for every post.
+
+        Each camera is always assigned to the same worker, so the frames for any one camera still arrive at the
+        main server in order. The queues are bounded - if the main server can't keep up, new results are dropped
+        and counted rather then piling up in memory.
+    """
+
+    def __init__(self, mainServerURL, workers=4, maxQueueSize=64, useCompactFormat=False):
+        """
+            :param mainServerURL: The root URL of the main server, e.g. http://localhost:1806
+            :param workers: The number of background threads doing the sending
+            :param maxQueueSize: The maximum number of frames waiting to be sent for each worker
+            :param useCompactFormat: Whether to send SingleCameraFrame objects in the compact binary format. Only turn this on
+                                     once the main server understands it - if it answers with an error, JSON is used from then on
+        """
+        self.mainServerURL = mainServerURL
+        self.useCompactFormat = useCompactFormat
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.queues = [queue.Queue(maxsize=maxQueueSize) for worker in range(workers)]
+
+        self.metricsLock = threading.Lock()
+        self.metrics = {
+            "queued": 0,
+            "sent": 0,
+            "dropped": 0,
+            "failed": 0,
+            "maxQueueDepth": 0
+        }
+
+        self.threads = []
+        for workerQueue in self.queues:
+            thread = threading.Thread(target=lambda workerQueue=workerQueue: self.runWorkerThread(workerQueue), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def forwardResults(self, singleCameraFrame, metadata, debugImage, personImages):
+        """
+            Queues up the results of processing one camera image to be sent to the main server. Does not block.
+
+            :param singleCameraFrame: The SingleCameraFrame object
+            :param metadata: The metadata that came in with the image
+            :param debugImage: The debug image, which is only sent if recording is on or a calibration object was found
+            :param personImages: A dictionary of detectionId to the best image of that person
+            :return: True if the results were queued, False if they were dropped because the queue is full
+        """
+        workerQueue = self.queues[hash(str(metadata['cameraId'])) % len(self.queues)]
+
+        try:
+            workerQueue.put_nowait((singleCameraFrame, metadata, debugImage, personImages, time.time()))
+        except queue.Full:
+            self.incrementMetric("dropped")
+            print("Dropped results for " + str(metadata['cameraId']) + " because the forwarding queue is full: " + metadata['timestamp'])
+            return False
+
+        forwardedResultsCounter.inc(result="queued")
+        with self.metricsLock:
+            self.metrics['queued'] += 1
+            self.metrics['maxQueueDepth'] = max(self.metrics['maxQueueDepth'], workerQueue.qsize())
+
+        return True
+
+    def getMetrics(self):
+        """ Returns a snapshot of the forwarding counters along with the current queue depths."""
+        with self.metricsLock:
+            metrics = dict(self.metrics)
+
+        metrics['queueDepth'] = sum(workerQueue.qsize() for workerQueue in self.queues)
+        metrics['queueCapacity'] = sum(workerQueue.maxsize for workerQueue in self.queues)
+        return metrics
+
+    def incrementMetric(self, name):
+        forwardedResultsCounter.inc(result=name)
+        with self.metricsLock:
+            self.metrics[name] += 1
+
+    def runWorkerThread(self, workerQueue):
+        while True:
+            singleCameraFrame, metadata, debugImage, personImages, queuedTime = workerQueue.get()
+
+            # This is stamped before sending, so the main server gets it along with the frame
+            recordStage(metadata, 'forward_queue_wait', time.time() - queuedTime)
+
+            try:
+                with traceStage(metadata, 'forward'):
+                    self.sendResults(singleCameraFrame, metadata, debugImage, personImages)
+                self.incrementMetric("sent")
+            except Exception:
+                self.incrementMetric("failed")
+                print('forwarding error', traceback.format_exc())
+
+    def sendResults(self, singleCameraFrame, metadata, debugImage, personImages):
+        # Error responses are raised, so they are counted as failed rather then sent
+        self.sendSingleCameraFrame(singleCameraFrame).raise_for_status()
+
+        # If recording is enabled, save the debug image
+        if metadata['record'] or singleCameraFrame['calibrationObject'] is not None:
+            recordMetadata = {
+                "storeId": metadata['storeId'],
+                "cameraId": metadata['cameraId'],
+                "timestamp": metadata['timestamp']
+            }
+
+            imageRecordUrl = self.mainServerURL + "/store/" + str(recordMetadata['storeId']) + "/cameras/" + str(recordMetadata['cameraId']) + "/image"
+
+            imageToSend = cv2.cvtColor(debugImage, cv2.COLOR_BGR2RGB)
+            self.session.post(imageRecordUrl, files={'image': self.encodeJPEG(imageToSend), "metadata": json.dumps(recordMetadata)}).raise_for_status()
+
+        # All of the person images for the frame are sent together in a single request
+        if len(personImages) > 0:
+            imageRecordUrl = self.mainServerURL + "/store/" + str(metadata['storeId']) + "/detection_images"
+
+            files = [('image', (str(detectionId), self.encodeJPEG(personImage), 'image/jpeg')) for detectionId, personImage in personImages.items()]
+            self.session.post(imageRecordUrl, files=files).raise_for_status()
+
+    def sendSingleCameraFrame(self, singleCameraFrame):
+        url = self.mainServerURL + "/collect_images"
+
+        if self.useCompactFormat:
+            r = self.session.post(url, data=encodeSingleCameraFrame(singleCameraFrame), headers={'Content-Type': compactContentType})
+            if r.status_code < 400:
+                return r
+
+            # A main server which doesn't understand the compact format fails to read the body as JSON, so on any error
+            # this frame is sent again as JSON, and the forwarder stays on JSON from then on
+            self.useCompactFormat = False
+
+        return self.session.post(url, json=singleCameraFrameToJSON(singleCameraFrame))
+
+    def encodeJPEG(self, image):
+        b = io.BytesIO()
+        Image.fromarray(image, mode=None).save(b, "JPEG", quality=80)
+        b.seek(0)
+        return b
@@ -0,0 +1,82 @@
+import os
+import json
+import numpy
+
+
+class FrameStore:
+    """
+        This class stores the decoded images of a capture on disk, as one raw uint8 .npy file for each camera,
+        along with a small JSON index.
+
+        The files are opened as read-only memory maps, so a frame is only read from disk when it is used, and every
+        process that opens the same store shares the one copy of the data in the page cache.
+    """
+
+    indexFileName = 'index.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(os.path.join(directory, FrameStore.indexFileName), 'rt') as file:
+            self.index = json.load(file)
+
+        self.metadata = self.index['metadata']
+        self.cameraArrays = [numpy.load(os.path.join(directory, camera['file']), mmap_mode='r') for camera in self.index['cameras']]
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, FrameStore.indexFileName))
+
+    @staticmethod
+    def create(directory, numberOfFrames, loadFrame, metadata=None):
+        """
+            Creates a new frame store, loading the frames one at a time so the whole capture never has to be in memory at once.
+
+            :param directory: The directory to write the store into
+            :param numberOfFrames: The number of frames in the capture
+            :param loadFrame: A function which takes a frame index, and returns a list with the image from each camera for that frame
+            :param metadata: Any extra JSON data to save in the index
+            :return: The opened FrameStore
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        cameras = []
+        cameraArrays = []
+        for frameIndex in range(numberOfFrames):
+            cameraImages = loadFrame(frameIndex)
+
+            if frameIndex == 0:
+                for cameraIndex, image in enumerate(cameraImages):
+                    fileName = 'camera-' + str(cameraIndex) + '.npy'
+                    shape = (numberOfFrames,) + image.shape
+
+                    cameras.append({"file": fileName, "shape": list(shape)})
+                    cameraArrays.append(numpy.lib.format.open_memmap(os.path.join(directory, fileName), mode='w+', dtype=numpy.uint8, shape=shape))
+
+            for cameraIndex, image in enumerate(cameraImages):
+                cameraArrays[cameraIndex][frameIndex] = image
+
+        for cameraArray in cameraArrays:
+            cameraArray.flush()
+        del cameraArrays
+
+        # The index is written last, so a store that was only partly written will never be opened
+        with open(os.path.join(directory, FrameStore.indexFileName), 'wt') as file:
+            json.dump({
+                "numberOfFrames": numberOfFrames,
+                "cameras": cameras,
+                "metadata": metadata if metadata is not None else {}
+            }, file, indent=4)
+
+        return FrameStore(directory)
+
+    def numberOfFrames(self):
+        return self.index['numberOfFrames']
+
+    def getFrame(self, frameIndex):
+        """ Returns a list with the image from each camera for the given frame. These are read-only views onto the files."""
+        return [cameraArray[frameIndex] for cameraArray in self.cameraArrays]
+
+    def getCameraSequence(self, cameraIndex):
+        """ Returns a read-only [frames, height, width, 3] array of every image from the given camera."""
+        return self.cameraArrays[cameraIndex]
@@ -7,16 +7,18 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
 
 import os
 import threading
+import math
+import time
 import numpy as np
-from pprint import pprint
-import scipy.linalg
-import scipy.spatial
 import cv2
 import uuid
 import datetime
 from datetime import datetime
 from sort import Sort
 from blur_detection import estimate_blur
+from ebretail.components.camera_projection import CameraProjection
+from ebretail.components.person_detection import PersonDetection, keypointNames, singleCameraFrameToJSON
+from ebretail.components.metrics import recordStage, traceStage
 
 globalSharedInstanceLock = threading.RLock()
 globalSharedInstance = None
@@ -30,11 +32,48 @@ class ImageAnalyzer:
         This class is meant to handle just that core image processing piece.
     """
 
+    # The number of inside corners on the calibration object's checkerboard
+    calibrationChessBoardSize = (4, 6)
+
     def __init__(self, initializeTracking = False):
         self.trackingSession = None
 
-        # How frequent does the person detector run
+        # How frequent does the person detector run. On the frames in between, people are moved along by their trackers
         self.personDetectorFrequency = 1
+        # When the processor falls behind, the detector is run less often, but never less often then this
+        self.personDetectorMaxFrequency = 1
+        # The detector frequency currently in use, between personDetectorFrequency and personDetectorMaxFrequency
+        self.currentDetectorFrequency = 1
+        # The detector runs early if the scene has changed by more then this mean pixel difference since its last run. None to disable
+        self.sceneChangeThreshold = 12
+        # Whether keypoints are refined with optical flow on the frames where the detector doesn't run
+        self.keypointOpticalFlowEnabled = False
+        # When no one is being tracked, the person detector is skipped unless at least this fraction of the image differs
+        # from the background. None to disable the motion gate
+        self.motionGateThreshold = None
+        # The difference in grey level at which a pixel counts as changed from the background
+        self.motionGatePixelThreshold = 15
+        # How quickly the background model adapts to the current image
+        self.motionGateBackgroundRate = 0.05
+        # When enabled, the pose network is only run on padded regions around the tracked people and the entry zones,
+        # except for a full frame pass every roiFullFrameInterval detections to pick up new people
+        self.roiInferenceEnabled = False
+        self.roiFullFrameInterval = 10
+        # How much each tracked box is grown on every side, as a fraction of its width and height
+        self.roiPadding = 0.5
+        # Regions where people can walk into view, as [left, top, right, bottom] fractions of the image size
+        self.roiEntryZones = []
+        # Regions are padded up to a multiple of this size, so that similar sized regions can be batched together
+        self.roiShapeQuantum = 64
+        # How many images have been gated and processed since startup
+        self.motionGateCounters = {
+            "gated": 0,
+            "processed": 0
+        }
+        # The maximum number of images run through the pose detector in a single batch
+        self.poseMaxBatchSize = 8
+        # The maximum number of person crops run through the tracking feature extractor in a single batch
+        self.trackingMaxBatchSize = 64
         self.detectorTrackerMaxDistance = 50
         self.trackerBoxWidth = 30
         self.trackerBoxHeight = 30
@@ -44,26 +83,25 @@ class ImageAnalyzer:
         
         self.validationEnabled = True
 
-        # We need to double check all of the indexes - some of these might not actually be correlated with the correct body parts
-        self.keypointNames = [
-            'left_ear',
-            'left_eye',
-            'nose',
-            'right_eye',
-            'right_ear',
-            'left_shoulder',
-            'right_shoulder',
-            'left_elbow',
-            'right_elbow',
-            'left_hand',
-            'right_hand',
-            'left_hip',
-            'right_hip',
-            'left_knee',
-            'right_knee',
-            'left_foot',
-            'right_foot'
+        self.keypointNames = keypointNames
+
+        # The groups of keypoints used to estimate where a person is standing, along with the hyper parameters giving
+        # the height of that body part off the ground and the weight given to its estimate.
+        self.locationEstimateGroups = [
+            ('foot_height', 'foot_location_estimate_weight', ['left_foot', 'right_foot']),
+            ('knee_height', 'knee_location_estimate_weight', ['left_knee', 'right_knee']),
+            ('hip_height', 'hip_location_estimate_weight', ['left_hip', 'right_hip']),
+            ('shoulder_height', 'shoulder_location_estimate_weight', ['left_shoulder', 'right_shoulder']),
+            ('eye_height', 'eye_location_estimate_weight', ['left_ear', 'right_ear', 'left_eye', 'right_eye', 'nose'])
         ]
+
+        self.locationEstimateGroupMatrix = np.zeros((len(self.locationEstimateGroups), len(self.keypointNames)))
+        for groupIndex, (heightName, weightName, groupKeypoints) in enumerate(self.locationEstimateGroups):
+            for keypoint in groupKeypoints:
+                self.locationEstimateGroupMatrix[groupIndex][self.keypointNames.index(keypoint)] = 1
+
+        # A keypoint is only used if it was detected. This is checked on the x coordinate for left side keypoints, and the y coordinate for the rest.
+        self.keypointDetectedCoordinate = np.array([0 if keypoint.startswith('left_') else 1 for keypoint in self.keypointNames])
         #
         # # These hyper parameters were the human defined starting point
         self.humanHyperParameters = {
@@ -137,10 +175,17 @@ class ImageAnalyzer:
 
         self.trackingFeatureDim = 128
 
-        self.detectionCache = {
-            'people': {},
-            'calibrationObjects': {}
-        }
+        # A DetectionCache for the results of the detection models, or None to always run them
+        self.detectionCache = None
+
+        # Change this whenever the detection models change, so that old results in a DetectionCache aren't used
+        self.detectionModelVersion = 'pose_cfg_multi/mars-small128'
+
+        # The projection for each camera, keyed by cameraId, along with the calibration it was built from
+        self.cameraProjections = {}
+        # The projections used by inverseScreenLocation, keyed by the calibration values themselves
+        self.inverseScreenProjections = {}
+        self.maxInverseScreenProjections = 64
 
         if initializeTracking:
             self.initializeTrackingSession()
@@ -183,6 +228,8 @@ class ImageAnalyzer:
         self.trackingFeatureDim = self.trackingOutputVar.get_shape().as_list()[-1]
         self.trackingImageShape = self.trackingInputVar.get_shape().as_list()[1:]
 
+        # Leave the batch dimension of the pose network open, so that images from several cameras can be run together
+        self.cfg.batch_size = None
         self.poseSess, self.poseInputs, self.poseOutputs = predict.setup_pose_prediction(self.cfg)
 
     def extractTrackingCrop(self, image, bbox, crop_shape, padding=50):
@@ -226,99 +273,189 @@ class ImageAnalyzer:
             This method is used to process a single image from a single camera. It produces a SingleCameraFrame object.
 
             :param image: A numpy array representing the image.
-            :param metadata: A python dictionary containing storeId, cameraId, and timestamp metadata objects.
+            :param metadata: A python dictionary containing storeId, cameraId, and timestamp metadata objects. An optional imageScale gives how many times smaller the image was decoded then the original.
             :param state: A state object, representing carryover state from the previous processed image.
-            :param debugImage: A numpy array, representing a clone of the image, to which debug information can be written to.
+            :param debugImage: A numpy array, representing a clone of the image, to which debug information can be written to. None if no debug output is needed.
             :return: A tuple (singleCameraFrame, state, personImages) representing the resulting SingleCameraFrame object, and state to be carried over to the next image. In addition, images of people to be saved to the server are returned.
         """
+        result = self.processSingleCameraImageBatch([image], [metadata], [state], [debugImage])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
-        peopleState = state.get('peopleState', None)
-        calibrationDetectionState = state.get('calibrationDetectionState', None)
-        cacheId = metadata.get('cacheId', None)
+    def processSingleCameraImageBatch(self, images, metadatas, states, debugImages):
+        """
+            This method is the batched version of processSingleCameraImage. It processes one image from each of several
+            cameras at the same time, so that the pose detector only has to be run once for all of them. Each camera still
+            has its own state object.
+
+            :param images: A list of numpy arrays representing the images.
+            :param metadatas: A list with the metadata dictionary for each image.
+            :param states: A list with the carryover state object for each image.
+            :param debugImages: A list with the debug image for each image. An entry can be None if no debug output is needed.
+            :return: A list with a (singleCameraFrame, state, personImages) tuple for each image. If something went wrong
+                     with one of the images, its entry is the exception instead, and the state for that camera is reset.
+                     An exception from the pose detector itself is raised, since all of the images share it.
+        """
+        cacheIds = [self.computeCacheId(image) for image in images]
 
         try:
             # Use the global image analyzer to do all the general purpose detections
-            people, peopleState, debugImage, personImages = self.detectPeople(image, peopleState, debugImage, cacheId)
-
-            for person in people:
-                oldDetectionId = person['detectionId']
-                person['detectionId'] = str(metadata['storeId']) + "-" + str(metadata['cameraId']) + "-" + str(person['detectionId'])
-                if oldDetectionId in personImages:
-                    personImages[person['detectionId']] = personImages[oldDetectionId]
-                    del personImages[oldDetectionId]
+            detectionStart = time.perf_counter()
+            peopleResults = self.detectPeopleBatch(images, [state.get('peopleState', None) for state in states], debugImages, cacheIds)
 
-            calibrationObject, calibrationDetectionState, debugImage = self.detectCalibrationObject(image, calibrationDetectionState, debugImage, cacheId)
+            # The images are detected together, so each one of them waited for the whole batch
+            detectionTime = time.perf_counter() - detectionStart
+            for metadata in metadatas:
+                recordStage(metadata, 'detect_people', detectionTime)
         except Exception as e:
             # Reset the state if something went wrong.
-            peopleState = None
-            calibrationDetectionState = None
+            for metadata, state in zip(metadatas, states):
+                state['timestamp'] = datetime.strptime(metadata['timestamp'], "%Y-%m-%dT%H:%M:%S.%f")
+                state['peopleState'] = None
+                state['calibrationDetectionState'] = None
             raise  # Reraise the exception
-        finally:
-            state['timestamp'] = datetime.strptime(metadata['timestamp'], "%Y-%m-%dT%H:%M:%S.%f")
-            state['peopleState'] = peopleState
-            state['calibrationDetectionState'] = calibrationDetectionState
-
-        # cv2.imshow('frame', debugImage)
-        # cv2.waitKey(1)
-
-        singleCameraFrame = {
-            "storeId": metadata['storeId'],
-            "cameraId": metadata['cameraId'],
-            "timestamp": metadata['timestamp'],
-            "people": people,
-            "calibrationObject": calibrationObject
-        }
 
-        if self.validationEnabled:
-            from ebretail.models.validate import validateSingleCameraFrame
-            validateSingleCameraFrame(singleCameraFrame)
+        results = []
+        for index, image in enumerate(images):
+            metadata = metadatas[index]
+            state = states[index]
+            debugImage = debugImages[index]
 
-        return (singleCameraFrame, state, personImages)
+            # Images can be decoded at a reduced size, in which case all of the coordinates are scaled back
+            # up to the size of the original camera image before they leave the analyzer
+            imageScale = metadata.get('imageScale', 1)
+
+            peopleState = state.get('peopleState', None)
+            calibrationDetectionState = state.get('calibrationDetectionState', None)
+
+            try:
+                if isinstance(peopleResults[index], Exception):
+                    raise peopleResults[index]
+
+                people, peopleState, debugImage, personImages = peopleResults[index]
+
+                # The people in the frame are copies, so the ones kept in the tracking state keep their tracker ids
+                people = [person.scaled(imageScale) for person in people]
+
+                for person in people:
+                    oldDetectionId = person.detectionId
+                    person.detectionId = str(metadata['storeId']) + "-" + str(metadata['cameraId']) + "-" + str(person.detectionId)
+                    if oldDetectionId in personImages:
+                        personImages[person.detectionId] = personImages[oldDetectionId]
+                        del personImages[oldDetectionId]
+
+                with traceStage(metadata, 'detect_calibration'):
+                    calibrationObject, calibrationDetectionState, debugImage = self.detectCalibrationObject(image, calibrationDetectionState, debugImage, cacheIds[index], imageScale)
+            except Exception as e:
+                # Reset the state if something went wrong. Only this camera is affected, the rest of the batch carries on.
+                peopleState = None
+                calibrationDetectionState = None
+                results.append(e)
+                continue
+            finally:
+                state['timestamp'] = datetime.strptime(metadata['timestamp'], "%Y-%m-%dT%H:%M:%S.%f")
+                state['peopleState'] = peopleState
+                state['calibrationDetectionState'] = calibrationDetectionState
+
+            # cv2.imshow('frame', debugImage)
+            # cv2.waitKey(1)
+
+            singleCameraFrame = {
+                "storeId": metadata['storeId'],
+                "cameraId": metadata['cameraId'],
+                "timestamp": metadata['timestamp'],
+                "people": people,
+                "calibrationObject": calibrationObject
+            }
+
+            if self.validationEnabled:
+                from ebretail.models.validate import validateSingleCameraFrame
+                validateSingleCameraFrame(singleCameraFrameToJSON(singleCameraFrame))
+
+            results.append((singleCameraFrame, state, personImages))
+
+        return results
 
 
     def inverseScreenLocation(self, location, height, rotationVector, translationVector, cameraMatrix, calibrationReference):
-        rotationMatrix = cv2.Rodrigues(np.array(rotationVector))[0]
+        calibrationPointSize = self.hyperParameters['calibration_point_size']
 
-        # Add in another dimension
-        location = np.array([[location[0]], [location[1]], [1]])
+        # This is called for a grid of points at a time, so the projection is kept rather then inverting the matrices for each point
+        key = (np.asarray(rotationVector, dtype=np.float64).tobytes(), np.asarray(translationVector, dtype=np.float64).tobytes(),
+               np.asarray(cameraMatrix, dtype=np.float64).tobytes(), tuple(sorted(calibrationReference.items())), calibrationPointSize)
+        projection = self.inverseScreenProjections.get(key, None)
+        if projection is None:
+            projection = CameraProjection(rotationVector, translationVector, cameraMatrix, calibrationReference, calibrationPointSize)
+            if len(self.inverseScreenProjections) >= self.maxInverseScreenProjections:
+                self.inverseScreenProjections.clear()
+            self.inverseScreenProjections[key] = projection
 
-        calibrationPointsSize = self.hyperParameters['calibration_point_size']
+        final = projection.project(np.array([location]), height)
 
-        tempMatrix = np.matmul(np.matmul(scipy.linalg.inv(rotationMatrix), scipy.linalg.inv(cameraMatrix)), location)
+        return np.reshape(final, (2, 1))
 
-        tempMatrix2 = np.matmul(scipy.linalg.inv(rotationMatrix), translationVector)
+    def getCameraProjection(self, cameraConfiguration):
+        """
+            Returns the CameraProjection for the given camera configuration. Projections are cached by cameraId, and only
+            rebuilt when the calibration of that camera changes.
+
+            Cameras stored in a store have a calibrationVersion, which is changed every time the store is saved, and the
+            projection is rebuilt when that changes. Configurations without one, such as those made by a capture test, are
+            kept as the same object between frames, so the projection is reused for as long as the same object is passed in.
+        """
+        calibrationPointSize = self.hyperParameters['calibration_point_size']
+        version = cameraConfiguration.get('calibrationVersion', None)
+
+        cached = self.cameraProjections.get(cameraConfiguration['cameraId'], None)
+        if cached is not None:
+            cachedVersion, cachedConfiguration, cachedPointSize, projection = cached
+            if cachedPointSize == calibrationPointSize:
+                if version is not None and version == cachedVersion:
+                    return projection
+                elif version is None and cachedConfiguration is cameraConfiguration:
+                    return projection
+
+        projection = CameraProjection.fromCameraConfiguration(cameraConfiguration, calibrationPointSize)
+        self.cameraProjections[cameraConfiguration['cameraId']] = (version, cameraConfiguration, calibrationPointSize, projection)
+        return projection
+
+    def estimateStoreLocations(self, keypoints, cameraInfo):
+        """
+            Estimates where on the store map each person seen by a camera is standing, based on their keypoints.
 
-        s = (-height) / calibrationPointsSize + tempMatrix2[2][0]
+            The detected keypoints are averaged within each body part group, each group is projected onto the store map using the
+            approximate height of that body part, and the projections are combined with a weighted average that gives more weight
+            to body parts close to the ground (so there is less uncertainty).
 
-        s /= tempMatrix[2][0]
+            :param keypoints: A [people, 17, 2] array of keypoints, with zeros for keypoints that weren't detected
+            :param cameraInfo: The SingleCameraConfiguration object for the camera
+            :return: (locations, valid) - A [people, 2] array of store map locations, and a [people] boolean array which is False for anyone with no usable keypoints
+        """
+        keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, len(self.keypointNames), 2)
+        peopleCount = len(keypoints)
 
-        final = np.matmul(scipy.linalg.inv(rotationMatrix),
-                          (s * np.matmul(scipy.linalg.inv(cameraMatrix), location) - translationVector))
+        # Mask out the zero keypoints, then compute the mean location of each group
+        detected = keypoints[:, np.arange(len(self.keypointNames)), self.keypointDetectedCoordinate] != 0
+        groupMembership = detected[:, np.newaxis, :] * self.locationEstimateGroupMatrix[np.newaxis, :, :]
+        groupCounts = np.sum(groupMembership, axis=2)
+        hasGroup = groupCounts > 0
+        groupMeans = np.matmul(groupMembership, keypoints) / np.maximum(groupCounts, 1)[:, :, np.newaxis]
 
-        final[0][0] *= calibrationReference['unitWidth']
-        final[1][0] *= calibrationReference['unitHeight']
+        heights = np.array([self.hyperParameters[heightName] for heightName, weightName, groupKeypoints in self.locationEstimateGroups])
+        weights = np.array([self.hyperParameters[weightName] for heightName, weightName, groupKeypoints in self.locationEstimateGroups])
 
-        # Now we need to rotate the coordinates based on the direction of the camera
-        if calibrationReference['direction'] == 'east':
-            x = final[0][0]
-            y = final[1][0]
-            final[0][0] = -y + calibrationReference['unitWidth'] * 7
-            final[1][0] = x
-        elif calibrationReference['direction'] == 'west':
-            x = final[0][0]
-            y = final[1][0]
-            final[0][0] = y
-            final[1][0] = -x + calibrationReference['unitHeight'] * 5
-        elif calibrationReference['direction'] == 'south':
-            x = final[0][0]
-            y = final[1][0]
-            final[0][0] = -x + calibrationReference['unitWidth'] * 7
-            final[1][0] = -y + calibrationReference['unitHeight'] * 5
+        projection = self.getCameraProjection(cameraInfo)
+        groupLocations = projection.project(groupMeans.reshape(-1, 2), np.tile(heights, peopleCount)).reshape(peopleCount, len(self.locationEstimateGroups), 2)
+        groupLocations[~hasGroup] = 0
 
-        final[0][0] += calibrationReference['x']
-        final[1][0] += calibrationReference['y']
+        # Now we create a weighted average of the various estimates
+        groupWeights = weights[np.newaxis, :] * hasGroup
+        totalWeights = np.sum(groupWeights, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            locations = np.sum(groupLocations * groupWeights[:, :, np.newaxis], axis=1) / totalWeights[:, np.newaxis]
 
-        return final
+        return locations, np.any(hasGroup, axis=1)
 
     def processMultipleCameraFrames(self, singleCameraFrames, singleCameraConfigurations):
         """
@@ -339,161 +476,107 @@ class ImageAnalyzer:
                     cameraInfo = camera
                     break
 
-            if 'rotationVector' in cameraInfo and 'translationVector' in cameraInfo:
-                rotationMatrix = cv2.Rodrigues(np.array(cameraInfo['rotationVector']))[0]
-
-                for index, person in enumerate(frame['people']):
-                    feet = []
-                    knees = []
-                    hips = []
-                    shoulders = []
-                    head = []
-                    if person['keypoints']['left_foot']['x'] != 0:
-                        feet.append(list(person['keypoints']['left_foot'].values()))
-                    if person['keypoints']['right_foot']['y'] != 0:
-                        feet.append(list(person['keypoints']['right_foot'].values()))
-
-                    if person['keypoints']['left_knee']['x'] != 0:
-                        knees.append(list(person['keypoints']['left_knee'].values()))
-                    if person['keypoints']['right_knee']['y'] != 0:
-                        knees.append(list(person['keypoints']['right_knee'].values()))
-
-                    if person['keypoints']['left_hip']['x'] != 0:
-                        hips.append(list(person['keypoints']['left_hip'].values()))
-                    if person['keypoints']['right_hip']['y'] != 0:
-                        hips.append(list(person['keypoints']['right_hip'].values()))
-
-                    if person['keypoints']['left_shoulder']['x'] != 0:
-                        shoulders.append(list(person['keypoints']['left_shoulder'].values()))
-                    if person['keypoints']['right_shoulder']['y'] != 0:
-                        shoulders.append(list(person['keypoints']['right_shoulder'].values()))
-
-                    if person['keypoints']['left_ear']['x'] != 0:
-                        head.append(list(person['keypoints']['left_ear'].values()))
-                    if person['keypoints']['right_ear']['y'] != 0:
-                        head.append(list(person['keypoints']['right_ear'].values()))
-                    if person['keypoints']['left_eye']['x'] != 0:
-                        head.append(list(person['keypoints']['left_eye'].values()))
-                    if person['keypoints']['right_eye']['y'] != 0:
-                        head.append(list(person['keypoints']['right_eye'].values()))
-                    if person['keypoints']['nose']['y'] != 0:
-                        head.append(list(person['keypoints']['nose'].values()))
-
-                    def getStoreLocation(group, height):
-                        screenLocation = np.mean(np.array(group), axis=0)
-
-                        storeLocation = self.inverseScreenLocation(screenLocation,
-                                                                   height,
-                                                                   np.array(cameraInfo['rotationVector']),
-                                                                   np.array(cameraInfo['translationVector']),
-                                                                   np.array(cameraInfo['cameraMatrix']),
-                                                                   cameraInfo['calibrationReferencePoint']
-                                                                   )
-                        return storeLocation
-
-                    # Build up a list of estimated screen locations, using approximated heights
-
-                    estimates = []
-                    if (len(feet) > 0):
-                        estimates.append((self.hyperParameters['foot_location_estimate_weight'], getStoreLocation(group=feet, height=self.hyperParameters['foot_height'])))
-
-                    if (len(knees) > 0):
-                        estimates.append((self.hyperParameters['knee_location_estimate_weight'], getStoreLocation(group=knees, height=self.hyperParameters['knee_height'])))
-
-                    if (len(hips) > 0):
-                        estimates.append((self.hyperParameters['hip_location_estimate_weight'], getStoreLocation(group=hips, height=self.hyperParameters['hip_height'])))
-
-                    if (len(shoulders) > 0):
-                        estimates.append((self.hyperParameters['shoulder_location_estimate_weight'], getStoreLocation(group=shoulders, height=self.hyperParameters['shoulder_height'])))
-
-                    if (len(head) > 0):
-                        estimates.append((self.hyperParameters['eye_location_estimate_weight'], getStoreLocation(group=head, height=self.hyperParameters['eye_height'])))
-
-                    if len(estimates) > 0:
-                        # Now we create a weighted average of the various estimates, giving more weight
-                        # to estimates for body parts close to the ground (so there is less uncertainty)
-                        totalWeight = 0
-                        for estimate in estimates:
-                            totalWeight += estimate[0]
-
-                        x = 0
-                        y = 0
-                        for estimate in estimates:
-                            x += estimate[1][0][0] * (estimate[0] / totalWeight)
-                            y += estimate[1][1][0] * (estimate[0] / totalWeight)
+            if 'rotationVector' in cameraInfo and 'translationVector' in cameraInfo and len(frame['people']) > 0:
+                # Frames loaded from the database have people in the JSON format
+                people = [person if isinstance(person, PersonDetection) else PersonDetection.fromJSON(person) for person in frame['people']]
+
+                locations, valid = self.estimateStoreLocations(np.stack([person.keypoints for person in people]), cameraInfo)
 
+                for index, person in enumerate(people):
+                    if valid[index]:
                         multiCameraFrame['people'].append({
-                            "x": x,
-                            "y": y,
-                            "detectionIds": [person['detectionId']],
-                            "averageFeatureVector": person['featureVector'],
+                            "x": float(locations[index][0]),
+                            "y": float(locations[index][1]),
+                            "detectionIds": [person.detectionId],
+                            "averageFeatureVector": None if person.featureVector is None else person.featureVector.tolist(),
                             "cameraIds": [cameraInfo['cameraId']]
                         })
 
-        # Crude algorithm - merge together any detections from different cameras which are < mergeDistance px from each other
-        # TODO: Replace this crude algorithm
-
-        didMerge = True
-        while didMerge:
-            didMerge = False
-
-            mergeDistance = self.hyperParameters['store_map_merge_distance']
-            personIndex1 = 0
-            personIndex2 = 0
-            mergePerson1 = None
-            mergePersonIndex1 = None
-            mergePerson2 = None
-            mergePersonIndex2 = None
-            minDistance = None
-
-            while personIndex1 < len(multiCameraFrame['people']):
-                personIndex2 = 0
-                while personIndex2 < len(multiCameraFrame['people']):
-                    if personIndex1 != personIndex2:
-                        person1 = multiCameraFrame['people'][personIndex1]
-                        person2 = multiCameraFrame['people'][personIndex2]
-
-                        if len(set(person1['cameraIds']).intersection(set(person2['cameraIds']))) == 0:
-                            dist = scipy.spatial.distance.euclidean(
-                                [person1['x'], person1['y']],
-                                [person2['x'], person2['y']]
-                            )
-
-                            if dist < mergeDistance and (minDistance is None or dist < minDistance):
-                                minDistance = dist
-                                mergePerson1 = person1
-                                mergePersonIndex1 = personIndex1
-
-                                mergePerson2 = person2
-                                mergePersonIndex2 = personIndex2
-                                break
-
-                    personIndex2 += 1
-                personIndex1 += 1
-
-            if mergePerson1 is not None:
-                mergePerson1['x'] = mergePerson1['x'] / 2 + mergePerson2['x'] / 2
-                mergePerson1['y'] = mergePerson1['y'] / 2 + mergePerson2['y'] / 2
-
-                mergePerson1['detectionIds'] = mergePerson1['detectionIds'] + mergePerson2['detectionIds']
-                mergePerson1['cameraIds'] = mergePerson1['cameraIds'] + mergePerson2['cameraIds']
-                if mergePerson1['averageFeatureVector'] is not None and mergePerson2['averageFeatureVector'] is not None:
-                    mergePerson1['averageFeatureVector'] = np.array(mergePerson1['averageFeatureVector']) + np.array(mergePerson2['averageFeatureVector'])
-                elif mergePerson1['averageFeatureVector'] is None and mergePerson2['averageFeatureVector'] is not None:
-                    mergePerson1['averageFeatureVector'] = np.array(mergePerson2['averageFeatureVector'])
-
-                del multiCameraFrame['people'][mergePersonIndex2]
-                didMerge = True
-
-        # Now divide all the average feature vectors by the number of detections.
-        for person in multiCameraFrame['people']:
-            if person['averageFeatureVector'] is not None:
-                person['averageFeatureVector'] = (np.array(person['averageFeatureVector']) / len(person['detectionIds'])).tolist()
+        # Merge together any detections of the same person made by different cameras
+        multiCameraFrame['people'] = self.mergeCameraDetections(multiCameraFrame['people'])
 
         multiCameraFrame['storeId'] = singleCameraFrames[0]['storeId']
 
         return multiCameraFrame
 
+    def mergeCameraDetections(self, people):
+        """
+            Merges together the detections of the same person made by different cameras.
+
+            This makes exactly the same merges as the original loop. On each pass, it goes through the detections in order,
+            taking for each one the first other detection from different cameras which is closer then both
+            store_map_merge_distance and the closest pair found so far. That pair is merged, with the position moved to the
+            midpoint, and the distances from the merged detection are recomputed before the next pass. The distances are kept
+            in a matrix, so each pass only does a few numpy operations per detection rather then comparing every pair.
+
+            :param people: A list of store map detections, each with x, y, detectionIds, averageFeatureVector and cameraIds
+            :return: A list of the merged detections, in the same format
+        """
+        mergeDistance = self.hyperParameters['store_map_merge_distance']
+
+        people = [dict(person) for person in people]
+        cameraIdSets = [set(person['cameraIds']) for person in people]
+
+        def distancesFrom(index):
+            return np.sqrt(np.square(positions[:, 0] - positions[index, 0]) + np.square(positions[:, 1] - positions[index, 1]))
+
+        def disjointFrom(index):
+            return np.array([cameraIdSets[index].isdisjoint(other) for other in cameraIdSets], dtype=bool)
+
+        positions = np.array([[person['x'], person['y']] for person in people], dtype=np.float64).reshape((-1, 2))
+        distances = np.array([distancesFrom(index) for index in range(len(people))]).reshape((len(people), len(people)))
+        disjoint = np.array([disjointFrom(index) for index in range(len(people))]).reshape((len(people), len(people)))
+        np.fill_diagonal(disjoint, False)
+
+        while True:
+            mergeIndex1 = None
+            mergeIndex2 = None
+            threshold = mergeDistance
+            for index1 in range(len(people)):
+                candidates = np.flatnonzero(disjoint[index1] & (distances[index1] < threshold))
+                if len(candidates) > 0:
+                    mergeIndex1 = index1
+                    mergeIndex2 = int(candidates[0])
+                    threshold = distances[index1, mergeIndex2]
+
+            if mergeIndex1 is None:
+                break
+
+            person1 = people[mergeIndex1]
+            person2 = people[mergeIndex2]
+            person1['x'] = person1['x'] / 2 + person2['x'] / 2
+            person1['y'] = person1['y'] / 2 + person2['y'] / 2
+            person1['detectionIds'] = person1['detectionIds'] + person2['detectionIds']
+            person1['cameraIds'] = person1['cameraIds'] + person2['cameraIds']
+
+            # The feature vectors are summed, and divided by the number of detections at the end
+            if person1['averageFeatureVector'] is not None and person2['averageFeatureVector'] is not None:
+                person1['averageFeatureVector'] = np.array(person1['averageFeatureVector']) + np.array(person2['averageFeatureVector'])
+            elif person1['averageFeatureVector'] is None and person2['averageFeatureVector'] is not None:
+                person1['averageFeatureVector'] = np.array(person2['averageFeatureVector'])
+
+            cameraIdSets[mergeIndex1] |= cameraIdSets[mergeIndex2]
+            positions[mergeIndex1] = [person1['x'], person1['y']]
+
+            del people[mergeIndex2]
+            del cameraIdSets[mergeIndex2]
+            positions = np.delete(positions, mergeIndex2, axis=0)
+            distances = np.delete(np.delete(distances, mergeIndex2, axis=0), mergeIndex2, axis=1)
+            disjoint = np.delete(np.delete(disjoint, mergeIndex2, axis=0), mergeIndex2, axis=1)
+
+            mergedIndex = mergeIndex1 if mergeIndex1 < mergeIndex2 else mergeIndex1 - 1
+            distances[mergedIndex, :] = distancesFrom(mergedIndex)
+            distances[:, mergedIndex] = distances[mergedIndex, :]
+            disjoint[mergedIndex, :] = disjointFrom(mergedIndex)
+            disjoint[:, mergedIndex] = disjoint[mergedIndex, :]
+            disjoint[mergedIndex, mergedIndex] = False
+
+        for person in people:
+            if person['averageFeatureVector'] is not None:
+                person['averageFeatureVector'] = (np.array(person['averageFeatureVector']) / len(person['detectionIds'])).tolist()
+
+        return people
+
     def boundingBoxForPerson(self, keypoints):
         epsilon = 1e-6
         left = min(point[0] for point in keypoints if point[0] != 0 or point[1] != 0) - epsilon
@@ -510,27 +593,58 @@ class ImageAnalyzer:
             "height": bottom-top
         }
 
-    def getKeypointsObject(self, keypointsArray):
-        data = {}
-        for index,keypoint in enumerate(self.keypointNames):
-            data[keypoint] = {
-                "x": keypointsArray[index][0],
-                "y": keypointsArray[index][1]
-            }
+    def computeCacheId(self, image):
+        """ Returns the key for the given image in the detection cache, or None if there is no detection cache."""
+        if self.detectionCache is None:
+            return None
+        return self.detectionCache.computeKey(image, self.detectionModelVersion)
 
-        return data
+    def createPeopleTracker(self, trackerArrays=None):
+        """
+            Creates the Sort tracker which follows the people within a single camera.
 
+            :param trackerArrays: The arrays from Sort.to_arrays to restore the tracker from, or None to create a new tracker
+            :return: The Sort object
+        """
+        parameters = {
+            "max_age": self.hyperParameters['image_tracker_max_age'],
+            "min_hits": self.hyperParameters['image_tracker_min_hits'],
+            "featureVectorSize": self.trackingFeatureDim,
+            "feature_vector_update_speed": self.hyperParameters['image_tracker_feature_vector_update_speed'],
+            "match_score_threshold": self.hyperParameters['image_tracker_match_score_threshold'],
+            "feature_vector_threshold": self.hyperParameters['image_tracker_feature_vector_threshold'],
+            "iou_mode_iou_weight": self.hyperParameters['image_tracker_iou_weight'],
+            "iou_mode_similarity_weight": self.hyperParameters['image_tracker_similarity_weight']
+        }
 
-    def getKeypointsArray(self, keypointsObject):
-        data = []
-        for index,keypoint in enumerate(self.keypointNames):
-            data.append([
-                keypointsObject[keypoint]['x'],
-                keypointsObject[keypoint]['y']
-            ])
+        if trackerArrays is None:
+            return Sort(**parameters)
+        return Sort.from_arrays(trackerArrays, **parameters)
 
-        return data
+    def createStoreMapTracker(self, trackerArrays=None):
+        """
+            Creates the Sort tracker which follows the people on the store map, across all of the cameras.
 
+            :param trackerArrays: The arrays from Sort.to_arrays to restore the tracker from, or None to create a new tracker
+            :return: The Sort object
+        """
+        parameters = {
+            "max_age": self.hyperParameters['store_map_tracker_max_age'],
+            "min_hits": self.hyperParameters['store_map_tracker_min_hits'],
+            "mode": 'euclidean',
+            "featureVectorSize": 128,
+            "new_track_min_dist": self.hyperParameters['store_map_tracker_new_track_min_dist'],
+            "feature_vector_update_speed": self.hyperParameters['store_map_tracker_feature_vector_update_speed'],
+            "match_score_threshold": self.hyperParameters['store_map_tracker_match_score_threshold'],
+            "feature_vector_threshold": self.hyperParameters['store_map_tracker_feature_vector_threshold'],
+            "euclid_threshold": self.hyperParameters['store_map_tracker_euclid_threshold'],
+            "euclid_mode_similarity_weight": self.hyperParameters['store_map_tracker_euclid_mode_similarity_weight'],
+            "euclid_mode_distance_weight": self.hyperParameters['store_map_tracker_euclid_mode_distance_weight']
+        }
+
+        if trackerArrays is None:
+            return Sort(**parameters)
+        return Sort.from_arrays(trackerArrays, **parameters)
 
     def detectPeople(self, image, state, debugImage, cacheId=None):
         """
@@ -540,146 +654,508 @@ class ImageAnalyzer:
             :param image: The image to be processed
             :param state: The current state of the people detector, from the last image. None if there is no current state.
             :param debugImage: The image upon which debug information can be written
-            :param cacheId: The cacheId for person detections, used for speeding up tests and optimization
+            :param cacheId: The key for the person detections in the detection cache, from computeCacheId
             :return: (people, state, debugImage, personImages)
         """
+        result = self.detectPeopleBatch([image], [state], [debugImage], [cacheId])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
-        if not (cacheId is not None and cacheId in self.detectionCache['people']):
+    def detectPeopleBatch(self, images, states, debugImages, cacheIds=None):
+        """
+            This method is the batched version of detectPeople. It processes several images at once, generally one from
+            each camera. All of the images which need the heavy weight detection model on this frame are run through it
+            in a single session call, while the tracking state for each image is kept entirely separate.
+
+            :param images: A list of images to be processed
+            :param states: A list containing the current state of the people detector for each image. None entries if there is no current state.
+            :param debugImages: A list of images upon which debug information can be written, one for each image
+            :param cacheIds: A list of keys for the person detections in the detection cache, from computeCacheId
+            :return: A list with a (people, state, debugImage, personImages) tuple for each image, or the exception raised
+                     while tracking the people in that image
+        """
+        if cacheIds is None:
+            cacheIds = [None] * len(images)
+
+        states = list(states)
+        for index, state in enumerate(states):
+            if not state:
+                state = {
+                    'stateId': str(uuid.uuid4())
+                }
+
+            # Create the tracker if it doesn't exist, restoring it if the state was loaded from a snapshot
+            if 'tracker' not in state:
+                state['tracker'] = self.createPeopleTracker(state.pop('trackerArrays', None))
+
+            state['frameIndex'] = state.get('frameIndex', 0) + 1
+            states[index] = state
+
+        # Images from cameras with nothing moving and nobody being tracked don't need to be looked at any further
+        gatedIndexes = set(index for index, state in enumerate(states) if self.motionGate(images[index], state))
+
+        # Every nth frame, or when the scene changes, we call the heavy weight detection model and feed it to the tracker
+        detectionIndexes = [index for index, state in enumerate(states) if index not in gatedIndexes and self.scheduleDetection(images[index], state)]
+
+        detections = {}
+        uncachedIndexes = []
+        for index in detectionIndexes:
+            cachedDetections = self.detectionCache.get('people', cacheIds[index]) if cacheIds[index] is not None else None
+            if cachedDetections is not None:
+                detections[index] = cachedDetections
+            else:
+                uncachedIndexes.append(index)
+
+        # All the images that weren't cached get run through the CNN together
+        if len(uncachedIndexes) > 0:
             if not self.trackingSession:
                 self.initializeTrackingSession()
-        if not state:
-            state = {
-                'stateId': str(uuid.uuid4())
-            }
 
-        width = len(image)
-        height = len(image[0])
+            uncachedImages = [images[index] for index in uncachedIndexes]
+            peoplePointsBatch, fullFrames = self.estimatePosesInRegions(uncachedImages, [states[index] for index in uncachedIndexes])
+            detectionBoxesBatch = self.computeDetectionBoxesBatch(uncachedImages, peoplePointsBatch)
 
-        # Each person data has {id, keypoints, trackers}
-        currentPeople = state.get('people', [])
+            for index, peoplePoints, (detectionBoxes, featureVectors), fullFrame in zip(uncachedIndexes, peoplePointsBatch, detectionBoxesBatch, fullFrames):
+                detections[index] = {
+                    'detectionBoxes': detectionBoxes,
+                    'featureVectors': featureVectors,
+                    'peoplePoints': peoplePoints
+                }
 
-        # Create the tracker if it doesn't exist
-        if 'tracker' not in state:
-            state['tracker'] = Sort(
-                max_age=self.hyperParameters['image_tracker_max_age'],
-                min_hits=self.hyperParameters['image_tracker_min_hits'],
-                featureVectorSize=self.trackingFeatureDim,
-                feature_vector_update_speed=self.hyperParameters['image_tracker_feature_vector_update_speed'],
-                match_score_threshold=self.hyperParameters['image_tracker_match_score_threshold'],
-                feature_vector_threshold=self.hyperParameters['image_tracker_feature_vector_threshold'],
-                iou_mode_iou_weight=self.hyperParameters['image_tracker_iou_weight'],
-                iou_mode_similarity_weight=self.hyperParameters['image_tracker_similarity_weight'],
-            )
+                # The results from only some regions of the image depend on where the tracker thought people were,
+                # so only the results for the whole image are cached
+                if cacheIds[index] is not None and fullFrame:
+                    self.detectionCache.put('people', cacheIds[index], detections[index])
+
+        results = []
+        for index, image in enumerate(images):
+            if index in gatedIndexes:
+                states[index]['people'] = []
+                results.append(([], states[index], debugImages[index], {}))
+            else:
+                try:
+                    results.append(self.updatePeopleTracking(image, states[index], debugImages[index], detections.get(index, None)))
+                except Exception as e:
+                    results.append(e)
+
+        return results
+
+    def adaptDetectorFrequency(self, queueDepth, batchSize):
+        """
+            Adjusts how often the person detector runs based on how many images are waiting to be processed. Every
+            extra batch worth of images in the queue adds one more frame between detections, up to personDetectorMaxFrequency.
+
+            :param queueDepth: The number of images waiting to be processed
+            :param batchSize: The number of images processed together in one batch
+        """
+        backlog = int(math.ceil(queueDepth / max(1, batchSize)))
+        self.currentDetectorFrequency = max(self.personDetectorFrequency, min(self.personDetectorMaxFrequency, self.personDetectorFrequency + backlog))
+
+    def computeSceneThumbnail(self, image, size=(32, 24)):
+        """ Returns a tiny greyscale version of the image, used to cheaply tell when the scene has changed."""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def motionGate(self, image, state):
+        """
+            Decides whether an image can skip people detection entirely, because nothing in it is moving and nobody
+            is currently being tracked. Each camera keeps a slowly adapting background model in its state, and the
+            image is compared against that on a downscaled greyscale copy.
+
+            :param image: The image being processed
+            :param state: The state of the people detector for this image
+            :return: True if the image can be skipped
+        """
+        if self.motionGateThreshold is None:
+            return False
+
+        thumbnail = self.computeSceneThumbnail(image, size=(80, 60))
+
+        background = state.get('motionBackground', None)
+        if background is None:
+            state['motionBackground'] = thumbnail
+            gated = False
+        else:
+            changedFraction = np.mean(np.abs(thumbnail - background) > self.motionGatePixelThreshold)
+            cv2.accumulateWeighted(thumbnail, background, self.motionGateBackgroundRate)
+
+            tracking = len(state.get('people', [])) > 0 or len(state['tracker'].trackers) > 0
+            gated = bool(not tracking and changedFraction < self.motionGateThreshold)
+
+        if gated:
+            self.motionGateCounters['gated'] += 1
+        else:
+            self.motionGateCounters['processed'] += 1
+
+        return gated
+
+    def scheduleDetection(self, image, state):
+        """
+            Decides whether the person detector should be run on the given image, or whether the people from the last
+            frame can be moved along by their trackers instead. Updates the scheduling information in the state.
+
+            :param image: The image being processed
+            :param state: The state of the people detector for this image
+            :return: True if the detector should be run on this image
+        """
+        frequency = max(self.currentDetectorFrequency, self.personDetectorFrequency)
+
+        thumbnail = None
+        if frequency <= 1:
+            runDetector = True
+        elif 'framesSinceDetection' not in state or state['framesSinceDetection'] + 1 >= frequency:
+            runDetector = True
+        elif self.sceneChangeThreshold is not None:
+            thumbnail = self.computeSceneThumbnail(image)
+            runDetector = bool(np.mean(np.abs(thumbnail - state['detectionThumbnail'])) > self.sceneChangeThreshold)
+        else:
+            runDetector = False
+
+        if runDetector:
+            state['framesSinceDetection'] = 0
+            if frequency > 1 and self.sceneChangeThreshold is not None:
+                state['detectionThumbnail'] = thumbnail if thumbnail is not None else self.computeSceneThumbnail(image)
+        else:
+            state['framesSinceDetection'] += 1
 
+        return runDetector
+
+    def propagatePeople(self, image, state, people, trackedBoxes):
+        """
+            Moves the people from the last frame along to the current frame, for frames where the detector wasn't run.
+            Each persons keypoints are shifted and scaled along with the Kalman prediction of their tracked box. If
+            optical flow is enabled, the keypoints which can be followed from the previous image are refined with it.
+
+            :param image: The current image
+            :param state: The state of the people detector for this image
+            :param people: The list of PersonDetection objects from the last frame
+            :param trackedBoxes: The predicted boxes from Sort.propagate, [[x1,y1,x2,y2,object_id],...]
+            :return: A list of PersonDetection objects for the current frame
+        """
+        predictedBoxes = {str(int(box[4])): box[:4] for box in trackedBoxes}
+
+        flowPoints = None
+        if self.keypointOpticalFlowEnabled and state.get('previousGrayImage', None) is not None and len(people) > 0:
+            previousPoints = np.concatenate([person.keypoints for person in people]).reshape(-1, 1, 2)
+            flowPoints, flowStatus, flowError = cv2.calcOpticalFlowPyrLK(state['previousGrayImage'], state['grayImage'], previousPoints, None)
+            flowPoints = flowPoints.reshape(len(people), len(self.keypointNames), 2)
+            flowStatus = flowStatus.reshape(len(people), len(self.keypointNames)).astype(bool)
+
+        newPeople = []
+        for personIndex, person in enumerate(people):
+            box = predictedBoxes.get(person.detectionId, None)
+            if box is None:
+                # The tracker for this person has been dropped
+                continue
+
+            oldBox = person.boundingBox
+            oldSize = np.maximum(oldBox[2:4] - oldBox[0:2], 1e-6)
+            newSize = box[2:4] - box[0:2]
+
+            scale = newSize / oldSize
+            oldCenter = (oldBox[0:2] + oldBox[2:4]) / 2
+            newCenter = (box[0:2] + box[2:4]) / 2
+
+            detected = np.any(person.keypoints != 0, axis=1)
+
+            keypoints = np.zeros_like(person.keypoints)
+            keypoints[detected] = (person.keypoints[detected] - oldCenter) * scale + newCenter
+
+            if flowPoints is not None:
+                followed = detected & flowStatus[personIndex]
+                keypoints[followed] = flowPoints[personIndex][followed]
+
+            boundingBox = np.concatenate([(oldBox[0:2] - oldCenter) * scale + newCenter, (oldBox[2:4] - oldCenter) * scale + newCenter])
+
+            newPeople.append(PersonDetection(person.detectionId, keypoints, person.featureVector, boundingBox))
+
+        return newPeople
+
+    def computePoseRegions(self, image, state):
+        """
+            Computes the regions of the image that the pose network should be run on, when region of interest inference is enabled.
+
+            :param image: The image being processed
+            :param state: The state of the people detector for this image
+            :return: A list of [left, top, right, bottom] integer regions, or None if the full image should be processed
+        """
+        imageHeight, imageWidth = image.shape[:2]
         tracker = state['tracker']
 
-        # Every nth frame, we call the heavy weight detection model and feed it to the tracker
-        frameIndex = state.get('frameIndex', 0)
-        frameIndex += 1
-        if frameIndex % self.personDetectorFrequency == 0:
-            time = datetime.now()
+        framesSinceFullFrame = state.get('detectionsSinceFullFrame', None)
+        if framesSinceFullFrame is None or framesSinceFullFrame + 1 >= self.roiFullFrameInterval or (len(tracker.trackers) == 0 and len(self.roiEntryZones) == 0):
+            state['detectionsSinceFullFrame'] = 0
+            return None
 
-            detectionBoxes = []
-            featureVectors = []
-            newPeople = []
-            peoplePoints = []
-            if cacheId is not None and cacheId in self.detectionCache['people']:
-                detectionBoxes = self.detectionCache['people'][cacheId]['detectionBoxes']
-                featureVectors = self.detectionCache['people'][cacheId]['featureVectors']
-                peoplePoints = self.detectionCache['people'][cacheId]['peoplePoints']
-            else:
-                # Only make these imports if we have to
-                from multiperson.predict import eval_graph, get_person_conf_multicut
-                from multiperson.detections import extract_detections
-                from dataset.pose_dataset import data_to_input
-                from nnet import predict
+        boxes = []
+        for trk in tracker.trackers:
+            left, top, right, bottom = trk.get_state()[0]
+            if np.any(np.isnan([left, top, right, bottom])):
+                continue
+
+            paddingX = (right - left) * self.roiPadding
+            paddingY = (bottom - top) * self.roiPadding
+            boxes.append([left - paddingX, top - paddingY, right + paddingX, bottom + paddingY])
+
+        for zone in self.roiEntryZones:
+            boxes.append([zone[0] * imageWidth, zone[1] * imageHeight, zone[2] * imageWidth, zone[3] * imageHeight])
+
+        # Overlapping regions are merged, so that nobody is detected twice in two different crops
+        merged = True
+        while merged:
+            merged = False
+            for first in range(len(boxes)):
+                for second in range(first + 1, len(boxes)):
+                    a = boxes[first]
+                    b = boxes[second]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        boxes[first] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del boxes[second]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        regions = []
+        for left, top, right, bottom in boxes:
+            left, top = max(0, int(left)), max(0, int(top))
+            right, bottom = min(imageWidth, int(math.ceil(right))), min(imageHeight, int(math.ceil(bottom)))
+            if right > left and bottom > top:
+                regions.append([left, top, right, bottom])
+
+        # If the regions cover most of the image anyway, there is nothing to be saved by cropping
+        if sum((right - left) * (bottom - top) for left, top, right, bottom in regions) >= 0.75 * imageWidth * imageHeight:
+            state['detectionsSinceFullFrame'] = 0
+            return None
+
+        state['detectionsSinceFullFrame'] = framesSinceFullFrame + 1
+        return regions
+
+    def estimatePosesInRegions(self, images, states):
+        """
+            Runs the pose detection CNN over a batch of images. When region of interest inference is enabled, only the
+            regions from computePoseRegions are run through the network, and the keypoints are mapped back into image coordinates.
+
+            :param images: A list of numpy images
+            :param states: The state of the people detector for each image
+            :return: (peoplePointsBatch, fullFrames) - A list with a [people, 17, 2] array of keypoints for each of the
+                     images, and a list which is True for each image that was run through the network in full
+        """
+        if not self.roiInferenceEnabled:
+            return self.estimatePosesBatch(images), [True] * len(images)
+
+        regionImages = []
+        regionLocations = []
+        fullFrames = []
+        for imageIndex, (image, state) in enumerate(zip(images, states)):
+            regions = self.computePoseRegions(image, state)
+            fullFrames.append(regions is None)
+            if regions is None:
+                regionImages.append(image)
+                regionLocations.append((imageIndex, 0, 0))
+                continue
+
+            for left, top, right, bottom in regions:
+                height = int(math.ceil((bottom - top) / self.roiShapeQuantum) * self.roiShapeQuantum)
+                width = int(math.ceil((right - left) / self.roiShapeQuantum) * self.roiShapeQuantum)
+
+                regionImage = np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+                regionImage[:bottom - top, :right - left] = image[top:bottom, left:right]
+
+                regionImages.append(regionImage)
+                regionLocations.append((imageIndex, left, top))
+
+        regionPoints = self.estimatePosesBatch(regionImages)
+
+        results = [[] for image in images]
+        for (imageIndex, left, top), peoplePoints in zip(regionLocations, regionPoints):
+            for person in peoplePoints:
+                person = np.array(person, dtype=np.float64)
+                detected = np.any(person != 0, axis=1)
+                person[detected] += [left, top]
+                results[imageIndex].append(person)
+
+        return [np.array(peoplePoints) for peoplePoints in results], fullFrames
+
+    def estimatePosesBatch(self, images):
+        """
+            Runs the pose detection CNN over a batch of images, producing the keypoints for every person in each image.
+            Images which have the same dimensions are stacked together, so the session is only launched once for each
+            group of up to poseMaxBatchSize images.
+
+            :param images: A list of numpy images
+            :return: A list with a [people, 17, 2] array of keypoints for each of the images
+        """
+        # Only make these imports if we have to
+        from multiperson.predict import eval_graph, get_person_conf_multicut
+        from multiperson.detections import extract_detections
+        from nnet import predict
+
+        results = [None] * len(images)
+
+        # The CNN can only accept a batch of images with matching dimensions, so group them by shape first
+        imageIndexesByShape = {}
+        for index, image in enumerate(images):
+            imageIndexesByShape.setdefault(image.shape, []).append(index)
+
+        for shape, imageIndexes in imageIndexesByShape.items():
+            for batchStart in range(0, len(imageIndexes), self.poseMaxBatchSize):
+                batchIndexes = imageIndexes[batchStart:batchStart + self.poseMaxBatchSize]
 
                 # Compute prediction with the CNN
-                image_batch = data_to_input(image)
-                outputs_np = self.poseSess.run(self.poseOutputs, feed_dict={self.poseInputs: image_batch})
-                scmap, locref, pairwise_diff = predict.extract_cnn_output(outputs_np, self.cfg, self.dataset.pairwise_stats)
+                image_batch = np.stack([images[index] for index in batchIndexes]).astype(float)
+                with traceStage(None, 'pose_inference'):
+                    outputs_np = self.poseSess.run(self.poseOutputs, feed_dict={self.poseInputs: image_batch})
 
-                # Convert the cnn output into the set of detected people
-                detections = extract_detections(self.cfg, scmap, locref, pairwise_diff)
-                unLab, pos_array, unary_array, pwidx_array, pw_array = eval_graph(self.sm, detections)
-                peoplePoints = get_person_conf_multicut(self.sm, unLab, unary_array, pos_array)
+                for batchIndex, imageIndex in enumerate(batchIndexes):
+                    # extract_cnn_output expects the outputs for a single image, so slice it out of the batch
+                    imageOutputs = [output[batchIndex:batchIndex + 1] for output in outputs_np]
+                    scmap, locref, pairwise_diff = predict.extract_cnn_output(imageOutputs, self.cfg, self.dataset.pairwise_stats)
 
-                # Filter out detections that have less then 4 keypoints ( use /2 here because there are two dimensions, x and y)
-                peoplePoints = np.array([person for person in peoplePoints if (np.count_nonzero(person) / 2) >= self.hyperParameters['image_tracker_min_keypoints']])
+                    # Convert the cnn output into the set of detected people
+                    detections = extract_detections(self.cfg, scmap, locref, pairwise_diff)
+                    unLab, pos_array, unary_array, pwidx_array, pw_array = eval_graph(self.sm, detections)
+                    peoplePoints = get_person_conf_multicut(self.sm, unLab, unary_array, pos_array)
 
-                # Now feed these detections through the tracker
-                for detectedPersonIndex, detectedPerson in enumerate(peoplePoints):
-                    # Compute this persons outer bounding box
-                    box = self.boundingBoxForPerson(detectedPerson)
+                    # Filter out detections that have less then 4 keypoints ( use /2 here because there are two dimensions, x and y)
+                    peoplePoints = np.array([person for person in peoplePoints if (np.count_nonzero(person) / 2) >= self.hyperParameters['image_tracker_min_keypoints']])
 
-                    detection = np.array([box['left'], box['top'], box['right'], box['bottom'], 1.0] + [0] * self.trackingFeatureDim)  # the middle entry is the score, which doesn't matter for this trackker. Feature vector after that.
+                    results[imageIndex] = peoplePoints
 
-                    croppedPerson = self.extractTrackingCrop(image, detection[:4], self.trackingImageShape[:-1])
-                    if croppedPerson is not None:
-                        featureVector = self.trackingSession.run(self.trackingOutputVar, feed_dict={self.trackingInputVar: [croppedPerson]})
-                        detection[5:] = featureVector[0]
-                        featureVectors.append(featureVector[0].tolist())
-                    else:
-                        featureVectors.append(None)
+        return results
 
-                    detectionBoxes.append(detection)
+    def computeDetectionBoxesBatch(self, images, peoplePointsBatch):
+        """
+            Computes the tracker detection box and tracking feature vector for each of the people detected in a batch of images.
+            The crops of every person across all of the images are run through the feature extractor together in one session call.
 
-            if cacheId is not None:
-                self.detectionCache['people'][cacheId] = {
-                    'detectionBoxes': detectionBoxes,
-                    'featureVectors': featureVectors,
-                    'peoplePoints': peoplePoints
-                }
+            :param images: The list of images the people were detected in
+            :param peoplePointsBatch: The keypoints for each detected person in each image, as returned by estimatePosesBatch
+            :return: A list of (detectionBoxes, featureVectors) tuples, one for each image
+        """
+        detectionBoxesBatch = []
+        featureVectorsBatch = []
+
+        trackingCrops = []
+        trackingCropLocations = []
+
+        for imageIndex, (image, peoplePoints) in enumerate(zip(images, peoplePointsBatch)):
+            detectionBoxes = []
+            for detectedPersonIndex, detectedPerson in enumerate(peoplePoints):
+                # Compute this persons outer bounding box
+                box = self.boundingBoxForPerson(detectedPerson)
+
+                detection = np.array([box['left'], box['top'], box['right'], box['bottom'], 1.0] + [0] * self.trackingFeatureDim)  # the middle entry is the score, which doesn't matter for this trackker. Feature vector after that.
+
+                croppedPerson = self.extractTrackingCrop(image, detection[:4], self.trackingImageShape[:-1])
+                if croppedPerson is not None:
+                    trackingCrops.append(croppedPerson)
+                    trackingCropLocations.append((imageIndex, detectedPersonIndex))
 
-            for box in detectionBoxes:
-                cv2.rectangle(debugImage, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 0, 255), 3)
+                detectionBoxes.append(detection)
+
+            detectionBoxesBatch.append(detectionBoxes)
+            featureVectorsBatch.append([None] * len(detectionBoxes))
+
+        # Now compute all of the feature vectors at once, and put them back with the person they came from
+        featureVectors = self.extractFeatureVectors(trackingCrops)
+        for (imageIndex, detectedPersonIndex), featureVector in zip(trackingCropLocations, featureVectors):
+            detectionBoxesBatch[imageIndex][detectedPersonIndex][5:] = featureVector
+            featureVectorsBatch[imageIndex][detectedPersonIndex] = featureVector
+
+        return list(zip(detectionBoxesBatch, featureVectorsBatch))
+
+    def extractFeatureVectors(self, trackingCrops):
+        """
+            Runs the deep-sort appearance model over a list of tracking crops, as produced by extractTrackingCrop.
+
+            :param trackingCrops: A list of cropped images of people
+            :return: A [len(trackingCrops), trackingFeatureDim] numpy array of feature vectors
+        """
+        if len(trackingCrops) == 0:
+            return np.zeros((0, self.trackingFeatureDim))
+
+        featureVectors = []
+        for batchStart in range(0, len(trackingCrops), self.trackingMaxBatchSize):
+            batch = np.stack(trackingCrops[batchStart:batchStart + self.trackingMaxBatchSize])
+            with traceStage(None, 'feature_extraction'):
+                featureVectors.append(self.trackingSession.run(self.trackingOutputVar, feed_dict={self.trackingInputVar: batch}))
+
+        return np.concatenate(featureVectors)
+
+    def updatePeopleTracking(self, image, state, debugImage, detection):
+        """
+            Feeds the detections for a single image into that images tracker, and gathers up the images of each person.
+
+            :param image: The image that was processed
+            :param state: The state of the people detector for this image
+            :param debugImage: The image upon which debug information can be written, or None to skip drawing
+            :param detection: A dictionary with the detectionBoxes, featureVectors and peoplePoints for this image, or None if the detector didn't run on this frame
+            :return: (people, state, debugImage, personImages)
+        """
+        width = len(image)
+        height = len(image[0])
+
+        # Each person data has {id, keypoints, trackers}
+        currentPeople = state.get('people', [])
+
+        tracker = state['tracker']
+
+        if self.keypointOpticalFlowEnabled:
+            state['previousGrayImage'] = state.get('grayImage', None)
+            state['grayImage'] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        if detection is not None:
+            detectionBoxes = detection['detectionBoxes']
+            featureVectors = detection['featureVectors']
+            peoplePoints = detection['peoplePoints']
+            newPeople = []
 
             trackedBoxes = tracker.update(np.array(detectionBoxes))
 
-            trackedVectors = [box[5] != -1 and featureVectors[int(box[5])] or None for box in trackedBoxes]
+            trackedVectors = [featureVectors[int(box[5])] if box[5] != -1 else None for box in trackedBoxes]
+
+            if debugImage is not None:
+                for box in detectionBoxes:
+                    cv2.rectangle(debugImage, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 0, 255), 3)
 
-            for box in trackedBoxes:
-                cv2.rectangle(debugImage, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 255, 0), 3)
+                for box in trackedBoxes:
+                    cv2.rectangle(debugImage, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 255, 0), 3)
 
-                textX = int(box[0]) + 10
-                textY = int(box[1]) + 35
+                    textX = int(box[0]) + 10
+                    textY = int(box[1]) + 35
 
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                cv2.putText(debugImage, str(int(box[4])), (textX, textY), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
+                    font = cv2.FONT_HERSHEY_SIMPLEX
+                    cv2.putText(debugImage, str(int(box[4])), (textX, textY), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
 
             # Now we have a bunch of tracked boxes. Find which person goes with which tracked box
             for boxIndex, box in enumerate(trackedBoxes):
                 if int(box[5]) >= 0:
                     person = peoplePoints[int(box[5])]
-                    personData = {
-                        'detectionId': str(int(box[4])),
-                        'keypoints': self.getKeypointsObject(person),
-                        "bounding_box": self.boundingBoxForPerson(person),
-                        "featureVector": trackedVectors[boxIndex]
-                    }
-                    newPeople.append(personData)
+                    newPeople.append(PersonDetection(str(int(box[4])), person, trackedVectors[boxIndex]))
 
             currentPeople = newPeople
 
             # self.draw_multi.draw(debugImage, self.dataset, peoplePoints)
         else:
-            for person in currentPeople:
-                box = person['bounding_box']
-                cv2.rectangle(debugImage, (int(box['left']), int(box['top'])), (int(box['right']), int(box['bottom'])), (0, 255, 0), 3)
+            # The detector wasn't run on this frame, so move people along based on the predictions from the trackers
+            currentPeople = self.propagatePeople(image, state, currentPeople, tracker.propagate())
 
-                textX = int(box['left']) + 10
-                textY = int(box['top']) + 35
+            if debugImage is not None:
+                for person in currentPeople:
+                    box = person.boundingBox
+                    cv2.rectangle(debugImage, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (255, 255, 0), 3)
 
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                cv2.putText(debugImage, str(int(person['id'])), (textX, textY), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
+                    textX = int(box[0]) + 10
+                    textY = int(box[1]) + 35
 
-            # Draw people the based the result from the trackers
-            if len(currentPeople) == 0:
-                peoplePoints = np.reshape(np.array([]), newshape=[0, 2])
-            else:
-                peoplePoints = np.reshape(np.array([[self.getKeypointsArray(person['keypoints']) for person in currentPeople]]), newshape=[len(currentPeople), 17, 2])
+                    font = cv2.FONT_HERSHEY_SIMPLEX
+                    cv2.putText(debugImage, person.detectionId, (textX, textY), font, 1, (255, 255, 0), 2, cv2.LINE_AA)
 
-            self.draw_multi.draw(debugImage, self.dataset, peoplePoints)
+                    for keypoint in person.keypoints:
+                        if np.any(keypoint != 0):
+                            cv2.circle(debugImage, (int(keypoint[0]), int(keypoint[1])), 3, (255, 255, 0), -1)
 
         # Now, grab an image of each person detection.
         # If the person detection has more points then has been detected for that person before,
@@ -690,26 +1166,28 @@ class ImageAnalyzer:
 
         personImages = {}
         for person in currentPeople:
-            bestImage = state['bestImages'].get(person['detectionId'], None)
+            bestImage = state['bestImages'].get(person.detectionId, None)
+
+            personLeft, personTop, personRight, personBottom = person.boundingBox
 
-            personWidth = person['bounding_box']['right'] - person['bounding_box']['left']
-            personHeight = person['bounding_box']['bottom'] - person['bounding_box']['top']
+            personWidth = personRight - personLeft
+            personHeight = personBottom - personTop
 
             cropWidth = max(150, personWidth + 100)
             cropHeight = max(150, personHeight + 100)
 
-            centerX = person['bounding_box']['left']/2 + person['bounding_box']['right']/2
-            centerY = person['bounding_box']['top']/2 + person['bounding_box']['bottom']/2
+            centerX = personLeft/2 + personRight/2
+            centerY = personTop/2 + personBottom/2
 
             cropTop = max(0, centerY - cropHeight / 2)
             cropBottom = min(centerY + cropHeight /2, height - 1)
             cropLeft = max(0, centerX - cropWidth/2)
             cropRight = min(centerX + cropWidth / 2, width - 1)
 
-            personWithinCropLeft = person['bounding_box']['left'] - cropLeft
-            personWithinCropRight = person['bounding_box']['right'] - cropLeft
-            personWithinCropTop = person['bounding_box']['top'] - cropTop
-            personWithinCropBottom = person['bounding_box']['bottom'] - cropTop
+            personWithinCropLeft = personLeft - cropLeft
+            personWithinCropRight = personRight - cropLeft
+            personWithinCropTop = personTop - cropTop
+            personWithinCropBottom = personBottom - cropTop
 
             # If we can't get a decent sized cropped image, and there is already an
             # image, then ignore this one.
@@ -722,55 +1200,59 @@ class ImageAnalyzer:
             cv2.rectangle(croppedImage, (int(personWithinCropLeft), int(personWithinCropTop)), (int(personWithinCropRight), int(personWithinCropBottom)), (0, 255, 0), 3)
 
             try:
-                blur_map, score, blurry = estimate_blur(croppedImage)
+                with traceStage(None, 'blur_estimation'):
+                    blur_map, score, blurry = estimate_blur(croppedImage)
             except cv2.error:
                 # Ignore error, assume maximum blurriness
                 score = 0
 
-            points = 0
-            for key in self.keypointNames:
-                if person['keypoints'][key]['x'] and person['keypoints'][key]['y']:
-                    points += 1
+            points = person.keypointCount()
 
             if bestImage is None:
-                personImages[person['detectionId']] = croppedImage
-                state['bestImages'][person['detectionId']] = {
+                personImages[person.detectionId] = croppedImage
+                state['bestImages'][person.detectionId] = {
                     'points': points,
                     'blurriness': score
                 }
             elif points > (bestImage['points'] + 1):
-                personImages[person['detectionId']] = croppedImage
-                state['bestImages'][person['detectionId']] = {
+                personImages[person.detectionId] = croppedImage
+                state['bestImages'][person.detectionId] = {
                     'points': points,
                     'blurriness': score
                 }
             elif points >= (bestImage['points']) and score > bestImage['blurriness']:
-                personImages[person['detectionId']] = croppedImage
-                state['bestImages'][person['detectionId']] = {
+                personImages[person.detectionId] = croppedImage
+                state['bestImages'][person.detectionId] = {
                     'points': points,
                     'blurriness': score
                 }
 
         state['people'] = currentPeople
-        state['frameIndex'] = frameIndex
 
         return currentPeople, state, debugImage, personImages
 
 
-    def detectCalibrationObject(self, image, state, debugImage, cacheId=None):
+    def detectCalibrationObject(self, image, state, debugImage, cacheId=None, imageScale=1):
         """
             Tries to detect the presence of the calibration object, which is just a standard checkerboard pattern.
 
             :param image: A standard np image array, [width, height, batchSize]
             :param state: The current state of the calibration object detector, from the last image. None if there is no current state.
-            :param debugImage: An image upon which the debugging information can be written
-            :return (calibrationData, state, debugImage)
+            :param debugImage: An image upon which the debugging information can be written, or None to skip drawing
+            :param cacheId: The key for the calibration object in the detection cache, from computeCacheId
+            :param imageScale: How many times smaller the image is then the original camera image
+            :return (calibrationData, state, debugImage). The new state holds the corners of the calibration object found
+                    in this image, or None, so that it can be drawn later with drawCalibrationObject.
         """
-        if cacheId is not None:
-            if cacheId in self.detectionCache['calibrationObjects']:
-                return self.detectionCache['calibrationObjects'][cacheId]
+        chessBoardSize = self.calibrationChessBoardSize
 
-        chessBoardSize = (4,6)
+        if cacheId is not None:
+            cached = self.detectionCache.get('calibrationObjects', cacheId)
+            if cached is not None:
+                calibrationObject, corners = cached
+                if debugImage is not None and corners is not None:
+                    self.drawCalibrationObject(debugImage, corners)
+                return (calibrationObject, {"corners": corners}, debugImage)
 
         # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
         objp = np.zeros((chessBoardSize[0] * chessBoardSize[1], 3), np.float32)
@@ -793,10 +1275,11 @@ class ImageAnalyzer:
             cameraRotationVector = None
             cameraTranslationVector = None
 
-            (ret, cameraRotationVector, cameraTranslationVector) = cv2.solvePnP(objp, corners, cameraMatrix, cameraDistortionCoefficients)
+            (ret, cameraRotationVector, cameraTranslationVector) = cv2.solvePnP(objp, corners * imageScale, cameraMatrix, cameraDistortionCoefficients)
 
             # Update the debug image with the calibration object drawn on
-            cv2.drawChessboardCorners(debugImage, chessBoardSize, corners, found)
+            if debugImage is not None:
+                self.drawCalibrationObject(debugImage, corners)
 
             calibrationObject = {
                 "cameraMatrix": cameraMatrix.tolist(),
@@ -806,9 +1289,18 @@ class ImageAnalyzer:
             }
 
         if cacheId is not None:
-            self.detectionCache['calibrationObjects'][cacheId] = (calibrationObject, state, debugImage)
+            self.detectionCache.put('calibrationObjects', cacheId, (calibrationObject, corners if found else None))
+
+        return (calibrationObject, {"corners": corners if found else None}, debugImage)
 
-        return (calibrationObject, state, debugImage)
+    def drawCalibrationObject(self, debugImage, corners):
+        """
+            Draws the calibration object onto a debug image.
+
+            :param debugImage: The image to draw on
+            :param corners: The corners of the calibration object, from the state returned by detectCalibrationObject
+        """
+        cv2.drawChessboardCorners(debugImage, self.calibrationChessBoardSize, corners, True)
 
 
     def processMultiCameraFrameTimeSeries(self, multiCameraFrame, state, storeConfiguration):
@@ -816,24 +1308,13 @@ class ImageAnalyzer:
             This method is used to process the sequence of multi-camera-frame objects. It creates TimeSeriesFrame objects.
 
             :param multiCameraFrame: The current multi camera frame.
-            :param state: The current state of the multi-camera-frame system. This contains arbitrary data which can be pickled in python
+            :param state: The current state of the multi-camera-frame system. This contains arbitrary data which can be pickled in python.
+                          The tracker can be given either as a Sort object, or under trackerArrays as the arrays from Sort.to_arrays
             :param storeConfiguration: The store configuration
             :return: (timeSeriesFrame, state)
         """
         if 'tracker' not in state:
-            state['tracker'] = Sort(
-                max_age=self.hyperParameters['store_map_tracker_max_age'],
-                min_hits=self.hyperParameters['store_map_tracker_min_hits'],
-                mode='euclidean',
-                featureVectorSize=128,
-                new_track_min_dist=self.hyperParameters['store_map_tracker_new_track_min_dist'],
-                feature_vector_update_speed=self.hyperParameters['store_map_tracker_feature_vector_update_speed'],
-                match_score_threshold=self.hyperParameters['store_map_tracker_match_score_threshold'],
-                feature_vector_threshold=self.hyperParameters['store_map_tracker_feature_vector_threshold'],
-                euclid_threshold=self.hyperParameters['store_map_tracker_euclid_threshold'],
-                euclid_mode_similarity_weight=self.hyperParameters['store_map_tracker_euclid_mode_similarity_weight'],
-                euclid_mode_distance_weight=self.hyperParameters['store_map_tracker_euclid_mode_distance_weight']
-            )
+            state['tracker'] = self.createStoreMapTracker(state.pop('trackerArrays', None))
 
         if 'people' not in state:
             state['people'] = {}
@@ -18,6 +18,9 @@ import subprocess
 
 import pika
 import sys
+from ebretail.components.metrics import traceStage
+from ebretail.components.frame_encoding import encodeCameraImage
+from ebretail.components.camera_shard_router import CameraShardRouter
 
 class ImageCollector:
     """
@@ -29,7 +32,9 @@ class ImageCollector:
     """
     def __init__(self):
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=32)
-        self.imageProcessorUrl = "http://localhost:1845/process_image"
+        # Each camera is always sent to the same image processor, which keeps the tracking state for it
+        self.imageProcessorUrls = ["http://localhost:1845"]
+        self.imageProcessorRouter = CameraShardRouter(self.imageProcessorUrls, handOverCamera=lambda cameraId, oldUrl, newUrl: self.handOverCamera(cameraId, oldUrl, newUrl))
         self.registrationUrl = "http://localhost:1806/register_collector"
         self.amqpUri = "localhost"
         self.metadata = {
@@ -43,11 +48,20 @@ class ImageCollector:
         self.collectionFrequency = 250
         self.uploadTimeout = 5
 
+        # An image processor is taken out of the rotation after this many uploads to it fail in a row, and its cameras
+        # are handed over to the others. It is checked again every imageProcessorRetryInterval seconds, and put back once it answers.
+        self.maxUploadFailures = 3
+        self.imageProcessorRetryInterval = 30
+        self.uploadFailures = {}
+        self.failedImageProcessorUrls = set()
+        self.imageProcessorLock = threading.Lock()
+
         self.bannedCameras = ['USB2.0 HD UVC WebCam: USB2.0 HD'] # This represents my laptop camera
 
         self.amqpThread = threading.Thread(target=lambda: self.amqpConnectionThread(), daemon=True)
         self.networkScanningThread = threading.Thread(target=lambda: self.scanNetworkThread(), daemon=True)
         self.localScanningThread = threading.Thread(target=lambda: self.scanLocalThread(), daemon=True)
+        self.imageProcessorCheckThread = threading.Thread(target=lambda: self.checkImageProcessorsThread(), daemon=True)
         
         self.detectedNetworkCameras = []
         self.detectedLocalCameras = []
@@ -291,6 +305,7 @@ class ImageCollector:
         # First, start up threads for network and local usb scanning. 
         self.networkScanningThread.start()
         self.localScanningThread.start()
+        self.imageProcessorCheckThread.start()
 
         self.synchronizeLocalCameras()
         self.synchronizeNetworkCameras()
@@ -323,7 +338,9 @@ class ImageCollector:
                     self.register()
 
                 # Capture all the images
+                captureStart = time.perf_counter()
                 capturedImages = self.captureImages()
+                captureTime = time.perf_counter() - captureStart
 
                 # Wait for last frames images to finish being uploaded
                 for future in concurrent.futures.as_completed(uploadFutures):
@@ -344,30 +361,128 @@ class ImageCollector:
                         record = True
                         self.recordNextImage[cameraId] = False
 
-                    uploadFutures.append(self.executor.submit(lambda image, id, time, record: self.uploadImageToProcessor(image, id, time, record), image.astype('uint8'), cameraId, nextFrameTime, record))
+                    uploadFutures.append(self.executor.submit(lambda image, id, time, record, stageTimings: self.uploadImageToProcessor(image, id, time, record, stageTimings), image.astype('uint8'), cameraId, nextFrameTime, record, {"capture": captureTime}))
 
                 lastFrameTime = nextFrameTime
             except Exception as e:
                 print('capture error', traceback.format_exc())
 
 
-    def uploadImageToProcessor(self, image, cameraId, timeStamp, record):
+    def setImageProcessors(self, imageProcessorUrls):
+        """
+            Changes the set of image processors that images are sent to. The tracking state for each camera which
+            now belongs to a different image processor is handed over to it first.
+
+            :param imageProcessorUrls: The base URLs of the image processors
+        """
+        with self.imageProcessorLock:
+            self.imageProcessorUrls = list(imageProcessorUrls)
+            self.uploadFailures = {}
+            self.failedImageProcessorUrls = set()
+        self.imageProcessorRouter.setShards(self.imageProcessorUrls)
+
+    def recordUploadResult(self, imageProcessorUrl, success):
+        """
+            Keeps count of the uploads which failed in a row for each image processor, and takes an image processor
+            out of the rotation when it reaches maxUploadFailures. Its cameras are handed over to the remaining
+            image processors, unless it is the only one left.
+
+            :param imageProcessorUrl: The base URL of the image processor the image was uploaded to
+            :param success: Whether the upload succeeded
+        """
+        with self.imageProcessorLock:
+            if success:
+                self.uploadFailures[imageProcessorUrl] = 0
+                return
+
+            self.uploadFailures[imageProcessorUrl] = self.uploadFailures.get(imageProcessorUrl, 0) + 1
+            if self.uploadFailures[imageProcessorUrl] < self.maxUploadFailures or imageProcessorUrl in self.failedImageProcessorUrls:
+                return
+
+            if len(self.failedImageProcessorUrls) + 1 >= len(self.imageProcessorUrls):
+                return
+
+            self.failedImageProcessorUrls.add(imageProcessorUrl)
+
+        print("Image processor " + imageProcessorUrl + " is failing, handing over its cameras")
+        self.imageProcessorRouter.removeShard(imageProcessorUrl)
+
+    def checkImageProcessors(self):
+        """ Puts every image processor which was taken out of the rotation back in, once it answers again."""
+        with self.imageProcessorLock:
+            failedUrls = list(self.failedImageProcessorUrls)
+
+        for imageProcessorUrl in failedUrls:
+            try:
+                requests.get(imageProcessorUrl + "/forwarding_status", timeout=self.uploadTimeout).raise_for_status()
+            except Exception as e:
+                continue
+
+            with self.imageProcessorLock:
+                if imageProcessorUrl not in self.failedImageProcessorUrls:
+                    continue
+                self.failedImageProcessorUrls.discard(imageProcessorUrl)
+                self.uploadFailures[imageProcessorUrl] = 0
+
+            print("Image processor " + imageProcessorUrl + " is back, handing its cameras back to it")
+            self.imageProcessorRouter.addShard(imageProcessorUrl)
+
+    def checkImageProcessorsThread(self):
+        while True:
+            time.sleep(self.imageProcessorRetryInterval)
+            try:
+                self.checkImageProcessors()
+            except Exception as e:
+                print('image processor check error', traceback.format_exc())
+
+    def handOverCamera(self, cameraId, oldUrl, newUrl):
+        """
+            Moves the tracking state for a camera from one image processor to another. The new image processor is
+            always told it has the camera, even when the old one had no state for it or can't be reached, so that
+            it doesn't keep discarding the cameras images from when it handed the camera over in the past.
+        """
+        snapshot = b''
+        try:
+            r = requests.get(oldUrl + "/camera_state", params={"cameraId": cameraId}, timeout=self.uploadTimeout)
+            if r.status_code != 404:
+                r.raise_for_status()
+                snapshot = r.content
+        except Exception as e:
+            # The camera just starts tracking from scratch on its new image processor
+            print("Failed to get the state for " + cameraId + " from " + oldUrl + ": " + str(e), traceback.format_exc())
+
+        try:
+            requests.put(newUrl + "/camera_state", params={"cameraId": cameraId}, data=snapshot, timeout=self.uploadTimeout).raise_for_status()
+            print(cameraId + "  Handed over from " + oldUrl + " to " + newUrl)
+        except Exception as e:
+            print("Failed to hand over " + cameraId + " to " + newUrl + ": " + str(e), traceback.format_exc())
+
+    def uploadImageToProcessor(self, image, cameraId, timeStamp, record, stageTimings=None):
+        """
+            :param stageTimings: The time taken by earlier stages for this image, which are sent along in the metadata for the image processor to record
+        """
+        imageProcessorUrl = None
         try:
             print(cameraId + "  Starting upload " + timeStamp.strftime("%Y-%m-%dT%H:%M:%S.%f"))
-            image = Image.fromarray(image, mode=None)
-            b = io.BytesIO()
-            image.save(b, "JPEG", quality=80)
-            b.seek(0)
             metadata = {
                 "storeId": self.metadata['storeId'],
                 "cameraId": cameraId,
                 "timestamp": timeStamp.strftime("%Y-%m-%dT%H:%M:%S.%f"),
-                "record": record
+                "record": record,
+                "stageTimings": dict(stageTimings) if stageTimings is not None else {}
             }
 
-            r = requests.post(self.imageProcessorUrl, files={'image': b, "metadata": json.dumps(metadata)}, timeout=self.uploadTimeout)
+            with traceStage(metadata, 'encode'):
+                b = encodeCameraImage(image)
+
+            imageProcessorUrl = self.imageProcessorRouter.getShard(cameraId)
+            r = requests.post(imageProcessorUrl + "/process_image", files={'image': b, "metadata": json.dumps(metadata)}, timeout=self.uploadTimeout)
+            r.raise_for_status()
+            self.recordUploadResult(imageProcessorUrl, True)
             print(metadata['cameraId'] + "  Successfully uploaded " + metadata['timestamp'])
         except Exception as e:
+            if imageProcessorUrl is not None:
+                self.recordUploadResult(imageProcessorUrl, False)
             print("Failed to upload " + timeStamp.strftime("%Y-%m-%dT%H:%M:%S.%f") + ": " + str(e), traceback.format_exc())
             pass
 
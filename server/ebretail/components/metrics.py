@@ -0,0 +1,236 @@
+import time
+import bisect
+import threading
+import contextlib
+import collections
+import wsgiref.simple_server
+from datetime import datetime
+
+# The content type of the Prometheus text format, which the /metrics endpoints are served in
+metricsContentType = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket bounds for latencies, in seconds, from a millisecond up to a minute
+defaultLatencyBuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+def formatLabels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels) + '}'
+
+
+class Histogram:
+    """
+        A histogram in the style of Prometheus. Each distinct combination of label values has its own set of bucket
+        counts, along with the sum and count of all the observed values.
+    """
+
+    def __init__(self, name, description, labelNames=(), buckets=defaultLatencyBuckets):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.buckets = sorted(buckets)
+
+        self.lock = threading.Lock()
+
+        # Maps each tuple of label values to [bucketCounts, sum, count]. The bucket counts are not cumulative.
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        bucketIndex = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            entry = self.values[key]
+            if bucketIndex < len(self.buckets):
+                entry[0][bucketIndex] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        """ Returns the lines for this histogram in the Prometheus text format."""
+        with self.lock:
+            values = {key: (list(bucketCounts), total, count) for key, (bucketCounts, total, count) in self.values.items()}
+
+        lines = [
+            '# HELP ' + self.name + ' ' + self.description,
+            '# TYPE ' + self.name + ' histogram'
+        ]
+        for key in sorted(values.keys()):
+            bucketCounts, total, count = values[key]
+            labels = list(zip(self.labelNames, key))
+
+            cumulativeCount = 0
+            for bound, bucketCount in zip(self.buckets, bucketCounts):
+                cumulativeCount += bucketCount
+                lines.append(self.name + '_bucket' + formatLabels(labels + [('le', repr(float(bound)))]) + ' ' + str(cumulativeCount))
+            lines.append(self.name + '_bucket' + formatLabels(labels + [('le', '+Inf')]) + ' ' + str(count))
+
+            lines.append(self.name + '_sum' + formatLabels(labels) + ' ' + repr(total))
+            lines.append(self.name + '_count' + formatLabels(labels) + ' ' + str(count))
+        return lines
+
+
+class Counter:
+    """ A counter in the style of Prometheus, which only ever goes up. Each distinct combination of label values is counted separately."""
+
+    metricType = 'counter'
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+
+        self.lock = threading.Lock()
+
+        # Maps each tuple of label values to its current value
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        """ Returns the lines for this metric in the Prometheus text format."""
+        with self.lock:
+            values = dict(self.values)
+
+        lines = [
+            '# HELP ' + self.name + ' ' + self.description,
+            '# TYPE ' + self.name + ' ' + self.metricType
+        ]
+        for key in sorted(values.keys()):
+            lines.append(self.name + formatLabels(list(zip(self.labelNames, key))) + ' ' + repr(values[key]))
+        return lines
+
+
+class Gauge(Counter):
+    """ A gauge in the style of Prometheus, which holds the latest value set for each combination of label values."""
+
+    metricType = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        with self.lock:
+            self.values[key] = value
+
+
+class MetricsRegistry:
+    """ This class holds all of the metrics for a process, and renders them for its /metrics endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()
+
+    def histogram(self, name, description, labelNames=(), buckets=defaultLatencyBuckets):
+        """ Returns the histogram with the given name, creating it if it doesn't exist yet."""
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(name, description, labelNames, buckets)
+            return self.metrics[name]
+
+    def counter(self, name, description, labelNames=()):
+        """ Returns the counter with the given name, creating it if it doesn't exist yet."""
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Counter(name, description, labelNames)
+            return self.metrics[name]
+
+    def gauge(self, name, description, labelNames=()):
+        """ Returns the gauge with the given name, creating it if it doesn't exist yet."""
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Gauge(name, description, labelNames)
+            return self.metrics[name]
+
+    def render(self):
+        """ Returns all of the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Every process has a single registry, which is what its /metrics endpoint serves
+globalMetricsRegistry = MetricsRegistry()
+
+stageLatencyHistogram = globalMetricsRegistry.histogram('ebretail_frame_stage_seconds',
+                                                        'Time taken by each stage of the frame pipeline.',
+                                                        ['stage'])
+
+frameAgeHistogram = globalMetricsRegistry.histogram('ebretail_frame_age_seconds',
+                                                    'Time since a frame was captured, when it reaches each point in the pipeline.',
+                                                    ['point'])
+
+
+def recordStage(metadata, stage, duration):
+    """
+        Records how long a stage of the pipeline took for a frame. The time is stamped into the stageTimings dictionary
+        of the frames metadata, which travels along with the frame, and is added to the stage latency histogram.
+
+        :param metadata: The metadata dictionary for the frame, or None to only record the histogram
+        :param stage: The name of the stage
+        :param duration: How long the stage took, in seconds
+    """
+    if metadata is not None:
+        metadata.setdefault('stageTimings', {})[stage] = duration
+    stageLatencyHistogram.observe(duration, stage=stage)
+
+
+def recordStageTimings(stageTimings):
+    """ Adds stage timings which were stamped by another process, such as the image collector, to the histograms of this one."""
+    for stage, duration in stageTimings.items():
+        stageLatencyHistogram.observe(duration, stage=stage)
+
+
+@contextlib.contextmanager
+def traceStage(metadata, stage):
+    """ Times the code inside the with block, and records it with recordStage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordStage(metadata, stage, time.perf_counter() - start)
+
+
+def recordFrameAge(point, timestamp):
+    """
+        Records how long ago a frame was captured, as it reaches the given point in the pipeline. This compares the
+        frames timestamp against the local clock, so the clocks of the machines involved need to be kept in sync.
+
+        :param point: The name of the point in the pipeline
+        :param timestamp: The timestamp of the frame, in the standard "%Y-%m-%dT%H:%M:%S.%f" format
+    """
+    age = (datetime.now() - datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")).total_seconds()
+    frameAgeHistogram.observe(age, point=point)
+
+
+class QuietRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def startMetricsServer(port, registry=globalMetricsRegistry):
+    """
+        Serves the metrics at /metrics on the given port, from a background thread. This is for the processes which
+        aren't already web applications, such as the multi image analyzer.
+    """
+    def application(environ, start_response):
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+
+        start_response('200 OK', [('Content-Type', metricsContentType)])
+        return [registry.render().encode('utf8')]
+
+    server = wsgiref.simple_server.make_server('', port, application, handler_class=QuietRequestHandler)
+    thread = threading.Thread(target=lambda: server.serve_forever(), daemon=True)
+    thread.start()
+    return server
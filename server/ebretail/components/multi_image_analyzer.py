@@ -15,6 +15,7 @@ from pprint import pprint
 import scipy.linalg
 import bson.json_util
 from ebretail.components.image_analyzer import ImageAnalyzer
+from ebretail.components.metrics import recordStage, traceStage, recordFrameAge
 
 
 class MultiImageAnalyzer:
@@ -70,11 +71,17 @@ class MultiImageAnalyzer:
         multiCameraFramesCollection = self.db.multiCameraFrames
         storesCollection = self.db.stores
 
-        singleCameraFrames = list(singleCameraFramesCollection.find({"frameNumber": frame['frameNumber']}))
-        currentMultiCameraFrame = multiCameraFramesCollection.find_one({"frameNumber": frame['frameNumber']})
-        store = storesCollection.find_one({"_id": frame['storeId']})
+        # This includes the time the frame spent waiting in the scheduler
+        recordFrameAge('multi_camera_start', frame['timestamp'])
 
+        with traceStage(None, 'multi_camera_load'):
+            singleCameraFrames = list(singleCameraFramesCollection.find({"frameNumber": frame['frameNumber']}))
+            currentMultiCameraFrame = multiCameraFramesCollection.find_one({"frameNumber": frame['frameNumber']})
+            store = storesCollection.find_one({"_id": frame['storeId']})
+
+        analysisStart = time.perf_counter()
         newMultiCameraFrame = self.imageAnalyzer.processMultipleCameraFrames(singleCameraFrames, store['cameras'])
+        recordStage(newMultiCameraFrame, 'multi_camera_analysis', time.perf_counter() - analysisStart)
 
         newMultiCameraFrame['storeId'] = currentMultiCameraFrame['storeId']
         newMultiCameraFrame['timestamp'] = currentMultiCameraFrame['timestamp']
@@ -88,3 +95,5 @@ class MultiImageAnalyzer:
         amqpChannel.exchange_declare(exchange=exchangeId, exchange_type='fanout')
         amqpChannel.basic_publish(exchange=exchangeId, routing_key='', body=bson.json_util.dumps(frame))
         amqpChannel.close()
+
+        recordFrameAge('multi_camera_done', frame['timestamp'])
@@ -8,12 +8,64 @@ from pprint import pprint
 from ebretail.components.CaptureTest import CaptureTest
 import hyperopt
 import cProfile
+import pickle
+import random
+import traceback
+import multiprocessing
+import concurrent.futures
+import hashlib
+from ebretail.components.stage_cache import StageCache, StageCacheManager
 
+testFile = '/home/bricks/bricks-analytics-data/session1/capture1.json'
 
+# When set, this DetectionCache is used for every trial instead of opening it again. It is passed on to the trial
+# workers started by parallelMinimize, and each of them opens its own connection to the database.
+sharedDetectionCache = None
+
+
+# When set, a trial stops processing frames as soon as its loss is certain to be worse then this. It is passed on
+# to the trial workers when parallelMinimize starts them, so this only applies to trials run locally or in this process.
+earlyStoppingLoss = None
+
+
+def loadSharedDetectionCache():
+    global sharedDetectionCache
+    sharedDetectionCache = CaptureTest(testFile).openDetectionCache()
+
+
+# The hyper parameters read by each of the cached stages of the pipeline. The results of a stage can be
+# reused by any trial with the same values for these, and for the hyper parameters of all the stages before it.
+stageHyperParameters = {
+    "singleCameraFrames": lambda key: key.startswith('image_tracker_'),
+    "multiCameraFrames": lambda key: key.endswith('_height') or key.endswith('_location_estimate_weight') or key in ['store_map_merge_distance', 'calibration_point_size']
+}
+
+# The most recently used stage results, keyed by computeStageKey. When trials are run by parallelMinimize, this is
+# replaced by a proxy for the StageCache in the manager process, shared by every trial worker for the whole run.
+maxStageCacheEntries = 8
+stageCache = StageCache(maxStageCacheEntries)
+
+stageCacheManager = None
+sharedStageCache = None
+
+
+def getSharedStageCache():
+    """ Returns the stage cache shared by the trial workers, starting the process which holds it the first time."""
+    global stageCacheManager, sharedStageCache
+    if sharedStageCache is None:
+        stageCacheManager = StageCacheManager(ctx=multiprocessing.get_context('spawn'))
+        stageCacheManager.start()
+        sharedStageCache = stageCacheManager.StageCache(maxStageCacheEntries)
+    return sharedStageCache
 
-def computeAccuracy_impl(hyperParameters):
-    testFile = '/home/bricks/bricks-analytics-data/session1/capture1.json'
 
+def computeStageKey(stage, hyperParameters, previousStageKey=None):
+    """ Returns a hash of the hyper parameters that the given stage reads, chained onto the key of the stage before it."""
+    values = {key: value for key, value in hyperParameters.items() if stageHyperParameters[stage](key)}
+    return hashlib.sha1(json.dumps([stage, previousStageKey, values], sort_keys=True).encode('utf8')).hexdigest()
+
+
+def computeAccuracy_impl(hyperParameters):
     test = CaptureTest(testFile)
 
     # Disable validation to improve performance
@@ -24,32 +76,49 @@ def computeAccuracy_impl(hyperParameters):
     test.createCameraConfigurations(showDebug=True)
     test.setHyperParameters(hyperParameters)
 
-    # Reload the cache
-    cacheFile = testFile + "-cached.pickle"
-    test.reloadDetectionCache(cacheFile)
-
-    # Process each of the main sequence images
-    resultSingleCameraFrames, resultDebugImages = test.createSingleCameraFrames()
-
-    # resultDebugImages = [[] for frame in range(test.testData['numberOfImages'])]
-
-    # Process each of the main sequence images
-    # resultSingleCameraFrames, resultDebugImages = test.createSingleCameraFrames()
+    # Use the persistent detection cache
+    if sharedDetectionCache is not None:
+        test.imageAnalyzer.detectionCache = sharedDetectionCache
+    else:
+        test.openDetectionCache()
+
+    # Each stage is only recomputed if the hyper parameters it depends on have changed since it was last run
+    singleCameraStageKey = computeStageKey("singleCameraFrames", hyperParameters)
+    multiCameraStageKey = computeStageKey("multiCameraFrames", hyperParameters, singleCameraStageKey)
+
+    multiCameraFrames = stageCache.get(multiCameraStageKey)
+    if multiCameraFrames is None:
+        resultSingleCameraFrames = stageCache.get(singleCameraStageKey)
+        if resultSingleCameraFrames is None:
+            # Process each of the main sequence images. The debug images are never looked at, so they aren't kept
+            resultSingleCameraFrames, resultDebugImages = test.createSingleCameraFrames(keepDebugImages=False)
+            stageCache.put(singleCameraStageKey, resultSingleCameraFrames)
+
+        # Process into multi camera frame objects
+        multiCameraFrames = test.createMultiCameraFrames(resultSingleCameraFrames)
+        stageCache.put(multiCameraStageKey, multiCameraFrames)
+
+    # Now we produce time-series analysis, scoring each frame as soon as it is produced
+    scorer = test.createAccuracyScorer(len(multiCameraFrames))
+    earlyStopped = False
+    for frameIndex, timeSeriesFrame in enumerate(test.iterateTimeSeriesFrames(multiCameraFrames)):
+        scorer.addFrame(frameIndex, timeSeriesFrame)
+
+        if scorer.shouldStop(earlyStoppingLoss):
+            earlyStopped = True
+            break
+
+    score, details = scorer.computeScore()
+    if earlyStopped:
+        # The lower bound is still worse then the best, so hyperopt learns that these hyper parameters are bad
+        score = scorer.computeLowerBound()
 
-    # Process into multi camera frame objects
-    multiCameraFrames = test.createMultiCameraFrames(resultSingleCameraFrames)
-
-    # Now we produce time-series analysis
-    timeSeriesFrames, visitSummaries = test.runTimeSeriesAnalysis(multiCameraFrames)
-
-    test.saveDetectionCache(cacheFile)
-
-    score, details = test.measureAccuracy(timeSeriesFrames)
     results = {
         "loss": score,
         'status': hyperopt.STATUS_OK,
         "hyperParameters": hyperParameters,
-        "detailedLoss": details
+        "detailedLoss": details,
+        "earlyStopped": earlyStopped
     }
 
     # Print everything
@@ -63,6 +132,65 @@ def computeAccuracy_impl(hyperParameters):
 
 def computeAccuracy(hyperParameters):
     return computeAccuracy_impl(hyperParameters)
+
+
+def initializeTrialWorker(detectionCache, stoppingLoss, stageCacheProxy):
+    """ Gives a trial worker process the shared detection cache, stage cache and early stopping loss of the process that started it."""
+    global sharedDetectionCache, earlyStoppingLoss, stageCache
+    sharedDetectionCache = detectionCache
+    earlyStoppingLoss = stoppingLoss
+    stageCache = stageCacheProxy
+
+
+def parallelMinimize(fn, space, algo, maxEvals, trials, workers):
+    """
+        A local replacement for hyperopt.fmin with MongoTrials. Trials are suggested by the given algorithm a batch at a time,
+        evaluated together in a pool of spawned worker processes, and then recorded in the trials object. No database is needed.
+        The workers share one stage cache, which is kept from one call to the next, so each experiment can reuse the
+        stages computed by the ones before it.
+
+        :param fn: The function to minimize, which must return a hyperopt result dictionary
+        :param space: The hyperopt search space
+        :param algo: The hyperopt suggestion algorithm, e.g. hyperopt.tpe.suggest
+        :param maxEvals: The total number of trials to run, including any already in the trials object
+        :param trials: A hyperopt.Trials object which the results are recorded into
+        :param workers: The number of trials evaluated at the same time
+        :return: The trials object
+    """
+    domain = hyperopt.base.Domain(fn, space)
+
+    # Spawn rather then fork, so the workers don't inherit any tensorflow sessions from this process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=initializeTrialWorker,
+                                                initargs=(sharedDetectionCache, earlyStoppingLoss, getSharedStageCache())) as executor:
+        while len(trials.trials) < maxEvals:
+            trials.refresh()
+
+            # Suggest one trial at a time, since some versions of the algorithms only accept a single new id
+            newTrials = []
+            for newId in trials.new_trial_ids(min(workers, maxEvals - len(trials.trials))):
+                newTrials.extend(algo([newId], domain, trials, random.randint(0, 2 ** 31 - 1)))
+
+            futures = []
+            for trial in newTrials:
+                values = {key: value[0] for key, value in trial['misc']['vals'].items() if len(value) > 0}
+                futures.append(executor.submit(fn, hyperopt.space_eval(space, values)))
+
+            for trial, future in zip(newTrials, futures):
+                try:
+                    trial['result'] = future.result()
+                    trial['state'] = hyperopt.JOB_STATE_DONE
+                except Exception:
+                    # Record it the same as a trial that reported its own failure, so it still counts towards maxEvals
+                    print(traceback.format_exc())
+                    trial['result'] = {'status': hyperopt.STATUS_FAIL}
+                    trial['state'] = hyperopt.JOB_STATE_DONE
+
+            trials.insert_trial_docs(newTrials)
+
+    trials.refresh()
+    return trials
 #
 #     script = """
 # import ebretail.components.optimization
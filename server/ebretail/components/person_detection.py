@@ -0,0 +1,110 @@
+import numpy as np
+
+# We need to double check all of the indexes - some of these might not actually be correlated with the correct body parts
+keypointNames = [
+    'left_ear',
+    'left_eye',
+    'nose',
+    'right_eye',
+    'right_ear',
+    'left_shoulder',
+    'right_shoulder',
+    'left_elbow',
+    'right_elbow',
+    'left_hand',
+    'right_hand',
+    'left_hip',
+    'right_hip',
+    'left_knee',
+    'right_knee',
+    'left_foot',
+    'right_foot'
+]
+
+
+def boundingBoxForKeypoints(keypoints):
+    """ Returns the [left, top, right, bottom] box around all of the detected (non-zero) keypoints of a person."""
+    epsilon = 1e-6
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    detected = keypoints[np.any(keypoints != 0, axis=1)]
+
+    return np.concatenate([np.min(detected, axis=0) - epsilon, np.max(detected, axis=0) + epsilon])
+
+
+class PersonDetection:
+    """
+        This class represents a single person detected within a single camera image. It is the compact, internal
+        version of a person within a SingleCameraFrame object, with the keypoints and feature vector held in numpy
+        arrays rather then nested dictionaries.
+
+        It is only converted to the SingleCameraFrame JSON format when it leaves the process, for example when
+        being sent over HTTP or stored in Mongo.
+    """
+
+    __slots__ = ['detectionId', 'keypoints', 'boundingBox', 'featureVector']
+
+    def __init__(self, detectionId, keypoints, featureVector=None, boundingBox=None):
+        """
+            :param detectionId: The id of this detection, as a string
+            :param keypoints: A [17, 2] array of keypoints, in the order of keypointNames, with zeros for keypoints that weren't detected
+            :param featureVector: The tracking feature vector for this person, or None
+            :param boundingBox: The [left, top, right, bottom] box around this person. Computed from the keypoints if not provided
+        """
+        self.detectionId = detectionId
+        self.keypoints = np.asarray(keypoints, dtype=np.float32).reshape(len(keypointNames), 2)
+
+        if featureVector is None:
+            self.featureVector = None
+        else:
+            self.featureVector = np.asarray(featureVector, dtype=np.float32)
+
+        if boundingBox is None:
+            self.boundingBox = boundingBoxForKeypoints(keypoints)
+        else:
+            self.boundingBox = np.asarray(boundingBox, dtype=np.float64)
+
+    def keypointCount(self):
+        """ Returns the number of keypoints that were detected with both an x and y coordinate."""
+        return int(np.count_nonzero(np.all(self.keypoints != 0, axis=1)))
+
+    def scaled(self, scale):
+        """ Returns a copy of this detection with its keypoints and bounding box multiplied by the given scale."""
+        return PersonDetection(self.detectionId, self.keypoints * scale, self.featureVector, self.boundingBox * scale)
+
+    def toJSON(self):
+        """ Converts this detection into a person object from the SingleCameraFrame format."""
+        keypoints = self.keypoints.tolist()
+        left, top, right, bottom = self.boundingBox.tolist()
+
+        return {
+            "detectionId": self.detectionId,
+            "keypoints": {keypoint: {"x": keypoints[index][0], "y": keypoints[index][1]} for index, keypoint in enumerate(keypointNames)},
+            "bounding_box": {
+                "left": left,
+                "top": top,
+                "right": right,
+                "bottom": bottom,
+                "width": right - left,
+                "height": bottom - top
+            },
+            "featureVector": None if self.featureVector is None else self.featureVector.tolist()
+        }
+
+    @staticmethod
+    def fromJSON(data):
+        """ Creates a PersonDetection from a person object in the SingleCameraFrame format."""
+        keypoints = [[data['keypoints'][keypoint]['x'], data['keypoints'][keypoint]['y']] for keypoint in keypointNames]
+
+        boundingBox = None
+        if data.get('bounding_box', None) is not None:
+            box = data['bounding_box']
+            boundingBox = [box['left'], box['top'], box['right'], box['bottom']]
+
+        return PersonDetection(data['detectionId'], keypoints, data.get('featureVector', None), boundingBox)
+
+
+def singleCameraFrameToJSON(singleCameraFrame):
+    """ Returns a copy of the given SingleCameraFrame object with all of its people converted to the JSON format."""
+    data = dict(singleCameraFrame)
+    data['people'] = [person.toJSON() if isinstance(person, PersonDetection) else person for person in singleCameraFrame['people']]
+    return data
@@ -0,0 +1,56 @@
+import threading
+import collections
+import multiprocessing.managers
+
+
+class StageCache:
+    """
+        This class keeps the results of the most recently used stages of the pipeline, keyed by a hash of the hyper
+        parameters they depend on, so that trials which only change the later stages don't recompute the earlier ones.
+
+        When trials are run in worker processes, a single StageCache is kept in a StageCacheManager process and every
+        worker uses it through a proxy. That way a trial can reuse the stages computed by any other worker, in this or
+        any earlier experiment, rather then only the ones that happened to run in the same process.
+    """
+
+    def __init__(self, maxEntries=8):
+        """
+            :param maxEntries: The maximum number of stage results to keep
+        """
+        self.maxEntries = maxEntries
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, stageKey):
+        """
+            Returns the cached results for the given stage key, or None if there aren't any.
+
+            :param stageKey: The key of the stage, from computeStageKey
+        """
+        with self.lock:
+            if stageKey not in self.entries:
+                return None
+            self.entries.move_to_end(stageKey)
+            return self.entries[stageKey]
+
+    def put(self, stageKey, results):
+        """
+            Stores the results for the given stage key, dropping the least recently used results if there are too many.
+
+            :param stageKey: The key of the stage, from computeStageKey
+            :param results: The results of the stage. These have to be picklable to be shared with other processes.
+        """
+        with self.lock:
+            self.entries[stageKey] = results
+            self.entries.move_to_end(stageKey)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+
+class StageCacheManager(multiprocessing.managers.BaseManager):
+    """ Runs a StageCache in its own process, to be shared by all of the trial worker processes."""
+    pass
+
+
+StageCacheManager.register('StageCache', StageCache)
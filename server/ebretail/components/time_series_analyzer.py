@@ -17,6 +17,8 @@ import bson.json_util
 import pickle
 from ebretail.components.image_analyzer import ImageAnalyzer
 from ebretail.components.visit_summarizer import VisitSummarizer
+from ebretail.components.frame_encoding import encodeArrays, decodeArrays
+from ebretail.components.metrics import recordStage, traceStage, recordFrameAge
 
 
 class TimeSeriesAnalyzer:
@@ -78,25 +80,39 @@ class TimeSeriesAnalyzer:
         storesCollection = self.db.stores
         visitorsCollection = self.db.visitors
 
+        recordFrameAge('time_series_start', multiCameraFrame['timestamp'])
+
         # Get the current state, and process a time series frame
-        currentStateObject = timeSeriesFrameState.find_one({"storeId": multiCameraFrame['storeId']})
-        if currentStateObject is None:
-            currentStateObject = {
-                "storeId": multiCameraFrame['storeId']
-            }
-            currentState = {}
-        else:
-            currentState = pickle.loads(currentStateObject['data'])
+        with traceStage(None, 'time_series_state_load'):
+            currentStateObject = timeSeriesFrameState.find_one({"storeId": multiCameraFrame['storeId']})
+            if currentStateObject is None:
+                currentStateObject = {
+                    "storeId": multiCameraFrame['storeId']
+                }
+                currentState = {}
+            else:
+                currentState = pickle.loads(currentStateObject['data'])
+
+                # The tracker is stored separately as raw arrays, and is restored by the image analyzer
+                if 'trackerArrays' in currentStateObject:
+                    currentState['trackerArrays'] = decodeArrays(currentStateObject['trackerArrays'])
 
         store = storesCollection.find_one({"_id": multiCameraFrame['storeId']})
         store['storeId'] = store['_id'] # quick hack, need to standardize id names
 
+        analysisStart = time.perf_counter()
         timeSeriesFrame, newState = self.imageAnalyzer.processMultiCameraFrameTimeSeries(multiCameraFrame, currentState, store)
+        recordStage(timeSeriesFrame, 'time_series_analysis', time.perf_counter() - analysisStart)
+
         timeSeriesFrames.insert(timeSeriesFrame)
 
-        currentStateObject['data'] = pickle.dumps(newState)
+        with traceStage(None, 'time_series_state_save'):
+            # The tracker is packed into a few numpy arrays rather then pickled, so the state stays small and doesn't grow over time
+            newState = dict(newState)
+            currentStateObject['trackerArrays'] = encodeArrays(newState.pop('tracker').to_arrays())
+            currentStateObject['data'] = pickle.dumps(newState)
 
-        timeSeriesFrameState.find_one_and_update({'storeId': timeSeriesFrame['storeId']}, {'$set': currentStateObject}, upsert=True)
+            timeSeriesFrameState.find_one_and_update({'storeId': timeSeriesFrame['storeId']}, {'$set': currentStateObject}, upsert=True)
 
         # Now create visitor summaries for any visitors from this state
         for person in timeSeriesFrame['people']:
@@ -115,4 +131,7 @@ class TimeSeriesAnalyzer:
         exchangeId = 'store-time-series-frames-' + str(timeSeriesFrame['storeId'])
         amqpChannel.exchange_declare(exchange=exchangeId, exchange_type='fanout')
         amqpChannel.basic_publish(exchange=exchangeId, routing_key='', body=bson.json_util.dumps(timeSeriesFrame))
-        amqpChannel.close()
\ No newline at end of file
+        amqpChannel.close()
+
+        # The full latency of the pipeline, from the frame being captured to its TimeSeriesFrame being published
+        recordFrameAge('time_series_done', multiCameraFrame['timestamp'])
\ No newline at end of file
@@ -5,6 +5,8 @@ import io
 import json
 import shutil
 import gridfs
+from ebretail.components.frame_encoding import decodeSingleCameraFrame, compactContentType
+from ebretail.components.metrics import traceStage, recordFrameAge
 
 
 @view_config(route_name='register_collector')
@@ -52,27 +54,35 @@ def collect_images(request):
         This endpoint is used by our main servers to receive images which have been
         processed by the ImageProcessor sub-module.
 
-        These data received here are SingleCameraFrame objects.
+        These data received here are SingleCameraFrame objects, either as JSON or in the compact binary format.
     """
 
     singleCameraFrameCollection = request.registry.db.singleCameraFrames
     multiCameraFrameCollection = request.registry.db.multiCameraFrames
 
-    data = request.json_body
+    with traceStage(None, 'collect_images_decode'):
+        # Anything not in the compact format is taken as JSON, whatever content type the client sent
+        if request.content_type == compactContentType:
+            data = decodeSingleCameraFrame(request.body)
+        else:
+            data = request.json_body
+
+    recordFrameAge('main_received', data['timestamp'])
 
     frameNumber = int(datetime.strptime(data['timestamp'], "%Y-%m-%dT%H:%M:%S.%f").timestamp() * 2)
     data['frameNumber'] = frameNumber
-    singleCameraFrameCollection.insert(data)
-
-    multiCameraFrameCollection.find_one_and_update({
-        'frameNumber': frameNumber,
-        'storeId': data['storeId']
-    }, {'$set': {
-        'frameNumber': frameNumber,
-        'storeId': data['storeId'],
-        'timestamp': data['timestamp'],
-        'needsUpdate': True
-    }}, upsert=True)
+    with traceStage(None, 'collect_images_store'):
+        singleCameraFrameCollection.insert(data)
+
+        multiCameraFrameCollection.find_one_and_update({
+            'frameNumber': frameNumber,
+            'storeId': data['storeId']
+        }, {'$set': {
+            'frameNumber': frameNumber,
+            'storeId': data['storeId'],
+            'timestamp': data['timestamp'],
+            'needsUpdate': True
+        }}, upsert=True)
 
     return Response('OK')
 
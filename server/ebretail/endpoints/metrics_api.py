@@ -0,0 +1,12 @@
+from pyramid.view import view_config
+from pyramid.response import Response
+from ebretail.components.metrics import globalMetricsRegistry, metricsContentType
+
+
+@view_config(route_name='metrics')
+def metrics(request):
+    """
+        Serves the metrics for the main server in the Prometheus text format, including the latency histograms for the
+        stages of the frame pipeline that run here.
+    """
+    return Response(body=globalMetricsRegistry.render().encode('utf8'), headerlist=[('Content-Type', metricsContentType)])
@@ -7,13 +7,26 @@ from pyramid.security import Everyone
 from pprint import pprint
 from ebretail.models.counter import get_next_object_id
 from ebretail.components.image_analyzer import ImageAnalyzer
+from ebretail.components.detection_image_store import DetectionImageStore
 from PIL import Image
+import bson
 import gridfs
 import pymongo
 import numpy
 import io
 
 
+def stampCalibrationVersions(store):
+    """
+        Gives every camera in the store data a new calibrationVersion, so that the image analyzer knows to rebuild its
+        projection for the camera. This is done on every save, since the calibration can be changed anywhere in the data.
+
+        :param store: The store data being saved
+    """
+    for camera in store.get('cameras', []):
+        camera['calibrationVersion'] = str(bson.ObjectId())
+
+
 @resource(collection_path='/store', path='/store/{id}', cors_origins=('*',), cors_max_age=3600)
 class Store(object):
     def __init__(self, request, context=None):
@@ -40,6 +53,7 @@ class Store(object):
 
     def post(self):
         data = self.request.json_body
+        stampCalibrationVersions(data)
 
         self.storesCollection.update_one({"_id": int(self.request.matchdict['id'])}, {"$set": data})
 
@@ -47,6 +61,7 @@ class Store(object):
 
     def collection_post(self):
         store = self.request.json_body
+        stampCalibrationVersions(store)
 
         # First, get the id
         id = get_next_object_id(self.request.registry.db, "stores")
@@ -207,7 +222,7 @@ class DetectionImage(object):
     def __init__(self, request, context=None):
         self.request = request
 
-        self.detectionImages = gridfs.GridFS(request.registry.db, collection='detectionImages')
+        self.detectionImages = DetectionImageStore(request.registry.db)
 
     def __acl__(self):
         return [(Allow, Everyone, 'everything')]
@@ -217,15 +232,7 @@ class DetectionImage(object):
         storeId = int(self.request.matchdict['storeId'])
         detectionId = self.request.matchdict['detectionId']
 
-        try:
-            image = self.detectionImages.get(detectionId)
-
-            if image is None:
-                return None
-            else:
-                return image
-        except gridfs.errors.NoFile:
-            return None
+        return self.detectionImages.get(detectionId)
 
     def post(self):
         image = self.request.POST['image'].file
@@ -233,12 +240,32 @@ class DetectionImage(object):
         storeId = int(self.request.matchdict['storeId'])
         detectionId = self.request.matchdict['detectionId']
 
-        if self.detectionImages.exists(detectionId):
-            self.detectionImages.delete(detectionId)
+        self.detectionImages.putImages({detectionId: image.read()})
 
-        metadata = {"_id": detectionId}
+        return None
 
-        result = self.detectionImages.put(image, **metadata)
 
-        return None
+@resource(path='/store/{storeId}/detection_images', cors_origins=('*',), cors_max_age=3600)
+class DetectionImages(object):
+    """
+        This RESTful endpoint is used for storing the images of all of the people detected in a single frame at once.
+        Each image is sent as its own 'image' part of the multipart body, with the detectionId as its filename.
+    """
+    def __init__(self, request, context=None):
+        self.request = request
+
+        self.detectionImages = DetectionImageStore(request.registry.db)
+
+    def __acl__(self):
+        return [(Allow, Everyone, 'everything')]
+
+    def post(self):
+        storeId = int(self.request.matchdict['storeId'])
+
+        images = {}
+        for image in self.request.POST.getall('image'):
+            images[image.filename] = image.file.read()
+
+        self.detectionImages.putImages(images)
 
+        return {"stored": len(images)}
@@ -2,29 +2,112 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "lib", "pose-tensorflow"))
 
-import os
-import uuid
-import shutil
-import io
-import cv2
-import numpy
 import json
-import requests
 from datetime import datetime
-import pickle
 from pyramid.response import Response
-from PIL import Image
 from pyramid.view import view_config
 from ebretail.components.image_analyzer import ImageAnalyzer
+from ebretail.components.frame_batcher import FrameBatcher
+from ebretail.components.frame_forwarder import FrameForwarder
+from ebretail.components.detection_cache import DetectionCache
+from ebretail.components.camera_shard import CameraShard
+from ebretail.components.frame_encoding import decodeCameraImage
+from ebretail.components.metrics import globalMetricsRegistry, metricsContentType, traceStage, recordFrameAge, recordStageTimings
 import threading
+import atexit
 
 # The main server URL
-mainServerURL = "http://localhost:1806/collect_images"
+mainServerURL = "http://localhost:1806"
+
+# The state for every camera routed to this processor is kept in main memory. It can be handed over to another
+# processor as a snapshot, through the camera_state endpoints, when the image collector rebalances its cameras.
+globalCameraShard = None
+globalCameraShardLock = threading.Lock()
+
+
+def getCameraShard(settings):
+    global globalCameraShard
+    with globalCameraShardLock:
+        if globalCameraShard is None:
+            globalCameraShard = CameraShard()
+
+            # The camera states can be saved when the processor exits, and picked up again when it restarts.
+            # They are also saved every so often, since nothing runs at exit if the processor is killed or crashes.
+            stateFile = settings.get('image_processor.state_file', None)
+            if stateFile:
+                globalCameraShard.loadCameraStates(stateFile)
+                atexit.register(globalCameraShard.saveCameraStates, stateFile)
+
+                saveInterval = float(settings.get('image_processor.state_save_interval', 30))
+                cameraShard = globalCameraShard
+                threading.Thread(target=lambda: cameraShard.saveCameraStatesThread(stateFile, saveInterval), daemon=True).start()
+        return globalCameraShard
+
+# Images from different cameras arriving at around the same time are run through the pose network together
+globalFrameBatcher = None
+globalFrameBatcherLock = threading.Lock()
+
+
+def getFrameBatcher(settings):
+    global globalFrameBatcher
+    with globalFrameBatcherLock:
+        if globalFrameBatcher is None:
+            imageAnalyzer = ImageAnalyzer.sharedInstance(initializeTracking = True)
+            imageAnalyzer.personDetectorFrequency = int(settings.get('image_processor.detector_frequency', 1))
+            imageAnalyzer.personDetectorMaxFrequency = int(settings.get('image_processor.detector_max_frequency', 1))
+            imageAnalyzer.keypointOpticalFlowEnabled = settings.get('image_processor.keypoint_optical_flow', 'false') == 'true'
+            imageAnalyzer.roiInferenceEnabled = settings.get('image_processor.roi_inference', 'false') == 'true'
+            imageAnalyzer.roiFullFrameInterval = int(settings.get('image_processor.roi_full_frame_interval', 10))
+            imageAnalyzer.roiEntryZones = json.loads(settings.get('image_processor.roi_entry_zones', '[]'))
+            # The motion gate is off unless a threshold is set, since it skips people detection on frames it judges static
+            if settings.get('image_processor.motion_gate_threshold', 'none') != 'none':
+                imageAnalyzer.motionGateThreshold = float(settings['image_processor.motion_gate_threshold'])
+            if settings.get('image_processor.detection_cache_file', None):
+                imageAnalyzer.detectionCache = DetectionCache(settings['image_processor.detection_cache_file'],
+                                                              maxMemoryEntries=int(settings.get('image_processor.detection_cache_size', 10000)))
+
+            globalFrameBatcher = FrameBatcher(imageAnalyzer,
+                                              batchWindow=float(settings.get('image_processor.batch_window', 0.02)),
+                                              maxBatchSize=int(settings.get('image_processor.max_batch_size', 8)))
+        return globalFrameBatcher
+
+# Results are sent onwards to the main server from background threads, so the camera locks aren't held during the posts
+globalFrameForwarder = None
+globalFrameForwarderLock = threading.Lock()
+
+
+def getFrameForwarder(settings):
+    global globalFrameForwarder
+    with globalFrameForwarderLock:
+        if globalFrameForwarder is None:
+            globalFrameForwarder = FrameForwarder(mainServerURL,
+                                                  workers=int(settings.get('image_processor.forward_workers', 4)),
+                                                  maxQueueSize=int(settings.get('image_processor.forward_queue_size', 64)),
+                                                  useCompactFormat=settings.get('image_processor.forward_format', 'json') == 'bson')
+        return globalFrameForwarder
+
+# Counters and gauges for this processor, served along with the latency histograms at /metrics
+framesReceivedCounter = globalMetricsRegistry.counter('ebretail_processor_frames_received_total',
+                                                      'Images received from the image collectors.',
+                                                      ['camera'])
 
-# Temporary, keep state in main memory. Unfortunately, OpenCV objects are not serializable, presenting a great challenge.
-globalState = {}
-globalLocks = {}
-globalLocksLock = threading.Lock()
+framesProcessedCounter = globalMetricsRegistry.counter('ebretail_processor_frames_processed_total',
+                                                       'Images which were run through the image analyzer and queued for forwarding.',
+                                                       ['camera'])
+
+framesDroppedCounter = globalMetricsRegistry.counter('ebretail_processor_frames_dropped_total',
+                                                     'Images which were discarded without being processed, by the reason they were discarded.',
+                                                     ['camera', 'reason'])
+
+peopleDetectedGauge = globalMetricsRegistry.gauge('ebretail_processor_people_detected',
+                                                  'The number of people detected in the last processed image from each camera.',
+                                                  ['camera'])
+
+forwardQueueDepthGauge = globalMetricsRegistry.gauge('ebretail_processor_forward_queue_depth',
+                                                     'The number of results waiting to be forwarded to the main server.')
+
+forwardQueueCapacityGauge = globalMetricsRegistry.gauge('ebretail_processor_forward_queue_capacity',
+                                                        'The number of results which can wait to be forwarded before new ones are dropped.')
 
 # cv2.namedWindow('frame', flags=cv2.WINDOW_NORMAL)
 
@@ -41,9 +124,6 @@ def processImage(request):
        so it is very scaled down and doesn't touch backend
        services. Just process and forward
     """
-    global globalState
-    global globalLocks, globalLocksLock
-
     # Get the data for the file out from the request object
     input_file = request.POST['image'].file
 
@@ -53,90 +133,124 @@ def processImage(request):
 
     timestamp = datetime.strptime(metadata['timestamp'], "%Y-%m-%dT%H:%M:%S.%f")
 
-    # Write file to memory buffer
-    # fileData = io.BytesIO()
-    # input_file.seek(0)
-    # shutil.copyfileobj(input_file, fileData)
-    # fileData.seek(0)
-
-    # Convert binary data to a numpy array
-    image = numpy.array(Image.open(input_file))
-    input_file.close()
-
-    # Copy for the debug image
-    debugImage = image.copy()
-
-    imageAnalyzer = ImageAnalyzer.sharedInstance(initializeTracking = True)
-
-    # Only one process can be working on images for a camera at one time
-    with globalLocksLock:
-        lockId = "camera_processing_lock-" + str(metadata['cameraId'])
-        if lockId not in globalLocks:
-            globalLocks[lockId] = threading.Lock()
-        lock = globalLocks[lockId]
-
-
-    acquired = lock.acquire(timeout=0.1)
-    if acquired:
-        try:
-            # Fet the current state for this camera.
-            currentState = globalState.get(metadata['cameraId'], {})
-
-            currentTimestamp = currentState.get('timestamp', None)
-
-            # Only process this image if its timestamp is after the last processed image
-            # otherwise we discard it from the sequence as out of order.
-            # TODO: We need better handling for these out-of-order images, since this reduces
-            # TODO: quality of the tracking, wastes bandwidth, etc..
-            if currentTimestamp is None or timestamp > currentTimestamp:
-                singleCameraFrame, newState, personImages = imageAnalyzer.processSingleCameraImage(image, metadata, currentState, debugImage)
-                globalState[metadata['cameraId']] = newState
-
-                # Forward the results onwards to the main server cluster
-                r = requests.post(mainServerURL, json=singleCameraFrame)
-
-                # If recording is enabled, save the debug image
-                if metadata['record'] or singleCameraFrame['calibrationObject'] is not None:
-                    recordMetadata = {
-                        "storeId": metadata['storeId'],
-                        "cameraId": metadata['cameraId'],
-                        "timestamp": metadata['timestamp']
-                    }
-
-                    imageRecordUrl = "http://localhost:1806/store/" + str(recordMetadata['storeId']) + "/cameras/" + str(recordMetadata['cameraId']) + "/image"
-
-                    imageToSend = cv2.cvtColor(debugImage, cv2.COLOR_BGR2RGB)
-                    image = Image.fromarray(imageToSend, mode=None)
-                    b = io.BytesIO()
-                    image.save(b, "JPEG", quality=80)
-                    b.seek(0)
-
-                    r = requests.post(imageRecordUrl.format(recordMetadata['cameraId']), files={'image': b, "metadata": json.dumps(recordMetadata)})
-
-                for detectionId, personImage in personImages.items():
-                    imageRecordUrl = "http://localhost:1806/store/" + str(metadata['storeId']) + "/detections/" + str(detectionId) + "/image"
-
-                    image = Image.fromarray(personImage, mode=None)
-                    b = io.BytesIO()
-                    image.save(b, "JPEG", quality=80)
-                    b.seek(0)
-
-                    detectionImageMetadata = {
-                        "storeId": metadata['storeId'],
-                        "cameraId": metadata['cameraId'],
-                        "timestamp": metadata['timestamp'],
-                        "detectionId": detectionId
-                    }
-
-                    r = requests.post(imageRecordUrl, files={'image': b, "metadata": json.dumps(detectionImageMetadata)})
-            else:
-                # print("Discarded image due to out-of-order: " + metadata['timestamp'])
-                pass
-        finally:
-            lock.release()
+    framesReceivedCounter.inc(camera=metadata['cameraId'])
+
+    # Record the stages the image collector has already timed, then keep adding to them as this image moves along
+    recordFrameAge('processor_received', metadata['timestamp'])
+    metadata['stageTimings'] = metadata.get('stageTimings', {})
+    recordStageTimings(metadata['stageTimings'])
+
+    # Decode the JPEG straight from the uploaded bytes into a BGR array, optionally at a reduced size
+    decodeScale = int(request.registry.settings.get('image_processor.decode_scale', 1))
+    try:
+        with traceStage(metadata, 'decode'):
+            image = decodeCameraImage(input_file.read(), decodeScale)
+    except ValueError as e:
+        print("Discarded image which couldn't be decoded: " + metadata['timestamp'])
+        framesDroppedCounter.inc(camera=metadata['cameraId'], reason='decode_error')
+        return Response(str(e), status=400)
+    finally:
+        input_file.close()
+    metadata['imageScale'] = decodeScale
+
+    # Only make a copy for the debug image if it is going to be recorded
+    if metadata['record']:
+        debugImage = image.copy()
     else:
+        debugImage = None
+
+    frameBatcher = getFrameBatcher(request.registry.settings)
+    frameForwarder = getFrameForwarder(request.registry.settings)
+
+    def processWithState(currentState):
+        nonlocal debugImage
+
+        singleCameraFrame, newState, personImages = frameBatcher.processSingleCameraImage(image, metadata, currentState, debugImage)
+
+        framesProcessedCounter.inc(camera=metadata['cameraId'])
+        peopleDetectedGauge.set(len(singleCameraFrame['people']), camera=metadata['cameraId'])
+
+        # The stage timings go along with the frame to the main server
+        singleCameraFrame['stageTimings'] = metadata['stageTimings']
+
+        # The debug image is always saved when the calibration object is visible, so draw it now if we skipped it
+        if debugImage is None and singleCameraFrame['calibrationObject'] is not None:
+            debugImage = image.copy()
+            frameBatcher.imageAnalyzer.drawCalibrationObject(debugImage, newState['calibrationDetectionState']['corners'])
+
+        # Queue the results to be forwarded onwards to the main server cluster. This is done while the camera
+        # lock is still held, so the results for each camera are queued in order.
+        frameForwarder.forwardResults(singleCameraFrame, metadata, debugImage, personImages)
+
+        return newState
+
+    # Only one thread can be working on images for a camera at one time
+    # TODO: We need better handling for out-of-order images, since discarding them reduces
+    # TODO: quality of the tracking, wastes bandwidth, etc..
+    status = getCameraShard(request.registry.settings).processImage(metadata, timestamp, processWithState)
+    if status == "out_of_order":
+        framesDroppedCounter.inc(camera=metadata['cameraId'], reason='out_of_order')
+    elif status == "lock_contended":
         print("Discarded image because i can't get the lock: " + metadata['timestamp'])
+        framesDroppedCounter.inc(camera=metadata['cameraId'], reason='lock_contended')
+    elif status == "handed_over":
+        framesDroppedCounter.inc(camera=metadata['cameraId'], reason='handed_over')
+
+    return Response('OK')
+
 
+@view_config(route_name='camera_state', request_method='GET')
+def exportCameraState(request):
+    """
+        Hands over the tracking state for a camera to whoever is taking it over. The state is removed from this
+        processor, and any more of the cameras images which arrive here are discarded until it is handed back.
+    """
+    snapshot = getCameraShard(request.registry.settings).exportCameraState(request.params['cameraId'])
+    if snapshot is None:
+        return Response(status=404)
+    return Response(body=snapshot, content_type='application/octet-stream')
+
+
+@view_config(route_name='camera_state', request_method='PUT')
+def importCameraState(request):
+    """
+        Takes over the tracking state for a camera, from a snapshot exported by another processor. An empty body takes
+        over the camera without any state, for when the other processor didn't have any.
+    """
+    snapshot = request.body if len(request.body) > 0 else None
+    getCameraShard(request.registry.settings).importCameraState(request.params['cameraId'], snapshot)
     return Response('OK')
 
 
+@view_config(route_name='forwarding_status', renderer='json')
+def forwardingStatus(request):
+    """
+        Reports how far behind the forwarding of results to the main server is. A queue depth which stays near
+        the capacity, or a growing dropped count, means the main server isn't keeping up with this processor.
+    """
+    return getFrameForwarder(request.registry.settings).getMetrics()
+
+
+@view_config(route_name='motion_gate_status', renderer='json')
+def motionGateStatus(request):
+    """
+        Reports how many images have skipped people detection because nothing in them was moving, against how many
+        were processed in full.
+    """
+    return dict(getFrameBatcher(request.registry.settings).imageAnalyzer.motionGateCounters)
+
+
+@view_config(route_name='metrics')
+def metrics(request):
+    """
+        Serves the metrics for this processor in the Prometheus text format, including the latency histograms for each
+        stage of the frame pipeline up to this point.
+    """
+    # The forwarding queues are only measured when the metrics are collected
+    forwarderMetrics = getFrameForwarder(request.registry.settings).getMetrics()
+    forwardQueueDepthGauge.set(forwarderMetrics['queueDepth'])
+    forwardQueueCapacityGauge.set(forwarderMetrics['queueCapacity'])
+
+    return Response(body=globalMetricsRegistry.render().encode('utf8'), headerlist=[('Content-Type', metricsContentType)])
+
+
@@ -27,3 +27,922 @@ class FunctionalTests(unittest.TestCase):
     def test_root(self):
         res = self.testapp.get('/', status=200)
         self.assertTrue(b'Pyramid' in res.body)
+
+
+class CameraImageEncodingTests(unittest.TestCase):
+    def test_colours_survive_upload(self):
+        import numpy as np
+        from ebretail.components.frame_encoding import encodeCameraImage, decodeCameraImage
+
+        # Pure blue, green and red stripes, in the BGR order the cameras give
+        image = np.zeros((48, 48, 3), dtype=np.uint8)
+        image[:16, :, 0] = 255
+        image[16:32, :, 1] = 255
+        image[32:, :, 2] = 255
+
+        decoded = decodeCameraImage(encodeCameraImage(image).read())
+        self.assertEqual(decoded.shape, image.shape)
+        for row, channel in [(8, 0), (24, 1), (40, 2)]:
+            self.assertGreater(int(decoded[row, 24, channel]), 240)
+            self.assertLess(int(np.max(np.delete(decoded[row, 24], channel))), 15)
+
+        reduced = decodeCameraImage(encodeCameraImage(image).read(), decodeScale=2)
+        self.assertEqual(reduced.shape, (24, 24, 3))
+        self.assertGreater(int(reduced[4, 12, 0]), 240)
+
+    def test_corrupt_upload_raises_value_error(self):
+        import numpy as np
+        from ebretail.components.frame_encoding import encodeCameraImage, decodeCameraImage
+
+        encoded = encodeCameraImage(np.zeros((48, 64, 3), dtype=np.uint8)).read()
+        for data in [b'', b'not an image', encoded[:len(encoded) // 2]]:
+            with self.assertRaises(ValueError):
+                decodeCameraImage(data)
+
+
+class DetectionImageStoreTests(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+
+        self.db = mongomock.MongoClient()['ebretail']
+
+    def test_replaces_images(self):
+        import os
+        from ebretail.components.detection_image_store import DetectionImageStore
+
+        store = DetectionImageStore(self.db)
+        large = os.urandom(600000)
+        store.putImages({"1-a-1": b"first", "1-a-2": large})
+        store.putImages({"1-a-1": b"second"})
+
+        self.assertEqual(store.get("1-a-1").read(), b"second")
+        self.assertEqual(store.get("1-a-2").read(), large)
+        self.assertIsNone(store.get("1-a-3"))
+
+        # The old version is gone, along with its chunks
+        self.assertEqual(self.db['detectionImages.files'].count_documents({"filename": "1-a-1"}), 1)
+        self.assertEqual(self.db['detectionImages.chunks'].count_documents({}), 1 + 3)
+
+    def test_replaces_legacy_images(self):
+        import gridfs
+        from ebretail.components.detection_image_store import DetectionImageStore
+
+        store = DetectionImageStore(self.db)
+
+        # Before versions were written, images were stored with the detectionId as their _id
+        gridfs.GridFS(self.db, collection='detectionImages').put(b"legacy", _id="1-a-1")
+        self.assertEqual(store.get("1-a-1").read(), b"legacy")
+
+        store.putImages({"1-a-1": b"replaced"})
+        self.assertEqual(store.get("1-a-1").read(), b"replaced")
+        self.assertEqual(self.db['detectionImages.files'].count_documents({}), 1)
+
+    def test_keeps_newer_versions(self):
+        import datetime
+        from ebretail.components.detection_image_store import DetectionImageStore
+
+        store = DetectionImageStore(self.db)
+
+        # Another upload for the same detection, which finished after this one started
+        store.putImages({"1-a-1": b"newer"})
+        self.db['detectionImages.files'].update_one({"filename": "1-a-1"}, {"$set": {"uploadDate": datetime.datetime.utcnow() + datetime.timedelta(seconds=10)}})
+
+        store.putImages({"1-a-1": b"older"})
+        self.assertEqual(store.get("1-a-1").read(), b"newer")
+
+        # Two uploads in the same millisecond don't leave both versions behind
+        store.putImages({"1-a-2": b"first"})
+        self.db['detectionImages.files'].update_one({"filename": "1-a-2"}, {"$set": {"uploadDate": datetime.datetime(2018, 5, 1)}})
+        store.putImages({"1-a-2": b"second"})
+        self.assertEqual(store.get("1-a-2").read(), b"second")
+        self.assertEqual(self.db['detectionImages.files'].count_documents({"filename": "1-a-2"}), 1)
+
+    def test_bulk_endpoint(self):
+        import urllib3
+        from pyramid import testing
+        from pyramid.request import Request
+        from ebretail.endpoints.store_api import DetectionImages
+        from ebretail.components.detection_image_store import DetectionImageStore
+
+        # Encoded the same way as the image processor sends them
+        body, contentType = urllib3.encode_multipart_formdata([('image', ('1-a-1', b'first')), ('image', ('1-a-2', b'second'))])
+        request = Request.blank('/store/1/detection_images', method='POST', body=body, content_type=contentType)
+        request.registry = testing.setUp().registry
+        request.registry.db = self.db
+        request.matchdict = {"storeId": "1"}
+        try:
+            self.assertEqual(DetectionImages(request).post(), {"stored": 2})
+        finally:
+            testing.tearDown()
+
+        store = DetectionImageStore(self.db)
+        self.assertEqual(store.get("1-a-1").read(), b"first")
+        self.assertEqual(store.get("1-a-2").read(), b"second")
+
+
+class SortAssociationTests(unittest.TestCase):
+    def setUp(self):
+        import sys
+        import os
+        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib"))
+
+    def referenceScoreMatrix(self, detections, trackers, mode, **kwargs):
+        """ The original per-pair implementation of the score matrix, which the vectorized version must match."""
+        import math
+        import numpy as np
+        import scipy.spatial
+        import scipy.special
+        from sort import iou
+
+        matrix = np.zeros((len(detections), len(trackers)), dtype=np.float32)
+        for d, det in enumerate(detections):
+            for t, trk in enumerate(trackers):
+                if np.count_nonzero(det[5:]) == 0 or np.count_nonzero(trk[5:]) == 0:
+                    similarityMetric = 0
+                else:
+                    similarityMetric = 1.0 - scipy.spatial.distance.cosine(det[5:], trk[5:])
+
+                if mode == 'iou':
+                    if similarityMetric < kwargs['feature_vector_threshold']:
+                        similarityMetric = 0.0
+                    matrix[d, t] = iou(det, trk) * kwargs['iou_mode_iou_weight'] + similarityMetric * kwargs['iou_mode_similarity_weight']
+                elif mode == 'euclidean':
+                    cx1 = det[0] / 2 + det[2] / 2
+                    cy1 = det[1] / 2 + det[3] / 2
+                    cx2 = trk[0] / 2 + trk[2] / 2
+                    cy2 = trk[1] / 2 + trk[3] / 2
+                    dist = math.sqrt((cx2 - cx1) * (cx2 - cx1) + (cy2 - cy1) * (cy2 - cy1))
+                    distMetric = scipy.special.expit(dist / (kwargs['euclid_threshold'] / 2))
+                    matrix[d, t] = similarityMetric * kwargs['euclid_mode_similarity_weight'] - distMetric * kwargs['euclid_mode_distance_weight']
+        return matrix
+
+    def randomBoxes(self, random, count, featureSize):
+        import numpy as np
+
+        topLeft = random.uniform(0, 500, size=(count, 2))
+        size = random.uniform(20, 150, size=(count, 2))
+        features = random.normal(size=(count, featureSize))
+        # Some detections don't have a feature vector at all
+        features[random.uniform(size=count) < 0.2] = 0
+        return np.concatenate([topLeft, topLeft + size, np.ones((count, 1)), features], axis=1)
+
+    def test_vectorized_association_matches_reference(self):
+        import numpy as np
+        from sort import compute_score_matrix, associate_detections_to_trackers
+
+        parameters = {
+            "feature_vector_threshold": 0.3,
+            "euclid_threshold": 200,
+            "iou_mode_iou_weight": 1.0,
+            "iou_mode_similarity_weight": 1.5,
+            "euclid_mode_similarity_weight": 2.0,
+            "euclid_mode_distance_weight": 1.0
+        }
+
+        random = np.random.RandomState(42)
+        for trial in range(50):
+            for mode in ['iou', 'euclidean']:
+                detections = self.randomBoxes(random, random.randint(0, 15), 8)
+                trackers = self.randomBoxes(random, random.randint(1, 15), 8)
+
+                expected = self.referenceScoreMatrix(detections, trackers, mode, **parameters)
+                actual = compute_score_matrix(detections, trackers, mode, **parameters)
+                np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+                matches, unmatchedDetections, unmatchedTrackers = associate_detections_to_trackers(detections, trackers, mode, match_score_threshold=0.2, **parameters)
+
+                # Run the assignment on the reference matrix the same way the tracker does
+                from scipy.optimize import linear_sum_assignment
+                detIndices, trkIndices = linear_sum_assignment(-expected)
+                expectedMatches = [[d, t] for d, t in zip(detIndices, trkIndices) if expected[d, t] >= 0.2]
+                expectedUnmatchedDetections = sorted(set(range(len(detections))) - set(d for d, t in expectedMatches))
+                expectedUnmatchedTrackers = sorted(set(range(len(trackers))) - set(t for d, t in expectedMatches))
+
+                self.assertEqual(matches.tolist(), expectedMatches)
+                self.assertEqual(sorted(unmatchedDetections.tolist()), expectedUnmatchedDetections)
+                self.assertEqual(sorted(unmatchedTrackers.tolist()), expectedUnmatchedTrackers)
+
+    def test_propagate_keeps_tracks_between_detections(self):
+        import numpy as np
+        from sort import Sort
+
+        tracker = Sort(max_age=1, min_hits=1, featureVectorSize=2)
+
+        # A box moving 4 pixels right on every frame, with the detector only run every third frame
+        for frame in range(10):
+            if frame % 3 == 0:
+                box = np.array([[100 + frame * 4, 50, 140 + frame * 4, 130, 1, 1, 0]])
+                trackedBoxes = tracker.update(box)
+            else:
+                trackedBoxes = tracker.propagate()
+
+            # The track is only reported once it has been matched to a detection
+            if frame >= 3:
+                self.assertEqual(len(trackedBoxes), 1)
+                self.assertEqual(int(trackedBoxes[0][4]), int(tracker.trackers[0].id + 1))
+
+        self.assertEqual(len(tracker.trackers), 1)
+        self.assertAlmostEqual(trackedBoxes[0][0], 100 + 9 * 4, delta=4)
+
+    def test_tracker_arrays_round_trip(self):
+        import numpy as np
+        from sort import Sort
+
+        def detections(frame):
+            return np.array([[100 + frame * 4, 50, 140 + frame * 4, 130, 1, 1, 0],
+                             [400 - frame * 4, 60, 440 - frame * 4, 140, 1, 0, 1]])
+
+        tracker = Sort(max_age=1, min_hits=1, featureVectorSize=2)
+        for frame in range(5):
+            tracker.update(detections(frame))
+
+        restored = Sort.from_arrays(tracker.to_arrays(), max_age=1, min_hits=1, featureVectorSize=2)
+        self.assertEqual(restored.frame_count, tracker.frame_count)
+
+        # The restored tracker should carry on exactly as the original would have
+        for frame in range(5, 10):
+            if frame % 2 == 0:
+                expected, actual = tracker.update(detections(frame)), restored.update(detections(frame))
+            else:
+                expected, actual = tracker.propagate(), restored.propagate()
+            self.assertEqual(expected.tolist(), actual.tolist())
+
+
+class MergeCameraDetectionsTests(unittest.TestCase):
+    def referenceMergeCameraDetections(self, people, mergeDistance):
+        """ The original loop for merging detections made by different cameras, which mergeCameraDetections must match."""
+        import numpy as np
+        import scipy.spatial
+
+        people = [dict(person) for person in people]
+
+        didMerge = True
+        while didMerge:
+            didMerge = False
+
+            personIndex1 = 0
+            personIndex2 = 0
+            mergePerson1 = None
+            mergePersonIndex1 = None
+            mergePerson2 = None
+            mergePersonIndex2 = None
+            minDistance = None
+
+            while personIndex1 < len(people):
+                personIndex2 = 0
+                while personIndex2 < len(people):
+                    if personIndex1 != personIndex2:
+                        person1 = people[personIndex1]
+                        person2 = people[personIndex2]
+
+                        if len(set(person1['cameraIds']).intersection(set(person2['cameraIds']))) == 0:
+                            dist = scipy.spatial.distance.euclidean(
+                                [person1['x'], person1['y']],
+                                [person2['x'], person2['y']]
+                            )
+
+                            if dist < mergeDistance and (minDistance is None or dist < minDistance):
+                                minDistance = dist
+                                mergePerson1 = person1
+                                mergePersonIndex1 = personIndex1
+
+                                mergePerson2 = person2
+                                mergePersonIndex2 = personIndex2
+                                break
+
+                    personIndex2 += 1
+                personIndex1 += 1
+
+            if mergePerson1 is not None:
+                mergePerson1['x'] = mergePerson1['x'] / 2 + mergePerson2['x'] / 2
+                mergePerson1['y'] = mergePerson1['y'] / 2 + mergePerson2['y'] / 2
+
+                mergePerson1['detectionIds'] = mergePerson1['detectionIds'] + mergePerson2['detectionIds']
+                mergePerson1['cameraIds'] = mergePerson1['cameraIds'] + mergePerson2['cameraIds']
+                if mergePerson1['averageFeatureVector'] is not None and mergePerson2['averageFeatureVector'] is not None:
+                    mergePerson1['averageFeatureVector'] = np.array(mergePerson1['averageFeatureVector']) + np.array(mergePerson2['averageFeatureVector'])
+                elif mergePerson1['averageFeatureVector'] is None and mergePerson2['averageFeatureVector'] is not None:
+                    mergePerson1['averageFeatureVector'] = np.array(mergePerson2['averageFeatureVector'])
+
+                del people[mergePersonIndex2]
+                didMerge = True
+
+        for person in people:
+            if person['averageFeatureVector'] is not None:
+                person['averageFeatureVector'] = (np.array(person['averageFeatureVector']) / len(person['detectionIds'])).tolist()
+
+        return people
+
+    def test_matches_reference(self):
+        import random
+        import numpy as np
+        from ebretail.components.image_analyzer import ImageAnalyzer
+
+        # Only the hyper parameters are needed, not the networks
+        imageAnalyzer = ImageAnalyzer.__new__(ImageAnalyzer)
+
+        random.seed(6)
+        for trial in range(200):
+            mergeDistance = random.choice([50.0, 100.0, 212.0])
+            imageAnalyzer.hyperParameters = {'store_map_merge_distance': mergeDistance}
+
+            # People standing in small groups, seen by several cameras, so there are chains of detections within range
+            people = []
+            for group in range(random.randint(0, 6)):
+                centerX, centerY = random.uniform(0, 1000), random.uniform(0, 1000)
+                for detection in range(random.randint(1, 6)):
+                    cameraId = "camera-" + str(random.randint(1, 4))
+                    people.append({
+                        "x": centerX + random.gauss(0, mergeDistance),
+                        "y": centerY + random.gauss(0, mergeDistance),
+                        "detectionIds": [cameraId + "-" + str(len(people))],
+                        "averageFeatureVector": None if random.random() < 0.2 else [random.random() for value in range(4)],
+                        "cameraIds": [cameraId]
+                    })
+
+            expected = self.referenceMergeCameraDetections(people, mergeDistance)
+            actual = imageAnalyzer.mergeCameraDetections(people)
+
+            self.assertEqual([person['detectionIds'] for person in actual], [person['detectionIds'] for person in expected])
+            self.assertEqual([person['cameraIds'] for person in actual], [person['cameraIds'] for person in expected])
+            for actualPerson, expectedPerson in zip(actual, expected):
+                self.assertAlmostEqual(actualPerson['x'], expectedPerson['x'], places=6)
+                self.assertAlmostEqual(actualPerson['y'], expectedPerson['y'], places=6)
+                if expectedPerson['averageFeatureVector'] is None:
+                    self.assertIsNone(actualPerson['averageFeatureVector'])
+                else:
+                    np.testing.assert_allclose(actualPerson['averageFeatureVector'], expectedPerson['averageFeatureVector'])
+
+
+class CameraProjectionTests(unittest.TestCase):
+    def referenceInverseScreenLocation(self, location, height, rotationVector, translationVector, cameraMatrix, calibrationReference, calibrationPointsSize):
+        """ The original projection of a single screen location onto the store map, which CameraProjection must match."""
+        import numpy as np
+        import scipy.linalg
+        import cv2
+
+        rotationMatrix = cv2.Rodrigues(np.array(rotationVector))[0]
+
+        # Add in another dimension
+        location = np.array([[location[0]], [location[1]], [1]])
+
+        tempMatrix = np.matmul(np.matmul(scipy.linalg.inv(rotationMatrix), scipy.linalg.inv(cameraMatrix)), location)
+
+        tempMatrix2 = np.matmul(scipy.linalg.inv(rotationMatrix), translationVector)
+
+        s = (-height) / calibrationPointsSize + tempMatrix2[2][0]
+
+        s /= tempMatrix[2][0]
+
+        final = np.matmul(scipy.linalg.inv(rotationMatrix),
+                          (s * np.matmul(scipy.linalg.inv(cameraMatrix), location) - translationVector))
+
+        final[0][0] *= calibrationReference['unitWidth']
+        final[1][0] *= calibrationReference['unitHeight']
+
+        if calibrationReference['direction'] == 'east':
+            x = final[0][0]
+            y = final[1][0]
+            final[0][0] = -y + calibrationReference['unitWidth'] * 7
+            final[1][0] = x
+        elif calibrationReference['direction'] == 'west':
+            x = final[0][0]
+            y = final[1][0]
+            final[0][0] = y
+            final[1][0] = -x + calibrationReference['unitHeight'] * 5
+        elif calibrationReference['direction'] == 'south':
+            x = final[0][0]
+            y = final[1][0]
+            final[0][0] = -x + calibrationReference['unitWidth'] * 7
+            final[1][0] = -y + calibrationReference['unitHeight'] * 5
+
+        final[0][0] += calibrationReference['x']
+        final[1][0] += calibrationReference['y']
+
+        return final
+
+    def referenceStoreLocation(self, imageAnalyzer, keypoints, cameraInfo):
+        """ The original estimate of where a single person is standing, which estimateStoreLocations must match."""
+        import numpy as np
+
+        keypoints = {name: {"x": float(keypoints[index][0]), "y": float(keypoints[index][1])} for index, name in enumerate(imageAnalyzer.keypointNames)}
+
+        feet = []
+        knees = []
+        hips = []
+        shoulders = []
+        head = []
+        if keypoints['left_foot']['x'] != 0:
+            feet.append(list(keypoints['left_foot'].values()))
+        if keypoints['right_foot']['y'] != 0:
+            feet.append(list(keypoints['right_foot'].values()))
+
+        if keypoints['left_knee']['x'] != 0:
+            knees.append(list(keypoints['left_knee'].values()))
+        if keypoints['right_knee']['y'] != 0:
+            knees.append(list(keypoints['right_knee'].values()))
+
+        if keypoints['left_hip']['x'] != 0:
+            hips.append(list(keypoints['left_hip'].values()))
+        if keypoints['right_hip']['y'] != 0:
+            hips.append(list(keypoints['right_hip'].values()))
+
+        if keypoints['left_shoulder']['x'] != 0:
+            shoulders.append(list(keypoints['left_shoulder'].values()))
+        if keypoints['right_shoulder']['y'] != 0:
+            shoulders.append(list(keypoints['right_shoulder'].values()))
+
+        if keypoints['left_ear']['x'] != 0:
+            head.append(list(keypoints['left_ear'].values()))
+        if keypoints['right_ear']['y'] != 0:
+            head.append(list(keypoints['right_ear'].values()))
+        if keypoints['left_eye']['x'] != 0:
+            head.append(list(keypoints['left_eye'].values()))
+        if keypoints['right_eye']['y'] != 0:
+            head.append(list(keypoints['right_eye'].values()))
+        if keypoints['nose']['y'] != 0:
+            head.append(list(keypoints['nose'].values()))
+
+        hyperParameters = imageAnalyzer.hyperParameters
+
+        def getStoreLocation(group, height):
+            screenLocation = np.mean(np.array(group), axis=0)
+            return self.referenceInverseScreenLocation(screenLocation,
+                                                       height,
+                                                       np.array(cameraInfo['rotationVector']),
+                                                       np.array(cameraInfo['translationVector']),
+                                                       np.array(cameraInfo['cameraMatrix']),
+                                                       cameraInfo['calibrationReferencePoint'],
+                                                       hyperParameters['calibration_point_size'])
+
+        estimates = []
+        if (len(feet) > 0):
+            estimates.append((hyperParameters['foot_location_estimate_weight'], getStoreLocation(group=feet, height=hyperParameters['foot_height'])))
+        if (len(knees) > 0):
+            estimates.append((hyperParameters['knee_location_estimate_weight'], getStoreLocation(group=knees, height=hyperParameters['knee_height'])))
+        if (len(hips) > 0):
+            estimates.append((hyperParameters['hip_location_estimate_weight'], getStoreLocation(group=hips, height=hyperParameters['hip_height'])))
+        if (len(shoulders) > 0):
+            estimates.append((hyperParameters['shoulder_location_estimate_weight'], getStoreLocation(group=shoulders, height=hyperParameters['shoulder_height'])))
+        if (len(head) > 0):
+            estimates.append((hyperParameters['eye_location_estimate_weight'], getStoreLocation(group=head, height=hyperParameters['eye_height'])))
+
+        if len(estimates) == 0:
+            return None
+
+        totalWeight = 0
+        for estimate in estimates:
+            totalWeight += estimate[0]
+
+        x = 0
+        y = 0
+        for estimate in estimates:
+            x += estimate[1][0][0] * (estimate[0] / totalWeight)
+            y += estimate[1][1][0] * (estimate[0] / totalWeight)
+        return (x, y)
+
+    def randomCameraConfiguration(self, random, cameraId, direction):
+        """ A camera looking down at the calibration object from a few meters away, like the ones made by calibration."""
+        focalLength = random.uniform(400, 1200)
+        return {
+            "cameraId": cameraId,
+            "rotationVector": [[random.uniform(2.5, 3.5)], [random.uniform(-0.4, 0.4)], [random.uniform(-0.4, 0.4)]],
+            "translationVector": [[random.uniform(-5, 5)], [random.uniform(-5, 5)], [random.uniform(10, 30)]],
+            "cameraMatrix": [[focalLength, 0, random.uniform(300, 340)], [0, focalLength, random.uniform(220, 260)], [0, 0, 1]],
+            "calibrationReferencePoint": {
+                "x": random.uniform(0, 500),
+                "y": random.uniform(0, 500),
+                "unitWidth": random.uniform(5, 20),
+                "unitHeight": random.uniform(5, 20),
+                "direction": direction
+            },
+            "width": 640,
+            "height": 480
+        }
+
+    def test_projection_matches_reference(self):
+        import random
+        import numpy as np
+        from ebretail.components.camera_projection import CameraProjection
+
+        random.seed(4)
+        for trial in range(40):
+            cameraInfo = self.randomCameraConfiguration(random, "camera-1", ['north', 'east', 'west', 'south'][trial % 4])
+            calibrationPointSize = random.choice([14, 20])
+            projection = CameraProjection.fromCameraConfiguration(cameraInfo, calibrationPointSize)
+
+            points = np.array([[random.uniform(0, 640), random.uniform(0, 480)] for point in range(25)])
+            heights = np.array([random.uniform(0, 200) for point in range(25)])
+
+            expected = np.array([
+                self.referenceInverseScreenLocation(point, height,
+                                                    np.array(cameraInfo['rotationVector']),
+                                                    np.array(cameraInfo['translationVector']),
+                                                    np.array(cameraInfo['cameraMatrix']),
+                                                    cameraInfo['calibrationReferencePoint'],
+                                                    calibrationPointSize)[:2, 0]
+                for point, height in zip(points, heights)
+            ])
+
+            np.testing.assert_allclose(projection.project(points, heights), expected, rtol=1e-9, atol=1e-6)
+
+    def test_store_locations_match_reference(self):
+        import random
+        import numpy as np
+        from ebretail.components.image_analyzer import ImageAnalyzer
+
+        imageAnalyzer = ImageAnalyzer()
+
+        random.seed(5)
+        for trial in range(40):
+            cameraInfo = self.randomCameraConfiguration(random, "camera-" + str(trial), ['north', 'east', 'west', 'south'][trial % 4])
+
+            # Keypoints are stored as float32, and keypoints that weren't detected are zero, sometimes in only one coordinate
+            keypoints = np.zeros((random.randint(1, 8), len(imageAnalyzer.keypointNames), 2), dtype=np.float32)
+            for person in keypoints:
+                for keypoint in person:
+                    chance = random.random()
+                    if chance < 0.6:
+                        keypoint[:] = [random.uniform(1, 640), random.uniform(1, 480)]
+                    elif chance < 0.7:
+                        keypoint[random.randint(0, 1)] = random.uniform(1, 640)
+
+            locations, valid = imageAnalyzer.estimateStoreLocations(keypoints, cameraInfo)
+
+            for index, person in enumerate(keypoints):
+                expected = self.referenceStoreLocation(imageAnalyzer, person, cameraInfo)
+                if expected is None:
+                    self.assertFalse(valid[index])
+                else:
+                    self.assertTrue(valid[index])
+                    np.testing.assert_allclose(locations[index], expected, rtol=1e-6, atol=1e-4)
+
+
+class CameraShardTests(unittest.TestCase):
+    def setUp(self):
+        import sys
+        import os
+        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib"))
+
+    def createState(self, timestamp):
+        """ Creates a camera state like the one the image analyzer keeps, with a Sort tracker which has been tracking two people."""
+        import numpy as np
+        from sort import Sort
+        from ebretail.components.person_detection import PersonDetection
+
+        tracker = Sort(max_age=1, min_hits=1, featureVectorSize=2)
+        for frame in range(5):
+            tracker.update(np.array([[100 + frame * 4, 50, 140 + frame * 4, 130, 1, 1, 0],
+                                     [400 - frame * 4, 60, 440 - frame * 4, 140, 1, 0, 1]]))
+
+        return {
+            "timestamp": timestamp,
+            "calibrationDetectionState": None,
+            "peopleState": {
+                "stateId": "state-1",
+                "tracker": tracker,
+                "frameIndex": 5,
+                "framesSinceDetection": 0,
+                "motionBackground": np.random.rand(36, 64).astype(np.float32),
+                "grayImage": np.zeros((480, 640), dtype=np.uint8),
+                "bestImages": {"1": {"points": np.int64(12), "blurriness": np.float64(0.25)}},
+                "people": [PersonDetection("1", np.random.rand(17, 2), np.array([1.0, 0.0]))]
+            }
+        }
+
+    def test_ring_placement_is_deterministic(self):
+        from ebretail.components.camera_shard_router import CameraShardRouter
+
+        cameraIds = ["camera-" + str(index) for index in range(200)]
+        router = CameraShardRouter(["a", "b", "c"])
+        shards = [router.getShard(cameraId) for cameraId in cameraIds]
+
+        # The placement only depends on the set of shards, not on the router or the order they were given in
+        self.assertEqual(shards, [CameraShardRouter(["c", "a", "b"]).getShard(cameraId) for cameraId in cameraIds])
+        self.assertEqual(set(shards), {"a", "b", "c"})
+
+    def test_adding_shard_only_moves_cameras_to_it(self):
+        from ebretail.components.camera_shard_router import CameraShardRouter
+
+        handedOver = []
+        router = CameraShardRouter(["a", "b"], handOverCamera=lambda cameraId, oldShard, newShard: handedOver.append((cameraId, oldShard, newShard)))
+        cameraIds = ["camera-" + str(index) for index in range(200)]
+        before = {cameraId: router.getShard(cameraId) for cameraId in cameraIds}
+
+        moves = router.addShard("c")
+
+        self.assertGreater(len(moves), 0)
+        self.assertEqual(moves, handedOver)
+        movedCameraIds = set(move[0] for move in moves)
+        for cameraId in cameraIds:
+            if cameraId in movedCameraIds:
+                self.assertEqual(router.getShard(cameraId), "c")
+            else:
+                self.assertEqual(router.getShard(cameraId), before[cameraId])
+        for cameraId, oldShard, newShard in moves:
+            self.assertEqual(oldShard, before[cameraId])
+            self.assertEqual(newShard, "c")
+
+    def test_removing_shard_only_moves_its_cameras(self):
+        from ebretail.components.camera_shard_router import CameraShardRouter
+
+        handedOver = []
+        router = CameraShardRouter(["a", "b", "c"], handOverCamera=lambda cameraId, oldShard, newShard: handedOver.append((cameraId, oldShard, newShard)))
+        cameraIds = ["camera-" + str(index) for index in range(200)]
+        before = {cameraId: router.getShard(cameraId) for cameraId in cameraIds}
+
+        moves = router.removeShard("b")
+
+        self.assertEqual(moves, handedOver)
+        self.assertEqual(set(move[0] for move in moves), set(cameraId for cameraId in cameraIds if before[cameraId] == "b"))
+        for cameraId in cameraIds:
+            self.assertIn(router.getShard(cameraId), ("a", "c"))
+            if before[cameraId] != "b":
+                self.assertEqual(router.getShard(cameraId), before[cameraId])
+
+    def test_camera_state_round_trip(self):
+        import os
+        import tempfile
+        import numpy as np
+        from datetime import datetime
+        from ebretail.components.camera_shard import CameraShard, createCameraStateSnapshot
+
+        timestamp = datetime(2018, 5, 1, 12, 30, 15, 123456)
+        state = self.createState(timestamp)
+        expectedArrays = state['peopleState']['tracker'].to_arrays()
+
+        oldShard = CameraShard()
+        self.assertEqual(oldShard.processImage({"cameraId": "camera-1"}, timestamp, lambda currentState: state), "processed")
+
+        def checkState(restored):
+            self.assertEqual(restored['timestamp'], timestamp)
+            self.assertIsNone(restored['calibrationDetectionState'])
+            peopleState = restored['peopleState']
+            self.assertNotIn('grayImage', peopleState)
+            self.assertNotIn('tracker', peopleState)
+            for name, array in expectedArrays.items():
+                self.assertEqual(peopleState['trackerArrays'][name].tolist(), array.tolist())
+            self.assertEqual(peopleState['motionBackground'].tolist(), state['peopleState']['motionBackground'].tolist())
+            self.assertEqual(peopleState['bestImages'], {"1": {"points": 12, "blurriness": 0.25}})
+            self.assertEqual(peopleState['people'][0].detectionId, "1")
+            self.assertEqual(peopleState['people'][0].keypoints.tolist(), state['peopleState']['people'][0].keypoints.tolist())
+            self.assertEqual(peopleState['people'][0].featureVector.tolist(), [1.0, 0.0])
+
+        # Through a file, as when the image processor restarts
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, "camera_states")
+            oldShard.saveCameraStates(fileName)
+            restartedShard = CameraShard()
+            restartedShard.loadCameraStates(fileName)
+            checkState(restartedShard.states["camera-1"])
+
+        # And handed over to another shard
+        newShard = CameraShard()
+        newShard.importCameraState("camera-1", oldShard.exportCameraState("camera-1"))
+        self.assertEqual(oldShard.cameraIds(), [])
+        checkState(newShard.states["camera-1"])
+        self.assertIsNone(newShard.exportCameraState("camera-2"))
+
+        # Snapshots are plain data, so anything else in the state is refused rather then stored
+        with self.assertRaises(TypeError):
+            createCameraStateSnapshot({"timestamp": timestamp, "other": object()})
+
+    def test_late_images_discarded_after_export(self):
+        from datetime import datetime, timedelta
+        from ebretail.components.camera_shard import CameraShard
+
+        shard = CameraShard()
+        processed = []
+        def processFunction(currentState):
+            processed.append(currentState)
+            return {"timestamp": timestamp}
+
+        timestamp = datetime(2018, 5, 1, 12, 30, 15)
+        self.assertEqual(shard.processImage({"cameraId": "camera-1"}, timestamp, processFunction), "processed")
+        self.assertIsNotNone(shard.exportCameraState("camera-1"))
+
+        # An image which was already on its way when the camera was handed over
+        timestamp += timedelta(seconds=1)
+        self.assertEqual(shard.processImage({"cameraId": "camera-1"}, timestamp, processFunction), "handed_over")
+        self.assertEqual(len(processed), 1)
+        self.assertEqual(shard.cameraIds(), [])
+
+        # Once the camera is handed back, its images are processed again
+        shard.importCameraState("camera-1", None)
+        timestamp += timedelta(seconds=1)
+        self.assertEqual(shard.processImage({"cameraId": "camera-1"}, timestamp, processFunction), "processed")
+        self.assertEqual(processed[-1], {})
+
+
+class StageCacheTests(unittest.TestCase):
+    def test_stage_results_reused_across_trials(self):
+        from ebretail.components import optimization
+
+        calls = {"singleCameraFrames": 0, "multiCameraFrames": 0}
+
+        class FakeScorer:
+            def addFrame(self, frameIndex, timeSeriesFrame):
+                pass
+
+            def shouldStop(self, bestLoss):
+                return False
+
+            def computeScore(self):
+                return 0, {}
+
+        class FakeCaptureTest:
+            """ Stands in for a capture test, counting how many times each of the cached stages is computed."""
+            def __init__(self, fileName):
+                self.imageAnalyzer = type('FakeImageAnalyzer', (), {'disableValidation': lambda self: None, 'detectionCache': None})()
+
+            def loadCalibrationImage(self):
+                pass
+
+            def createCameraConfigurations(self, showDebug=False):
+                pass
+
+            def setHyperParameters(self, hyperParameters):
+                pass
+
+            def createSingleCameraFrames(self, keepDebugImages=True):
+                calls['singleCameraFrames'] += 1
+                return [{"frame": 1}], None
+
+            def createMultiCameraFrames(self, singleCameraFrames):
+                calls['multiCameraFrames'] += 1
+                return [{"frame": 1}]
+
+            def createAccuracyScorer(self, frames):
+                return FakeScorer()
+
+            def iterateTimeSeriesFrames(self, multiCameraFrames):
+                return iter(multiCameraFrames)
+
+        originalCaptureTest, originalStageCache = optimization.CaptureTest, optimization.stageCache
+        optimization.CaptureTest = FakeCaptureTest
+        optimization.sharedDetectionCache = object()
+        try:
+            # Use the cache in the manager process, the same as a trial worker would
+            optimization.stageCache = optimization.getSharedStageCache()
+
+            baseHyperParameters = {'image_tracker_max_age': 3, 'store_map_merge_distance': 212.0, 'store_map_tracker_min_hits': 2}
+            trials = [
+                (baseHyperParameters, 1, 1),
+                (dict(baseHyperParameters, store_map_tracker_min_hits=5), 1, 1),  # Neither cached stage reads this
+                (dict(baseHyperParameters, store_map_merge_distance=100.0), 1, 2),  # Only the multi camera stage reads this
+                (dict(baseHyperParameters, image_tracker_max_age=6), 2, 3),  # Both stages are computed again
+                (baseHyperParameters, 2, 3)
+            ]
+            for hyperParameters, singleCameraFrames, multiCameraFrames in trials:
+                optimization.computeAccuracy_impl(hyperParameters)
+                self.assertEqual(calls, {"singleCameraFrames": singleCameraFrames, "multiCameraFrames": multiCameraFrames})
+        finally:
+            optimization.CaptureTest, optimization.stageCache = originalCaptureTest, originalStageCache
+            optimization.sharedDetectionCache = None
+            optimization.stageCacheManager.shutdown()
+            optimization.stageCacheManager, optimization.sharedStageCache = None, None
+
+
+class AccuracyScorerTests(unittest.TestCase):
+    def referenceMeasureAccuracy(self, annotationFrames, widthAdjust, heightAdjust, storeMap, timeSeriesFrames):
+        """ The original all-at-once accuracy measurement from CaptureTest, which the incremental scorer must match."""
+        import json
+        import numpy
+        import scipy.optimize
+        import scipy.spatial
+
+        score = 0
+        allTags = set()
+        personTags = {}
+        allAnnotations = json.loads(json.dumps(annotationFrames))
+        timeSeriesFrames = json.loads(json.dumps(timeSeriesFrames))
+
+        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
+            for annotation in allAnnotations[str(frameIndex + 1)]:
+                allTags.add(annotation['tags'][0])
+            for person in timeSeriesFrame['people']:
+                person['annotation'] = None
+                person['groundTruth'] = None
+                personTags[person['visitorId']] = {}
+
+        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
+            people = timeSeriesFrame['people']
+            annotations = allAnnotations[str(frameIndex + 1)]
+
+            matrix = []
+            for person in people:
+                matrix.append([scipy.spatial.distance.euclidean(
+                    [(annotation['x1'] / 2 + annotation['x2'] / 2) * widthAdjust - storeMap['x'],
+                     (annotation['y1'] / 2 + annotation['y2'] / 2) * heightAdjust - storeMap['y']],
+                    [person['x'] * storeMap['width'], person['y'] * storeMap['height']]
+                ) for annotation in annotations])
+
+            assignments = [[], []] if len(matrix) == 0 else scipy.optimize.linear_sum_assignment(numpy.array(matrix))
+            for personIndex, annotationIndex in zip(assignments[0], assignments[1]):
+                person = people[personIndex]
+                annotation = annotations[annotationIndex]
+                tag = annotation['tags'][0]
+                personTags[person['visitorId']][tag] = personTags[person['visitorId']].get(tag, 0) + 1
+                person['annotation'] = annotation
+                person['groundTruth'] = tag
+                person['groundTruthDistance'] = matrix[personIndex][annotationIndex]
+
+        for timeSeriesFrame in timeSeriesFrames:
+            for person in timeSeriesFrame['people']:
+                bestScore = None
+                bestGroundTruth = None
+                for tag, count in personTags[person['visitorId']].items():
+                    if bestScore is None or count > bestScore:
+                        bestScore = count
+                        bestGroundTruth = tag
+
+                if person['groundTruth'] != bestGroundTruth:
+                    person['groundTruth'] = None
+                elif person['groundTruth'] is not None:
+                    person['annotation']['visitorId'] = person['visitorId']
+
+        falsePositiveCostTotal = 0
+        falseNegativeCostTotal = 0
+        distanceCostTotal = 0
+        for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
+            for person in timeSeriesFrame['people']:
+                if person['groundTruth'] is None:
+                    falsePositiveCostTotal += 5000
+                else:
+                    distanceCostTotal += min(1000, person['groundTruthDistance'])
+            for annotation in allAnnotations[str(frameIndex + 1)]:
+                if annotation.get('visitorId', None) is None:
+                    falseNegativeCostTotal += 5000
+
+        extraTracksCostTotal = max(0, len(personTags) - len(allTags)) * 5000
+        score = falsePositiveCostTotal + falseNegativeCostTotal + distanceCostTotal + extraTracksCostTotal
+
+        frames = len(timeSeriesFrames)
+        return score / frames, {
+            "totalCost": score / frames,
+            "falsePositiveCost": falsePositiveCostTotal / frames,
+            "falseNegativeCostTotal": falseNegativeCostTotal / frames,
+            "distanceCostTotal": distanceCostTotal / frames,
+            "extraTracksCostTotal": extraTracksCostTotal / frames,
+        }
+
+    def createCapture(self, seed, frames=12):
+        """ Creates random annotations and tracks, where the tracks follow the annotations with noise, swapped ids, and missed or extra people."""
+        import random
+
+        rng = random.Random(seed)
+        storeMap = {"x": 50, "y": 20, "width": 800, "height": 600}
+        tags = ["person-" + str(index) for index in range(4)]
+
+        annotationFrames = {}
+        timeSeriesFrames = []
+        for frameIndex in range(frames):
+            annotations = []
+            people = []
+            for tagIndex, tag in enumerate(tags):
+                if rng.random() < 0.8:
+                    x = rng.uniform(100, 700)
+                    y = rng.uniform(100, 500)
+                    annotations.append({"x1": x - 20, "x2": x + 20, "y1": y - 40, "y2": y + 40, "tags": [tag]})
+
+                    if rng.random() < 0.85:
+                        # Sometimes the tracker swaps over to a different id for the same person
+                        visitorId = "visitor-" + str(tagIndex if rng.random() < 0.8 else rng.randrange(6))
+                        people.append({
+                            "visitorId": visitorId,
+                            "x": (x - storeMap['x'] + rng.gauss(0, 30)) / storeMap['width'],
+                            "y": (y - storeMap['y'] + rng.gauss(0, 30)) / storeMap['height']
+                        })
+
+            # An occasional person who isn't there at all
+            if rng.random() < 0.2:
+                people.append({"visitorId": "visitor-ghost", "x": rng.random(), "y": rng.random()})
+
+            annotationFrames[str(frameIndex + 1)] = annotations
+            timeSeriesFrames.append({"people": people})
+
+        return annotationFrames, storeMap, timeSeriesFrames
+
+    def test_matches_reference(self):
+        from ebretail.components.accuracy_scorer import AccuracyScorer
+
+        for seed in range(5):
+            annotationFrames, storeMap, timeSeriesFrames = self.createCapture(seed)
+
+            scorer = AccuracyScorer(annotationFrames, 1.0, 1.0, storeMap, len(timeSeriesFrames))
+            lowerBounds = []
+            for frameIndex, timeSeriesFrame in enumerate(timeSeriesFrames):
+                scorer.addFrame(frameIndex, timeSeriesFrame)
+                lowerBounds.append(scorer.computeLowerBound())
+
+            score, details = scorer.computeScore()
+            expectedScore, expectedDetails = self.referenceMeasureAccuracy(annotationFrames, 1.0, 1.0, storeMap, timeSeriesFrames)
+
+            self.assertAlmostEqual(score, expectedScore, places=6)
+            for key in expectedDetails:
+                self.assertAlmostEqual(details[key], expectedDetails[key], places=6)
+
+            # The lower bound along the way can never be above the final loss
+            self.assertLessEqual(max(lowerBounds), score + 1e-6)
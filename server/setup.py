@@ -23,6 +23,7 @@ tests_require = [
     'WebTest >= 1.3.1',  # py3 compat
     'pytest',
     'pytest-cov',
+    'mongomock',
 ]
 
 setup(